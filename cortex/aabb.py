@@ -0,0 +1,315 @@
+"""Axis-aligned bounding box tree over the triangles of a mesh.
+
+The tree is a complete binary tree stored in heap order. Each level is built at once
+by splitting every node's triangles at the median centroid along its longest axis,
+and the triangles are packed `leafsize` to a leaf. Queries are also batched: all queries descend the
+tree together one level at a time, dropping the boxes that cannot hold an answer.
+"""
+import numpy as np
+
+# Fixed, irrational-looking ray direction for inside/outside tests, so that rays
+# practically never graze an edge or vertex of the mesh
+_PARITY_DIR = np.array([0.5773502692, 0.6172133998, 0.5345224838])
+
+class AABBTree(object):
+    """Bounding volume hierarchy over mesh triangles, answering batched closest point,
+    ray intersection and inside/outside queries.
+    """
+    def __init__(self, pts, polys, leafsize=8):
+        """Build the tree.
+
+        Parameters
+        ----------
+        pts : 2D ndarray, shape (total_verts, 3)
+            Vertex coordinates
+        polys : 2D ndarray, shape (total_polys, 3)
+            Indices of the vertices in each triangle
+        leafsize : int, optional
+            Number of triangles in each leaf box
+        """
+        self.pts = np.asarray(pts, dtype=float)
+        self.polys = np.asarray(polys)
+        self.leafsize = leafsize
+        self.ppts = self.pts[self.polys]
+
+        nleaves = max(int(np.ceil(len(self.polys) / float(leafsize))), 1)
+        self.depth = int(np.ceil(np.log2(nleaves)))
+        nleaves = 2 ** self.depth
+
+        ## Split the triangles in half at the median centroid along the longest
+        ## axis of every node, one level at a time. Padding slots (-1) point at the
+        ## extra NaN centroid at the end and sort last.
+        cents = np.full((nleaves * leafsize + 1, 3), np.nan)
+        cents[:len(self.polys)] = self.ppts.mean(1)
+        slots = -np.ones((nleaves * leafsize,), dtype=np.int64)
+        slots[:len(self.polys)] = np.arange(len(self.polys))
+        for level in range(self.depth):
+            blocks = slots.reshape(2 ** level, -1)
+            bcents = cents[blocks]
+            lo = np.where(np.isnan(bcents), np.inf, bcents).min(1)
+            hi = np.where(np.isnan(bcents), -np.inf, bcents).max(1)
+            axis = np.argmax(hi - lo, axis=1)
+            key = np.take_along_axis(bcents, axis[:,np.newaxis,np.newaxis], axis=2)[:,:,0]
+            key[np.isnan(key)] = np.inf
+            half = blocks.shape[1] // 2
+            split = np.argpartition(key, half - 1, axis=1)
+            slots = np.take_along_axis(blocks, split, axis=1).ravel()
+        self.leaves = slots.reshape(nleaves, leafsize)
+        self._vertex_index = None
+
+        ## Leaf boxes bound their triangles, and every parent bounds its two children.
+        ## Empty leaves get inverted boxes, which no query can reach.
+        valid = slots >= 0
+        lo = np.full((nleaves * leafsize, 3), np.inf)
+        hi = np.full((nleaves * leafsize, 3), -np.inf)
+        lo[valid] = self.ppts[slots[valid]].min(1)
+        hi[valid] = self.ppts[slots[valid]].max(1)
+        self.lo = np.empty((2 * nleaves - 1, 3))
+        self.hi = np.empty((2 * nleaves - 1, 3))
+        self.lo[nleaves-1:] = lo.reshape(nleaves, leafsize, 3).min(1)
+        self.hi[nleaves-1:] = hi.reshape(nleaves, leafsize, 3).max(1)
+        for level in range(self.depth - 1, -1, -1):
+            nodes = np.arange(2 ** level - 1, 2 ** (level + 1) - 1)
+            self.lo[nodes] = np.minimum(self.lo[2*nodes+1], self.lo[2*nodes+2])
+            self.hi[nodes] = np.maximum(self.hi[2*nodes+1], self.hi[2*nodes+2])
+
+    def _descend(self, query, test):
+        """Walk all queries down the tree, keeping the (query, node) pairs for which
+        `test(query, node)` is True. Returns the surviving (query, leaf) pairs.
+        """
+        node = np.zeros_like(query)
+        for _ in range(self.depth):
+            keep = test(query, node)
+            query, node = query[keep], node[keep]
+            query = np.repeat(query, 2)
+            node = (2 * np.repeat(node, 2) + 1) + np.tile([0, 1], len(node))
+
+        keep = test(query, node)
+        return query[keep], node[keep] - (2 ** self.depth - 1)
+
+    def _leaf_tris(self, query, leaf):
+        """Expand (query, leaf) pairs into (query, triangle) pairs."""
+        tris = self.leaves[leaf].ravel()
+        query = np.repeat(query, self.leafsize)
+        valid = tris >= 0
+        return query[valid], tris[valid]
+
+    def closest_point(self, points, max_dist=np.inf, chunksize=65536, blocksize=131072):
+        """Find the closest point on the mesh to each of `points`.
+
+        Parameters
+        ----------
+        points : 2D ndarray, shape (n, 3)
+            Query points
+        max_dist : float, optional
+            Skip points farther than this from the mesh, which is much faster when
+            most points are far away.
+        chunksize : int, optional
+            Number of points to query at once
+        blocksize : int, optional
+            Number of leaves to test at once. Together with `chunksize`, this bounds
+            memory use.
+
+        Returns
+        -------
+        dist : 1D ndarray, shape (n,)
+            Distance to the mesh, inf for points beyond `max_dist`
+        faces : 1D ndarray, shape (n,)
+            Triangle holding the closest point, -1 for points beyond `max_dist`
+        bary : 2D ndarray, shape (n, 3)
+            Barycentric coordinates of the closest point in that triangle
+        """
+        from scipy.spatial import cKDTree
+        points = np.asarray(points, dtype=float)
+        ppts = self.ppts
+        if self._vertex_index is None:
+            # Nearest vertex lookup, and the faces around each vertex as a ragged array
+            verts = np.unique(self.polys)
+            order = np.argsort(self.polys.ravel(), kind='mergesort')
+            offsets = np.searchsorted(self.polys.ravel()[order], np.arange(len(self.pts) + 1))
+            maxedge = np.sqrt(((ppts - np.roll(ppts, 1, axis=1))**2).sum(-1).max())
+            self._vertex_index = cKDTree(self.pts[verts]), verts, order // 3, offsets, maxedge
+        kdt, verts, vertfaces, offsets, maxedge = self._vertex_index
+
+        dist = np.full((len(points),), np.inf)
+        faces = -np.ones((len(points),), dtype=np.int64)
+        bary = np.zeros((len(points), 3))
+        for start in range(0, len(points), chunksize):
+            pts = points[start:start+chunksize]
+            best = np.full((len(pts),), np.inf)
+
+            def update(query, tris):
+                # Keep the nearest triangle for every query
+                cbary = closest_on_triangles(pts[query], ppts[tris])
+                cdist = (((cbary[:,:,np.newaxis] * ppts[tris]).sum(1) - pts[query])**2).sum(1)
+                idx = np.lexsort((cdist, query))
+                first = np.ones((len(idx),), dtype=bool)
+                first[1:] = query[idx][1:] != query[idx][:-1]
+                idx = idx[first]
+                idx = idx[cdist[idx] < best[query[idx]]]
+                best[query[idx]] = cdist[idx]
+                faces[start + query[idx]] = tris[idx]
+                bary[start + query[idx]] = cbary[idx]
+
+            # A point farther than max_dist + the longest edge from every vertex is
+            # out of range. Otherwise, the faces around the nearest vertex usually
+            # hold the answer, and give a tight bound to prune the tree with.
+            vdist, vidx = kdt.query(pts, distance_upper_bound=max_dist + maxedge)
+            todo = np.nonzero(np.isfinite(vdist))[0]
+            near = verts[vidx[todo]]
+            count = offsets[near + 1] - offsets[near]
+            update(np.repeat(todo, count),
+                   vertfaces[np.repeat(offsets[near + 1] - count.cumsum(), count) + np.arange(count.sum())])
+
+            def gap(query, node):
+                lo, hi = self.lo[node] - pts[query], pts[query] - self.hi[node]
+                return (np.maximum(np.maximum(lo, hi), 0)**2).sum(1)
+
+            def test(query, node):
+                return gap(query, node) <= np.minimum(best[query], max_dist**2)
+
+            # Test the nearest leaves first, so that the bound tightens quickly
+            query, leaf = self._descend(todo, test)
+            lgap = gap(query, leaf + 2 ** self.depth - 1)
+            order = np.argsort(lgap, kind='mergesort')
+            query, leaf, lgap = query[order], leaf[order], lgap[order]
+            for block in range(0, len(query), blocksize):
+                bquery, bleaf = query[block:block+blocksize], leaf[block:block+blocksize]
+                keep = lgap[block:block+blocksize] <= np.minimum(best[bquery], max_dist**2)
+                update(*self._leaf_tris(bquery[keep], bleaf[keep]))
+
+            inrange = best <= max_dist**2
+            dist[start:start+chunksize][inrange] = np.sqrt(best[inrange])
+            faces[start:start+chunksize][~inrange] = -1
+            bary[start:start+chunksize][~inrange] = 0
+
+        return dist, faces, bary
+
+    def intersect(self, origins, directions, all_hits=False):
+        """Intersect rays with the mesh.
+
+        Parameters
+        ----------
+        origins : 2D ndarray, shape (n, 3)
+            Starting point of each ray
+        directions : 2D ndarray, shape (n, 3) or (3,)
+            Direction of each ray. Hit distances are in units of its length.
+        all_hits : bool, optional
+            If True, return every hit instead of only the first one along each ray
+
+        Returns
+        -------
+        t : 1D ndarray
+            Distance along the ray to the hit, inf if the ray misses
+        faces : 1D ndarray
+            Triangle that was hit, -1 if the ray misses
+        bary : 2D ndarray, shape (len(t), 3)
+            Barycentric coordinates of the hit in that triangle
+        rays : 1D ndarray
+            Only if `all_hits`, the ray of each hit. Hits are sorted by ray, then t.
+        """
+        origins = np.atleast_2d(np.asarray(origins, dtype=float))
+        directions = np.broadcast_to(np.asarray(directions, dtype=float), origins.shape)
+        with np.errstate(divide='ignore'):
+            invdir = 1. / directions
+
+        def test(query, node):
+            with np.errstate(invalid='ignore'):
+                t1 = (self.lo[node] - origins[query]) * invdir[query]
+                t2 = (self.hi[node] - origins[query]) * invdir[query]
+                tnear = np.nan_to_num(np.minimum(t1, t2), nan=-np.inf).max(1)
+                tfar = np.nan_to_num(np.maximum(t1, t2), nan=np.inf).min(1)
+            return np.logical_and(tnear <= tfar, tfar >= 0)
+
+        query, tris = self._leaf_tris(*self._descend(np.arange(len(origins)), test))
+        t, bary = _ray_triangles(origins[query], directions[query], self.pts[self.polys[tris]])
+        hit = np.isfinite(t)
+        query, tris, t, bary = query[hit], tris[hit], t[hit], bary[hit]
+        order = np.lexsort((t, query))
+        query, tris, t, bary = query[order], tris[order], t[order], bary[order]
+        if all_hits:
+            return t, tris, bary, query
+
+        first = np.ones((len(query),), dtype=bool)
+        first[1:] = query[1:] != query[:-1]
+        tfirst = np.full((len(origins),), np.inf)
+        faces = -np.ones((len(origins),), dtype=np.int64)
+        hitbary = np.zeros((len(origins), 3))
+        tfirst[query[first]] = t[first]
+        faces[query[first]] = tris[first]
+        hitbary[query[first]] = bary[first]
+        return tfirst, faces, hitbary
+
+    def contains(self, points):
+        """Test whether `points` are inside the mesh, which must be closed, by the
+        parity of the number of times a ray from each point crosses it.
+        """
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        t, faces, bary, rays = self.intersect(points, _PARITY_DIR, all_hits=True)
+        return np.bincount(rays, minlength=len(points)) % 2 == 1
+
+def closest_on_triangles(pts, tris):
+    """Barycentric coordinates of the closest point on each triangle to each point,
+    following Ericson, Real-Time Collision Detection, 5.1.5.
+
+    Parameters
+    ----------
+    pts : 2D ndarray, shape (n, 3)
+        Query points
+    tris : 3D ndarray, shape (n, 3, 3)
+        Corners of the triangle for each point
+
+    Returns
+    -------
+    bary : 2D ndarray, shape (n, 3)
+    """
+    a, b, c = tris[:,0], tris[:,1], tris[:,2]
+    dot = lambda x, y: (x * y).sum(1)
+    ab, ac = b - a, c - a
+    ap, bp, cp = pts - a, pts - b, pts - c
+    d1, d2 = dot(ab, ap), dot(ac, ap)
+    d3, d4 = dot(ab, bp), dot(ac, bp)
+    d5, d6 = dot(ab, cp), dot(ac, cp)
+    va, vb, vc = d3*d6 - d5*d4, d5*d2 - d1*d6, d1*d4 - d3*d2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Assign from the interior outwards, so that the corner regions win ties
+        denom = va + vb + vc
+        v, w = vb / denom, vc / denom
+        bary = np.array([1 - v - w, v, w]).T
+        region = [(np.logical_and(va <= 0, np.logical_and(d4 - d3 >= 0, d5 - d6 >= 0)),
+                   lambda w: [0 * w, 1 - w, w], (d4 - d3) / ((d4 - d3) + (d5 - d6))),
+                  (np.logical_and(vb <= 0, np.logical_and(d2 >= 0, d6 <= 0)),
+                   lambda w: [1 - w, 0 * w, w], d2 / (d2 - d6)),
+                  (np.logical_and(d6 >= 0, d5 <= d6),
+                   lambda w: [0 * w, 0 * w, 1 + 0 * w], d6),
+                  (np.logical_and(vc <= 0, np.logical_and(d1 >= 0, d3 <= 0)),
+                   lambda v: [1 - v, v, 0 * v], d1 / (d1 - d3)),
+                  (np.logical_and(d3 >= 0, d4 <= d3),
+                   lambda v: [0 * v, 1 + 0 * v, 0 * v], d3),
+                  (np.logical_and(d1 <= 0, d2 <= 0),
+                   lambda v: [1 + 0 * v, 0 * v, 0 * v], d1)]
+        for mask, weights, param in region:
+            bary[mask] = np.array(weights(param[mask])).T
+
+    # Degenerate triangles fall back to their first corner
+    bary[~np.isfinite(bary).all(1)] = [1, 0, 0]
+    return bary
+
+def _ray_triangles(origins, directions, tris, eps=1e-12):
+    """Moller-Trumbore intersection of each ray with its triangle. Returns the hit
+    distance (inf on a miss) and the barycentric coordinates of the hit.
+    """
+    e1 = tris[:,1] - tris[:,0]
+    e2 = tris[:,2] - tris[:,0]
+    pvec = np.cross(directions, e2)
+    det = (e1 * pvec).sum(1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inv = 1. / det
+        tvec = origins - tris[:,0]
+        u = (tvec * pvec).sum(1) * inv
+        qvec = np.cross(tvec, e1)
+        v = (directions * qvec).sum(1) * inv
+        t = (e2 * qvec).sum(1) * inv
+        hit = (np.abs(det) > eps) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t >= 0)
+        return np.where(hit, t, np.inf), np.array([1 - u - v, u, v]).T
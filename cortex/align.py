@@ -183,7 +183,7 @@ def autotweak(subject, xfmname):
     magnet = db.get_xfm(subject, xfmname, xfmtype='magnet')
     try:
         cache = tempfile.mkdtemp()
-        epifile = magnet.reference.get_filename()
+        epifile = magnet.reference_file
         raw = db.get_anat(subject, type='raw').get_filename()
         bet = db.get_anat(subject, type='brainmask').get_filename()
         wmseg = db.get_anat(subject, type='whitematter').get_filename()
@@ -50,7 +50,7 @@ def whitematter(outfile, subject, do_voxelize=False):
         finally:
             shutil.rmtree(cache)
 
-def voxelize(outfile, subject, surf='wm', mp=True):
+def voxelize(outfile, subject, surf='wm'):
     '''Voxelize the whitematter surface to generate the white matter mask'''
     from . import polyutils
     nib = db.get_anat(subject, "raw")
@@ -58,7 +58,7 @@ def voxelize(outfile, subject, surf='wm', mp=True):
     vox = np.zeros(shape, dtype=bool)
     for pts, polys in db.get_surf(subject, surf, nudge=False):
         xfm = Transform(np.linalg.inv(nib.get_affine()), nib)
-        vox += polyutils.voxelize(xfm(pts), polys, shape=shape, center=(0,0,0), mp=mp).astype('bool')
+        vox += polyutils.voxelize(xfm(pts), polys, shape=shape, center=(0,0,0)).astype('bool')
 
     import nibabel
     nib = nibabel.Nifti1Image(vox, nib.get_affine(), header=nib.get_header())
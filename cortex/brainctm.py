@@ -21,6 +21,7 @@ from scipy.spatial import cKDTree
 
 from .database import db
 from .utils import get_cortical_mask, get_mapper, get_dropout
+from . import cache
 from . import polyutils
 from openctm import CTMfile
 
@@ -110,21 +111,11 @@ class BrainCTM(object):
         (rpts, _, _), rbin = self.right.save(method=method, **kwargs)
 
         offsets = [0]
-        with open(path+'.ctm', 'w') as fp:
+        with cache.atomic_write(path+'.ctm', 'w') as fp:
             fp.write(lbin)
             offsets.append(fp.tell())
             fp.write(rbin)
 
-        # Save the JSON descriptor | Need to add to this for extra_disp?
-        jsdict = dict(rois=os.path.split(svgname)[1],
-                      data=os.path.split(ctmname)[1],
-                      names=self.types, 
-                      materials=[],
-                      offsets=offsets)
-        if self.flatlims is not None:
-            jsdict['flatlims'] = self.flatlims
-        json.dump(jsdict, open(jsname, 'w'))
-
         # Compute and save the index map
         if method != 'raw':
             ptmap, inverse = [], []
@@ -152,7 +143,7 @@ class BrainCTM(object):
                 layers = (layers,)
             
             # assign coordinates in left hemisphere negative values
-            with open(svgname, "w") as fp:
+            with cache.atomic_write(svgname, "w") as fp:
                 for layer in layers:
                     for element in layer.findall(".//{http://www.w3.org/2000/svg}text"):
                         idx = int(element.attrib["data-ptidx"])
@@ -163,6 +154,18 @@ class BrainCTM(object):
                             idx = inverse[1][idx] + len(inverse[0])
                         element.attrib["data-ptidx"] = str(idx)
                 fp.write(roipack.toxml())
+
+        # Save the JSON descriptor last, since its presence marks a complete pack
+        # | Need to add to this for extra_disp?
+        jsdict = dict(rois=os.path.split(svgname)[1],
+                      data=os.path.split(ctmname)[1],
+                      names=self.types, 
+                      materials=[],
+                      offsets=offsets)
+        if self.flatlims is not None:
+            jsdict['flatlims'] = self.flatlims
+        with cache.atomic_write(jsname, 'w') as fp:
+            json.dump(jsdict, fp)
         return ptmap
 
 class Hemi(object):
@@ -207,19 +210,20 @@ class Hemi(object):
 class DecimatedHemi(Hemi):
     def __init__(self, pts, polys, fpolys, pia=None):
         print("Decimating...")
-        kdt = cKDTree(pts)
         mask = np.zeros((len(pts),), dtype=bool)
 
         fidset = set([tuple(p) for p in polyutils.sort_polys(polys)])
         flatset = set([tuple(p) for p in polyutils.sort_polys(fpolys)])
         mwall = np.array(list(fidset - flatset))
 
-        dpts, dpolys = polyutils.decimate(pts, fpolys)
-        dist, didx = kdt.query(dpts)
+        # Decimation keeps boundaries, so the flat part and the medial wall still
+        # meet along the cut, and maps every remaining vertex back to the original.
+        # A tenth of the vertices are kept, denser than the old VTK decimation, which
+        # removed as many as it could.
+        dpts, dpolys, didx = polyutils.decimate(pts, fpolys, reduction=.9, return_map=True)
         mask[didx] = True
 
-        mwpts, mwpolys = polyutils.decimate(pts, mwall)
-        dist, mwidx = kdt.query(mwpts)
+        mwpts, mwpolys, mwidx = polyutils.decimate(pts, mwall, reduction=.9, return_map=True)
         mask[mwidx] = True
 
         allpolys = np.vstack([didx[dpolys], mwidx[mwpolys]])
@@ -0,0 +1,193 @@
+"""Single-file subject bundles, for machines that do not have the filestore.
+
+A bundle is a read-only HDF5 file with one subject's surfaces, transforms and masks,
+its anatomicals, ROI overlay and surface info, and optionally its derived caches
+(mappers, flatmaps, ctm packs). Arrays are stored chunked and compressed, and a JSON
+index of the contents is kept in the root attributes, so opening a bundle reads no
+groups. Write one with `pack`, and serve it from the database with `Database.mount`::
+
+    cortex.bundle.pack("S1", "S1.pycx")
+    ...
+    cortex.db.mount("S1.pycx")
+
+Mounted subjects are read from the bundle. Files that consumers need on disk, such as
+the anatomicals, the overlay and the caches, are extracted into a scratch copy of the
+subject directory in the temporary directory when they are first used. The scratch
+directory also holds any caches built later.
+"""
+import os
+import json
+import tempfile
+import numpy as np
+import h5py
+
+from . import cache
+
+_version = 1
+
+def _write(group, name, data):
+    data = np.asarray(data)
+    if data.size == 0:
+        return group.create_dataset(name, data=data)
+    return group.create_dataset(name, data=data, chunks=True, compression="gzip",
+                                shuffle=True)
+
+def _packed_files(subjdir, caches=True):
+    """Files of the subject directory to store in a bundle, relative to it."""
+    files = ["rois.svg"]
+    dirnames = ["anatomicals", "surface-info"] + (["cache"] if caches else [])
+    for dirname in dirnames:
+        try:
+            names = sorted(os.listdir(os.path.join(subjdir, dirname)))
+        except OSError:
+            continue
+        for name in names:
+            # Skip temporary files, locks and the cache manifest
+            if name.startswith(".") or name.endswith(".lock") or name == cache._manifest_name:
+                continue
+            if os.path.isfile(os.path.join(subjdir, dirname, name)):
+                files.append(dirname + "/" + name)
+    return [f for f in files if os.path.isfile(os.path.join(subjdir, f))]
+
+def pack(subject, filename, xfms=None, caches=True):
+    """Pack a subject from the filestore into the bundle `filename`.
+
+    Parameters
+    ----------
+    subject : str
+        Name of the subject
+    filename : str
+        Bundle to write. It is written to a temporary file and renamed into place.
+    xfms : list of str, optional
+        Transforms to include, with all their masks. Defaults to every transform.
+    caches : bool, optional
+        Include the subject cache, so that mounted bundles start out with the
+        mappers, flatmaps and ctm packs already built
+    """
+    from .database import db
+    paths = db.get_paths(subject)
+    subjdir = os.path.join(db.filestore, subject)
+    if xfms is None:
+        xfms = paths['xfms']
+
+    index = dict(version=_version, subject=subject, surfs=dict(), xfms=list(xfms),
+                 masks=dict(), files=dict())
+    with cache.atomic_path(filename) as tmpname:
+        with h5py.File(tmpname, "w") as h5:
+            for name, hemis in paths['surfs'].items():
+                index['surfs'][name] = sorted(hemis)
+                for hemi in hemis:
+                    pts, polys = db.get_surf(subject, name, hemi)
+                    group = h5.require_group("surfaces/%s/%s"%(name, hemi))
+                    _write(group, "pts", pts)
+                    _write(group, "polys", polys)
+
+            for xfmname in xfms:
+                group = h5.require_group("transforms/%s"%xfmname)
+                for xfmtype in ("coord", "magnet"):
+                    xfm = db.get_xfm(subject, xfmname, xfmtype)
+                    group.create_dataset(xfmtype, data=np.asarray(xfm.xfm))
+                group.attrs['shape'] = xfm.shape
+                group.attrs['affine'] = xfm.affine
+
+                masks = db._mask_index(subject, xfmname)
+                index['masks'][xfmname] = sorted(masks)
+                for type, entry in masks.items():
+                    node = _write(group, "masks/%s"%type, entry['bits'])
+                    node.attrs['nvox'] = entry['nvox']
+                    node.attrs['digest'] = entry['digest']
+                    node.attrs['shape'] = entry['shape']
+
+            for relpath in _packed_files(subjdir, caches):
+                with open(os.path.join(subjdir, relpath), "rb") as fp:
+                    data = np.frombuffer(fp.read(), dtype=np.uint8)
+                _write(h5, "files/%s"%relpath, data)
+                index['files'][relpath] = len(data)
+
+            h5.attrs['index'] = json.dumps(index, sort_keys=True)
+    return filename
+
+class Bundle(object):
+    """A subject bundle written by `pack`, opened read-only."""
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self.h5 = h5py.File(self.filename, "r")
+        try:
+            self.index = json.loads(self.h5.attrs['index'])
+        except KeyError:
+            self.h5.close()
+            raise IOError('Not a subject bundle: %s'%filename)
+        if self.index['version'] > _version:
+            self.h5.close()
+            raise IOError('Subject bundle %s is from a newer version'%filename)
+        self.subject = self.index['subject']
+        self._masks = dict()
+        self._extracted = set()
+
+        stat = os.stat(self.filename)
+        hashname = "pycx_%s"%cache.digest(self.filename, stat.st_mtime, stat.st_size)[:8]
+        self.scratch = os.path.join(tempfile.gettempdir(), hashname, self.subject)
+
+    def __repr__(self):
+        return "<Subject bundle of %s in %s>"%(self.subject, self.filename)
+
+    def close(self):
+        self.h5.close()
+
+    def get_surf(self, type, hemi):
+        try:
+            group = self.h5["surfaces/%s/%s"%(type, hemi)]
+        except KeyError:
+            raise IOError('Surface not found in bundle')
+        return group['pts'][()], group['polys'][()]
+
+    def get_xfm(self, name, xfmtype="coord"):
+        from .xfm import Transform
+        try:
+            group = self.h5["transforms/%s"%name]
+            xfm = group[xfmtype][()]
+        except KeyError:
+            raise IOError('Transform not found in bundle')
+        shape = tuple(int(s) for s in group.attrs['shape'])
+        return Transform(xfm, shape, affine=group.attrs['affine'][()])
+
+    def mask_index(self, xfmname):
+        """Mask index of the transform `xfmname`, in the format of
+        `Database._mask_index`."""
+        if xfmname not in self._masks:
+            index = dict()
+            for type in self.index['masks'].get(xfmname, []):
+                node = self.h5["transforms/%s/masks/%s"%(xfmname, type)]
+                index[type] = dict(nvox=int(node.attrs['nvox']),
+                                   digest=str(node.attrs['digest']),
+                                   shape=tuple(int(s) for s in node.attrs['shape']),
+                                   bits=node[()])
+            self._masks[xfmname] = index
+        return self._masks[xfmname]
+
+    def extract(self, prefix="", dirname=None):
+        """Write the bundled files (anatomicals, overlay, surface info and caches) into
+        `dirname`, by default the scratch directory. Only the file or directory
+        `prefix`, relative to the subject directory, is written; by default everything
+        is. Files that are already there are kept.
+        """
+        prefix = prefix.strip("/")
+        if dirname is None:
+            if prefix in self._extracted:
+                return self.scratch
+            dirname = self.scratch
+        for relpath, size in self.index['files'].items():
+            if prefix and relpath != prefix and not relpath.startswith(prefix + "/"):
+                continue
+            filename = os.path.join(dirname, *relpath.split("/"))
+            if os.path.exists(filename) and os.stat(filename).st_size == size:
+                continue
+            try:
+                os.makedirs(os.path.dirname(filename))
+            except OSError:
+                pass
+            with cache.atomic_write(filename) as fp:
+                fp.write(self.h5["files/%s"%relpath][()].tobytes())
+        if dirname == self.scratch:
+            self._extracted.add(prefix)
+        return dirname
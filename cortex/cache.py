@@ -0,0 +1,285 @@
+"""Safe writes of cache files that are shared between processes and machines.
+
+Cache files are written to a temporary file next to their destination and renamed into
+place, so that readers never see a partial file. A file that has to be built is built
+under an advisory lock on a ``.lock`` file beside it: when several processes miss the
+same cache entry at once, one of them builds it and the others wait and then read it.
+
+Typical use::
+
+    with cache.building(cachefile, recache) as build:
+        if build:
+            with cache.atomic_write(cachefile) as fp:
+                np.savez(fp, ...)
+    npz = np.load(cachefile)
+
+Directories registered with `manage` (the subject caches, see `Database.get_cache`) also
+keep a manifest of their artifacts, with the size, inputs and last access of each. When
+a new artifact pushes a directory over its size budget, the least recently used
+artifacts are evicted.
+"""
+import os
+import json
+import time
+import hashlib
+import tempfile
+import contextlib
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+def _suffix(filename):
+    """Full extension of `filename`, such as ".nii.gz", so that temporary files are
+    understood by writers that pick a format from the name."""
+    base = os.path.basename(filename)
+    return base[base.index('.', 1):] if '.' in base[1:] else ''
+
+@contextlib.contextmanager
+def atomic_path(filename):
+    """Yield a temporary path to write to, which is renamed to `filename` once the block
+    exits without an error, and removed otherwise."""
+    dirname, base = os.path.split(os.path.abspath(filename))
+    fd, tmpname = tempfile.mkstemp(dir=dirname, prefix="."+base+".", suffix=_suffix(base))
+    os.close(fd)
+    try:
+        yield tmpname
+        os.rename(tmpname, filename)
+    finally:
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+
+@contextlib.contextmanager
+def atomic_write(filename, mode="wb"):
+    """Open a temporary file for writing, which replaces `filename` once the block exits
+    without an error."""
+    with atomic_path(filename) as tmpname:
+        with open(tmpname, mode) as fp:
+            yield fp
+
+@contextlib.contextmanager
+def lock(filename):
+    """Hold an exclusive advisory lock for `filename`, on `filename` + ".lock". Locks go
+    through fcntl, so they also work between machines on NFS. Without fcntl (Windows),
+    this does nothing.
+
+    The lock file is removed when the lock is released. A process that was waiting on
+    a lock file that has since been removed locks the new one instead."""
+    if fcntl is None:
+        yield
+        return
+
+    lockname = filename + ".lock"
+    while True:
+        fp = open(lockname, "a")
+        fcntl.lockf(fp, fcntl.LOCK_EX)
+        try:
+            current = os.stat(lockname).st_ino == os.fstat(fp.fileno()).st_ino
+        except OSError:
+            current = False
+        if current:
+            break
+        fp.close()
+
+    try:
+        yield
+    finally:
+        # Remove the file before unlocking, so that waiters see that it is stale
+        try:
+            os.unlink(lockname)
+        except OSError:
+            pass
+        fcntl.lockf(fp, fcntl.LOCK_UN)
+        fp.close()
+
+def digest(*inputs):
+    """Hex digest that identifies `inputs`, for naming cache files by what they were
+    built from. Inputs can be arrays (hashed by dtype, shape and contents), strings,
+    bytes, numbers, None, and tuples, lists or dicts of these."""
+    h = hashlib.sha1()
+    _digest_update(h, inputs)
+    return h.hexdigest()
+
+def _digest_update(h, obj):
+    if isinstance(obj, np.generic):
+        # The repr of numpy scalars differs between numpy versions
+        obj = obj.item()
+    if isinstance(obj, np.ndarray):
+        h.update(("a%s%r" % (obj.dtype.str, obj.shape)).encode())
+        h.update(np.ascontiguousarray(obj).view(np.uint8).ravel())
+    elif isinstance(obj, dict):
+        h.update(("d%d" % len(obj)).encode())
+        for key in sorted(obj):
+            _digest_update(h, key)
+            _digest_update(h, obj[key])
+    elif isinstance(obj, (tuple, list)):
+        h.update(("l%d" % len(obj)).encode())
+        for item in obj:
+            _digest_update(h, item)
+    elif isinstance(obj, bytes):
+        h.update(("b%d:" % len(obj)).encode())
+        h.update(obj)
+    else:
+        text = repr(obj)
+        h.update(("s%d:" % len(text)).encode())
+        h.update(text.encode())
+
+# Managed cache directories, with their size budget in bytes (0 for no limit)
+_managed = dict()
+
+# Last access times are only written to the manifest once per this many seconds
+_touch_interval = 60.
+
+_manifest_name = "cache_manifest.json"
+
+# When this process last wrote the access time of each artifact, so that cache hits
+# between writes do not have to read the manifest
+_touched = dict()
+
+def parse_size(size):
+    """Parse a size such as "500M" or "20G" into bytes."""
+    size = str(size).strip().upper().rstrip("B")
+    units = dict(K=2**10, M=2**20, G=2**30, T=2**40)
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(float(size or 0))
+
+def manage(dirname, max_size=0):
+    """Keep a manifest of the artifacts in the cache directory `dirname`, and evict the
+    least recently used ones to keep it under `max_size` (bytes, or a string such as
+    "20G"; 0 for no limit)."""
+    _managed[os.path.abspath(dirname)] = parse_size(max_size)
+
+def _artifact_files(filename):
+    """The files that make up the artifact `filename`: it and any siblings that share
+    its base name, such as the .ctm and .svg files beside a ctm pack's .json."""
+    dirname, base = os.path.split(filename)
+    stem = os.path.splitext(base)[0]
+    try:
+        names = os.listdir(dirname)
+    except OSError:
+        return []
+    return [os.path.join(dirname, name) for name in names
+            if name == base or (os.path.splitext(name)[0] == stem and not name.startswith("."))]
+
+def _read_manifest(dirname):
+    try:
+        with open(os.path.join(dirname, _manifest_name)) as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return dict()
+
+@contextlib.contextmanager
+def _updating_manifest(dirname):
+    """Lock the manifest of `dirname` and yield it for changes, then save it."""
+    manifest_file = os.path.join(dirname, _manifest_name)
+    with lock(manifest_file):
+        manifest = _read_manifest(dirname)
+        yield manifest
+        with atomic_write(manifest_file, "w") as fp:
+            json.dump(manifest, fp, sort_keys=True, indent=4)
+
+def record(filename, inputs=None):
+    """Add the newly built artifact `filename` to the manifest of its managed cache
+    directory, with a description of its `inputs`, and evict least recently used
+    artifacts if the directory is over its budget. Does nothing outside managed
+    directories."""
+    dirname, name = os.path.split(os.path.abspath(filename))
+    if dirname not in _managed:
+        return
+    size = 0
+    for path in _artifact_files(os.path.join(dirname, name)):
+        try:
+            size += os.stat(path).st_size
+        except OSError:
+            pass
+    now = time.time()
+    with _updating_manifest(dirname) as manifest:
+        manifest[name] = dict(size=size, inputs=inputs, created=now, accessed=now)
+        _evict(dirname, manifest, _managed[dirname], keep=name)
+    _touched[os.path.join(dirname, name)] = now
+
+def touch(filename):
+    """Note that the artifact `filename` was used, for LRU eviction. Does nothing in
+    directories without a size budget, where nothing is ever evicted."""
+    dirname, name = os.path.split(os.path.abspath(filename))
+    if not _managed.get(dirname):
+        return
+    path = os.path.join(dirname, name)
+    now = time.time()
+    if now - _touched.get(path, -np.inf) < _touch_interval:
+        return
+    _touched[path] = now
+    with _updating_manifest(dirname) as manifest:
+        if name in manifest:
+            manifest[name]['accessed'] = now
+        elif os.path.exists(filename):
+            # Built before the directory was managed
+            manifest[name] = dict(size=sum(os.stat(f).st_size for f in _artifact_files(filename)),
+                                  inputs=None, created=now, accessed=now)
+
+def _evict(dirname, manifest, max_size, keep=None):
+    total = sum(entry['size'] for entry in manifest.values())
+    if max_size <= 0 or total <= max_size:
+        return
+    lru = sorted((entry['accessed'], name) for name, entry in manifest.items() if name != keep)
+    for _, name in lru:
+        if total <= max_size:
+            break
+        for path in _artifact_files(os.path.join(dirname, name)):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        total -= manifest.pop(name)['size']
+
+def evict(dirname, max_size=None):
+    """Evict least recently used artifacts from the cache directory `dirname` until it
+    fits in `max_size`, by default its configured budget."""
+    dirname = os.path.abspath(dirname)
+    if max_size is None:
+        max_size = _managed.get(dirname, 0)
+    with _updating_manifest(dirname) as manifest:
+        _evict(dirname, manifest, parse_size(max_size))
+
+def stats(dirname):
+    """Summarize the cache directory `dirname`.
+
+    Returns
+    -------
+    stats : dict
+        total size in bytes, the size budget (0 for none), and `artifacts`, a dict
+        from file name to its size, inputs, creation and last access times
+    """
+    dirname = os.path.abspath(dirname)
+    manifest = _read_manifest(dirname)
+    return dict(size=sum(entry['size'] for entry in manifest.values()),
+                max_size=_managed.get(dirname, 0),
+                artifacts=manifest)
+
+@contextlib.contextmanager
+def building(filename, recache=False, fresh=os.path.exists, inputs=None):
+    """Decide whether the caller has to build the cache file `filename`.
+
+    Yields False straight away if `fresh(filename)` says the file is usable. Otherwise
+    takes the lock for `filename` and yields True, holding the lock until the block
+    exits. A process that had to wait for the lock checks again, and yields False if
+    the file was built in the meantime. With `recache`, always builds.
+
+    In a managed cache directory, a built file is recorded in the manifest along with
+    `inputs`, and a file that is used is marked as recently accessed.
+    """
+    if not recache and fresh(filename):
+        yield False
+        touch(filename)
+        return
+
+    with lock(filename):
+        build = recache or not fresh(filename)
+        yield build
+    if build:
+        record(filename, inputs)
+    else:
+        touch(filename)
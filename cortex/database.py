@@ -8,22 +8,160 @@ This module creates a singleton object surfs_ which allows easy access to surfac
 """
 import os
 import re
-import copy
 import glob
 import json
 import shutil
+import struct
 import warnings
 import tempfile
 import functools
 import numpy as np
+from collections import OrderedDict
 from hashlib import sha1
 
+from . import cache
 from . import options
 
 default_filestore = options.config.get('basic', 'filestore')
 
 
+def _map_arrays(fn, obj):
+    """Apply `fn` to every array in `obj`, which may be nested tuples or lists of arrays."""
+    if isinstance(obj, np.ndarray):
+        return fn(obj)
+    if isinstance(obj, (tuple, list)):
+        return tuple(_map_arrays(fn, o) for o in obj)
+    return obj
+
+def _readonly(arr):
+    arr.flags.writeable = False
+    return arr
+
+# Number of decoded masks that are kept in memory
+_mask_cache_size = 8
+
+# Binary surface cache: a fixed-size header, then float32 points and int32 triangles.
+# The header records the size and mtime of the source file, to detect stale caches.
+_SURFCACHE_MAGIC = b"PYCXSRF1"
+_SURFCACHE_HEADER = struct.Struct("<8sQQdQ") # magic, npts, npolys, mtime, size
+_SURFCACHE_OFFSET = 64
+
+def _surfcache_layout(pts, polys):
+    """A surface in the dtypes and layout of the binary cache."""
+    return np.ascontiguousarray(pts, dtype=np.float32), np.ascontiguousarray(polys, dtype=np.int32)
+
+def _write_surfcache(path, source, pts, polys):
+    """Write a surface to the binary cache `path`, atomically."""
+    pts, polys = _surfcache_layout(pts, polys)
+    stat = os.stat(source)
+    header = _SURFCACHE_HEADER.pack(_SURFCACHE_MAGIC, len(pts), len(polys),
+                                    stat.st_mtime, stat.st_size)
+    with cache.atomic_write(path) as fp:
+        fp.write(header.ljust(_SURFCACHE_OFFSET, b"\0"))
+        fp.write(pts.tobytes())
+        fp.write(polys.tobytes())
+
+def _read_surfcache(path, source):
+    """Memory-map the surface in the binary cache `path`. Returns None if there is no
+    cache, or if it is older than `source`."""
+    try:
+        with open(path, "rb") as fp:
+            header = fp.read(_SURFCACHE_HEADER.size)
+        stat = os.stat(source)
+    except (IOError, OSError):
+        return None
+    if len(header) < _SURFCACHE_HEADER.size:
+        return None
+    magic, npts, npolys, mtime, size = _SURFCACHE_HEADER.unpack(header)
+    if magic != _SURFCACHE_MAGIC or mtime != stat.st_mtime or size != stat.st_size:
+        return None
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    ptsend = _SURFCACHE_OFFSET + npts * 3 * 4
+    pts = np.asarray(data[_SURFCACHE_OFFSET:ptsend]).view(np.float32).reshape(npts, 3)
+    polys = np.asarray(data[ptsend:ptsend + npolys * 3 * 4]).view(np.int32).reshape(npolys, 3)
+    return pts, polys
+
+def _mask_entry(fname):
+    """Decode the mask file `fname` into an entry of a mask index."""
+    import nibabel
+    mask = np.asarray(nibabel.load(fname).dataobj).T != 0
+    stat = os.stat(fname)
+    return dict(nvox=int(mask.sum()), digest=cache.digest(mask), shape=mask.shape,
+                bits=np.packbits(mask.ravel()), mtime=stat.st_mtime, size=stat.st_size)
+
+def _write_mask_index(path, index):
+    """Write a mask index to the npz file `path`, atomically. The packed bits of all the
+    masks are stored end to end, split by `offsets`."""
+    types = sorted(index)
+    entries = [index[t] for t in types]
+    offsets = np.cumsum([0] + [len(e['bits']) for e in entries])
+    with cache.atomic_write(path) as fp:
+        np.savez(fp, types=np.array(types, dtype=str),
+                 nvox=np.array([e['nvox'] for e in entries], dtype=np.int64),
+                 digests=np.array([e['digest'] for e in entries], dtype=str),
+                 shapes=np.array([e['shape'] for e in entries], dtype=np.int64).reshape(-1, 3),
+                 mtimes=np.array([e['mtime'] for e in entries], dtype=float),
+                 sizes=np.array([e['size'] for e in entries], dtype=np.int64),
+                 offsets=offsets,
+                 bits=np.hstack([e['bits'] for e in entries] + [np.zeros(0, dtype=np.uint8)]))
+
+def _read_mask_index(path):
+    """Read a mask index written by `_write_mask_index`, or an empty one if there is
+    none."""
+    try:
+        npz = np.load(path)
+        types, offsets, bits = npz['types'], npz['offsets'], npz['bits']
+        return dict((str(t), dict(nvox=int(npz['nvox'][i]), digest=str(npz['digests'][i]),
+                                  shape=tuple(int(s) for s in npz['shapes'][i]),
+                                  bits=bits[offsets[i]:offsets[i+1]],
+                                  mtime=float(npz['mtimes'][i]), size=int(npz['sizes'][i])))
+                    for i, t in enumerate(types))
+    except (IOError, OSError, ValueError, KeyError):
+        return dict()
+
+# Index of the files in each subject directory, as (directory mtimes, listing)
+_path_index = dict()
+
+def _dir_mtimes(subjdir):
+    mtimes = []
+    for dirname in ("surfaces", "views", "transforms"):
+        try:
+            mtimes.append(os.stat(os.path.join(subjdir, dirname)).st_mtime)
+        except OSError:
+            mtimes.append(None)
+    return mtimes
+
+def _list_subject(subjdir):
+    """List the surfaces, transforms and views of a subject directory."""
+    surfs = dict()
+    surfpath = os.path.join(subjdir, "surfaces")
+    for surf in os.listdir(surfpath):
+        ssurf = os.path.splitext(surf)[0].split('_')
+        name = '_'.join(ssurf[:-1])
+        hemi = ssurf[-1]
+
+        if name not in surfs:
+            surfs[name] = dict()
+        surfs[name][hemi] = surf
+
+    viewsdir = os.path.join(subjdir, "views")
+    if not os.path.exists(viewsdir):
+        os.makedirs(viewsdir)
+    views = sorted([os.path.splitext(f)[0] for f in os.listdir(viewsdir)])
+    xfms = sorted(os.listdir(os.path.join(subjdir, "transforms")))
+    return surfs, xfms, views
+
+def _read_manifest(subjdir):
+    try:
+        with open(os.path.join(subjdir, "manifest.json")) as fp:
+            manifest = json.load(fp)
+        return manifest['mtimes'], (manifest['surfs'], manifest['xfms'], manifest['views'])
+    except (IOError, ValueError, KeyError):
+        return None
+
 def _memo(fn):
+    """Cache the results of `fn`. Arrays in the results are made read-only, so the one
+    cached copy can be handed out on every call instead of a copy of it."""
     @functools.wraps(fn)
     def memofn(self, *args, **kwargs):
         if not hasattr(self, "_memocache"):
@@ -31,21 +169,25 @@ def _memo(fn):
         #h = sha1(str((id(fn), args, kwargs))).hexdigest()
         h = str((id(fn), args, kwargs))
         if h not in self._memocache:
-            self._memocache[h] = fn(self, *args, **kwargs)
-        return copy.deepcopy(self._memocache[h])
+            self._memocache[h] = _map_arrays(_readonly, fn(self, *args, **kwargs))
+        return self._memocache[h]
 
     return memofn
 
 class SubjectDB(object):
-    def __init__(self, subj, filestore=default_filestore):
+    """Handles to the surfaces and transforms of one subject. They are read through
+    `db`, the database that lists the subject, so that mounted subjects are served from
+    their bundle."""
+    def __init__(self, subj, filestore=default_filestore, db=None):
         self.subject = subj
         self._warning = None
         self._transforms = None
         self._surfaces = None
         self.filestore = filestore
+        self.db = db if db is not None else Database(filestore)
 
         try:
-            with open(os.path.join(filestore, subj, "warning.txt")) as fp:
+            with open(os.path.join(self.db._subjdir(subj), "warning.txt")) as fp:
                 self._warning = fp.read()
         except IOError:
             pass
@@ -54,23 +196,24 @@ class SubjectDB(object):
     def transforms(self):
         if self._transforms is not None:
             return self._transforms
-        self._transforms = XfmDB(self.subject, filestore=self.filestore)
+        self._transforms = XfmDB(self.subject, filestore=self.filestore, db=self.db)
         return self._transforms
 
     @property
     def surfaces(self):
         if self._surfaces is not None:
             return self._surfaces
-        self._surfaces = SurfaceDB(self.subject, filestore=self.filestore)
+        self._surfaces = SurfaceDB(self.subject, filestore=self.filestore, db=self.db)
         return self._surfaces
 
 class SurfaceDB(object):
-    def __init__(self, subj, filestore=default_filestore):
+    def __init__(self, subj, filestore=default_filestore, db=None):
         self.subject = subj
         self.types = {}
-        db = Database(filestore)
+        if db is None:
+            db = Database(filestore)
         for name in db.get_paths(subj)['surfs'].keys():
-            self.types[name] = Surf(subj, name, filestore=filestore)
+            self.types[name] = Surf(subj, name, filestore=filestore, db=db)
                 
     def __repr__(self):
         return "Surfaces: [{surfs}]".format(surfs=', '.join(list(self.types.keys())))
@@ -84,9 +227,9 @@ class SurfaceDB(object):
         raise AttributeError(attr)
 
 class Surf(object):
-    def __init__(self, subject, surftype, filestore=default_filestore):
+    def __init__(self, subject, surftype, filestore=default_filestore, db=None):
         self.subject, self.surftype = subject, surftype
-        self.db = Database(filestore)
+        self.db = db if db is not None else Database(filestore)
 
     def get(self, hemisphere="both"):
         return self.db.get_surf(self.subject, self.surftype, hemisphere)
@@ -97,50 +240,61 @@ class Surf(object):
         return mlab.triangular_mesh(pts[:,0], pts[:,1], pts[:,2], polys)
 
 class XfmDB(object):
-    def __init__(self, subj, filestore=default_filestore):
+    def __init__(self, subj, filestore=default_filestore, db=None):
         self.subject = subj
         self.filestore = filestore
-        self.xfms = Database(self.filestore).get_paths(subj)['xfms']
+        self.db = db if db is not None else Database(filestore)
+        self.xfms = self.db.get_paths(subj)['xfms']
 
     def __getitem__(self, name):
         if name in self.xfms:
-            return XfmSet(self.subject, name, filestore=self.filestore)
+            return XfmSet(self.subject, name, filestore=self.filestore, db=self.db)
         raise AttributeError
     
     def __repr__(self):
         return "Transforms: [{xfms}]".format(xfms=",".join(self.xfms))
 
 class XfmSet(object):
-    def __init__(self, subj, name, filestore=default_filestore):
+    def __init__(self, subj, name, filestore=default_filestore, db=None):
         self.subject = subj
         self.name = name
-        jspath = os.path.join(filestore, subj, 'transforms', name, 'matrices.xfm')
-        self._jsdat = json.load(open(jspath))
-        self.masks = MaskSet(subj, name, filestore=filestore)
-        self.db = Database(filestore)
+        self.db = db if db is not None else Database(filestore)
+        if subj in self.db._bundles:
+            self._types = ["coord", "magnet"]
+        else:
+            jspath = self.db.get_paths(subj)['xfmdir'].format(xfmname=name)
+            with open(jspath) as fp:
+                # The reference shape and affine are stored beside the matrices
+                self._types = [k for k in json.load(fp) if k not in ("shape", "affine")]
+        self.masks = MaskSet(subj, name, filestore=filestore, db=self.db)
     
     def __getattr__(self, attr):
-        if attr in self._jsdat:
+        if attr in self._types:
             return self.db.get_xfm(self.subject, self.name, attr)
         raise AttributeError
     
     def __repr__(self):
-        return "Types: {types}".format(types=", ".join(self._jsdat.keys()))
+        return "Types: {types}".format(types=", ".join(self._types))
 
 class MaskSet(object):
-    def __init__(self, subj, name, filestore=default_filestore):
+    def __init__(self, subj, name, filestore=default_filestore, db=None):
         self.subject = subj
         self.xfmname = name
-        maskform = Database(filestore).get_paths(subj)['masks']
-        maskpath = maskform.format(xfmname=name, type='*')
-        self._masks = dict((os.path.split(path)[1][5:-7], path) for path in glob.glob(maskpath))
+        self.db = db if db is not None else Database(filestore)
+        if subj in self.db._bundles:
+            self._masks = sorted(self.db._mask_index(subj, name))
+        else:
+            maskform = self.db.get_paths(subj)['masks']
+            maskpath = maskform.format(xfmname=name, type='*')
+            self._masks = sorted(os.path.split(path)[1][5:-7] for path in glob.glob(maskpath))
 
     def __getitem__(self, item):
-        import nibabel
-        return nibabel.load(self._masks[item]).get_data().T
+        if item not in self._masks:
+            raise KeyError(item)
+        return self.db.get_mask(self.subject, self.xfmname, item)
 
     def __repr__(self):
-        return "Masks: [{types}]".format(types=', '.join(self._masks.keys()))
+        return "Masks: [{types}]".format(types=', '.join(self._masks))
 
 class Database(object):
     """
@@ -156,6 +310,14 @@ class Database(object):
         self.filestore = filestore
         self._subjects = None
         self.auxfile = None
+        # Mask index of each (subject, xfmname), as (directory mtime, index)
+        self._mask_indices = dict()
+        # Most recently used decoded masks, by content digest, oldest first
+        self._masks = OrderedDict()
+        # Transforms by (subject, name, xfmtype), as (file mtimes, transform)
+        self._xfms = dict()
+        # Mounted subject bundles, by subject
+        self._bundles = dict()
     
     def __repr__(self):
         subjs = ", ".join(sorted(self.subjects.keys()))
@@ -171,7 +333,8 @@ class Database(object):
     
     def __dir__(self):
         return ["save_xfm","get_xfm", "get_surf", "get_anat", "get_surfinfo",
-                "get_mask", "get_overlay","get_cache", "get_view","save_view"] + list(self.subjects.keys())
+                "get_mask", "find_mask", "get_overlay","get_cache", "cache_stats", "get_view","save_view",
+                "mount", "unmount"] + list(self.subjects.keys())
 
     def loadXfm(self, *args, **kwargs):
         warnings.warn("loadXfm is deprecated, use save_xfm instead", Warning)
@@ -218,9 +381,56 @@ class Database(object):
         if self._subjects is not None:
             return self._subjects
         subjs = os.listdir(os.path.join(self.filestore))
-        self._subjects = dict([(sname, SubjectDB(sname, filestore=self.filestore)) for sname in subjs])
+        subjs.extend(self._bundles)
+        self._subjects = dict([(sname, SubjectDB(sname, filestore=self.filestore, db=self))
+                               for sname in subjs])
         return self._subjects
 
+    def mount(self, filename):
+        """Serve a subject from a bundle written by `cortex.bundle.pack`, in place of
+        its filestore directory. Bundled files that are needed on disk are extracted
+        into a scratch subject directory when they are first used. It also holds the
+        caches built while the subject is mounted.
+
+        Returns
+        -------
+        subject : str
+            Name of the mounted subject
+        """
+        from .bundle import Bundle
+        bundle = Bundle(filename)
+        subject = bundle.subject
+        self.unmount(subject)
+        self._bundles[subject] = bundle
+        return subject
+
+    def unmount(self, subject):
+        """Stop serving `subject` from its bundle."""
+        bundle = self._bundles.pop(subject, None)
+        if bundle is not None:
+            bundle.close()
+        # Anything cached for the subject may have come from the other source
+        self._subjects = None
+        self._memocache = dict()
+        self._masks.clear()
+        self._mask_indices = dict((k, v) for k, v in self._mask_indices.items() if k[0] != subject)
+        self._xfms = dict((k, v) for k, v in self._xfms.items() if k[0] != subject)
+
+    def _subjdir(self, subject):
+        """Directory of `subject`: its scratch directory if it is mounted from a bundle,
+        otherwise its directory in the filestore."""
+        if subject in self._bundles:
+            return self._bundles[subject].scratch
+        return os.path.join(self.filestore, subject)
+
+    def _extract(self, subject, path):
+        """Extract the file or directory `path` of a mounted subject from its bundle,
+        the first time it is needed. Does nothing for subjects in the filestore."""
+        if subject in self._bundles:
+            bundle = self._bundles[subject]
+            bundle.extract(os.path.relpath(path, bundle.scratch).replace(os.sep, "/"))
+        return path
+
     def get_anat(self, subject, type='raw', xfmname=None, recache=False, **kwargs):
         """Return anatomical information from the filestore. Anatomical information is defined as
         any volume-space anatomical information pertaining to the subject, such as T1 image,
@@ -244,7 +454,7 @@ class Database(object):
         if len(kwargs) > 0:
             opts = "[%s]"%','.join(["%s=%s"%i for i in kwargs.items()])
         anatform = self.get_paths(subject)['anats']
-        anatfile = anatform.format(type=type, opts=opts, ext="nii.gz")
+        anatfile = self._extract(subject, anatform.format(type=type, opts=opts, ext="nii.gz"))
 
         if not os.path.exists(anatfile) or recache:
             print("Generating %s anatomical..."%type)
@@ -286,23 +496,13 @@ class Database(object):
         npz : npzfile
             Otherwise, an npz object is returned. Remember to close it!
         """
-        opts = ""
-        if len(kwargs) > 0:
-            opts = "[%s]"%','.join(["%s=%s"%i for i in kwargs.items()])
-        try:
-            self.auxfile.get_surf(subject, "fiducial")
-            surfifile = os.path.join(self.get_cache(subject),"%s%s.npz"%(type, opts)) 
-        except (AttributeError, IOError):
-            surfiform = self.get_paths(subject)['surfinfo']
-            surfifile = surfiform.format(type=type, opts=opts)
-
-            if not os.path.exists(os.path.join(self.filestore, subject, "surface-info")):
-                os.makedirs(os.path.join(self.filestore, subject, "surface-info"))
-
-        if not os.path.exists(surfifile) or recache:
-            print ("Generating %s surface info..."%type)
-            from . import surfinfo
-            getattr(surfinfo, type)(surfifile, subject, **kwargs)
+        surfifile = self._surfinfo_file(subject, type, kwargs)
+        with cache.building(surfifile, recache) as build:
+            if build:
+                print ("Generating %s surface info..."%type)
+                from . import surfinfo
+                with cache.atomic_path(surfifile) as tmpname:
+                    getattr(surfinfo, type)(tmpname, subject, **kwargs)
 
         npz = np.load(surfifile)
         if "left" in npz and "right" in npz:
@@ -312,6 +512,21 @@ class Database(object):
             return Vertex(verts, subject)
         return npz
 
+    def _surfinfo_file(self, subject, type, kwargs):
+        """Path of the npz file that holds surface info `type`, generated with the
+        options in the dict `kwargs`."""
+        opts = ""
+        if len(kwargs) > 0:
+            opts = "[%s]"%','.join(["%s=%s"%i for i in kwargs.items()])
+        try:
+            self.auxfile.get_surf(subject, "fiducial")
+            return os.path.join(self.get_cache(subject),"%s%s.npz"%(type, opts))
+        except (AttributeError, IOError):
+            surfiform = self.get_paths(subject)['surfinfo']
+            if not os.path.exists(os.path.join(self._subjdir(subject), "surface-info")):
+                os.makedirs(os.path.join(self._subjdir(subject), "surface-info"))
+            return self._extract(subject, surfiform.format(type=type, opts=opts))
+
     def get_overlay(self, subject, otype='rois', **kwargs):
         from . import svgroi
         pts, polys = self.get_surf(subject, "flat", merge=True, nudge=True)
@@ -398,12 +613,17 @@ class Database(object):
         elif xfmtype == "coord":
             jsdict['coord'] = xfm.tolist()
             jsdict['magnet'] = np.dot(nib.get_affine(), xfm).tolist()
+        jsdict['shape'] = list(nib.shape[:3][::-1])
+        jsdict['affine'] = nib.get_affine().tolist()
         
         files = self.get_paths(subject)
         if len(glob.glob(files['masks'].format(xfmname=name, type="*"))) > 0:
             raise ValueError('Refusing to change a transform with masks')
             
-        json.dump(jsdict, open(fname, "w"), sort_keys=True, indent=4)
+        with cache.atomic_write(fname, "w") as fp:
+            json.dump(jsdict, fp, sort_keys=True, indent=4)
+        for xtype in ("coord", "magnet"):
+            self._xfms.pop((subject, name, xtype), None)
     
     def get_xfm(self, subject, name, xfmtype="coord"):
         """Retrieves a transform from the filestore
@@ -416,6 +636,11 @@ class Database(object):
             Name of the transform
         xfmtype : str, optional
             Type of transform to return. Defaults to coord.
+
+        Transforms are cached, and read again when their files change. The shape and
+        affine of the reference image are stored with the transform, so the reference
+        is only loaded when its image data is used. Cached transforms are shared, so
+        their matrices are read-only.
         """
         from .xfm import Transform
         if xfmtype == 'coord':
@@ -425,16 +650,39 @@ class Database(object):
                 pass
 
         if name == "identity":
+            # Bundles carry the anatomicals, so this also works for mounted subjects
             nib = self.get_anat(subject, 'raw')
-            return Transform(np.linalg.inv(nib.get_affine()), nib)
+            return Transform(np.linalg.inv(nib.affine), nib)
+
+        if subject in self._bundles:
+            return self._bundles[subject].get_xfm(name, xfmtype)
 
         fname = os.path.join(self.filestore, subject, "transforms", name, "matrices.xfm")
         reference = os.path.join(self.filestore, subject, "transforms", name, "reference.nii.gz")
+        mtimes = []
+        for path in (fname, reference):
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        key = subject, name, xfmtype
+        if key in self._xfms and self._xfms[key][0] == mtimes:
+            return self._xfms[key][1]
+
         xfmdict = json.load(open(fname))
-        return Transform(xfmdict[xfmtype], reference)
+        if 'shape' in xfmdict and 'affine' in xfmdict:
+            shape, affine = xfmdict['shape'], np.array(xfmdict['affine'])
+        else:
+            # Transforms saved before the reference metadata was stored
+            import nibabel
+            nib = nibabel.load(reference)
+            shape, affine = nib.shape[:3][::-1], nib.affine
+        xfm = Transform(_readonly(np.array(xfmdict[xfmtype])), reference,
+                        shape=shape, affine=_readonly(affine))
+        self._xfms[key] = mtimes, xfm
+        return xfm
 
-    @_memo
-    def get_surf(self, subject, type, hemisphere="both", merge=False, nudge=False):
+    def get_surf(self, subject, type, hemisphere="both", merge=False, nudge=False, copy=False):
         '''Return the surface pair for the given subject, surface type, and hemisphere.
 
         Parameters
@@ -451,6 +699,9 @@ class Database(object):
         nudge : bool
             Nudge the hemispheres apart from each other, for overlapping surfaces
             (inflated, etc)
+        copy : bool
+            Return writeable copies of the arrays. By default, every call returns
+            the same read-only arrays, which are loaded once and then cached.
 
         Returns
         -------
@@ -459,6 +710,36 @@ class Database(object):
         pts, polys, norms : ((p,3) array, (f,3) array, (p,3) array or None)
             For single hemisphere
         '''
+        stamp = self._surf_stamp(subject, type, hemisphere)
+        surf = self._get_surf(subject, type, hemisphere, merge, nudge, stamp)
+        if copy:
+            return _map_arrays(np.array, surf)
+        return surf
+
+    def _surf_stamp(self, subject, type, hemisphere="both"):
+        """Modification times and sizes of the files that a surface is read from. They
+        are part of the key of the cached surfaces and their digests, so that surfaces
+        are read again when their files are replaced."""
+        if subject in self._bundles:
+            return None
+        try:
+            files = self.get_paths(subject)['surfs']
+        except (IOError, OSError, KeyError):
+            return None
+        types = ['wm', 'pia'] if type == 'fiducial' and type not in files else [type]
+        hemis = ['lh', 'rh'] if hemisphere.lower() == 'both' else [hemisphere.lower()[0]+'h']
+        stamp = []
+        for name in types:
+            for hemi in hemis:
+                try:
+                    stat = os.stat(files[name][hemi])
+                    stamp.append((stat.st_mtime, stat.st_size))
+                except (KeyError, OSError):
+                    stamp.append(None)
+        return tuple(stamp)
+
+    @_memo
+    def _get_surf(self, subject, type, hemisphere, merge, nudge, stamp):
         try:
             return self.auxfile.get_surf(subject, type, hemisphere, merge=merge, nudge=nudge)
         except (AttributeError, IOError):
@@ -467,10 +748,13 @@ class Database(object):
         files = self.get_paths(subject)['surfs']
 
         if hemisphere.lower() == "both":
-            left, right = [ self.get_surf(subject, type, hemisphere=h) for h in ["lh", "rh"]]
+            left, right = [ self.get_surf(subject, type, h) for h in ["lh", "rh"]]
             if type != "fiducial" and nudge:
-                left[0][:,0] -= left[0].max(0)[0]
-                right[0][:,0] -= right[0].min(0)[0]
+                # The cached hemispheres are read-only, so nudge copies of them
+                lpts, rpts = left[0].copy(), right[0].copy()
+                lpts[:,0] -= lpts.max(0)[0]
+                rpts[:,0] -= rpts.min(0)[0]
+                left, right = (lpts,) + left[1:], (rpts,) + right[1:]
             
             if merge:
                 pts   = np.vstack([left[0], right[0]])
@@ -490,12 +774,33 @@ class Database(object):
             ppts, _     = self.get_surf(subject, 'pia', hemi)
             return (wpts + ppts) / 2, polys
 
+        if subject in self._bundles:
+            return self._bundles[subject].get_surf(type, hemi)
+
         try:
-            from . import formats
-            return formats.read(os.path.splitext(files[type][hemi])[0])
+            source = files[type][hemi]
         except KeyError:
             raise IOError
 
+        # Parsed surfaces are kept in a binary cache, which later processes can map
+        # directly instead of parsing the source again
+        cachefile = os.path.join(self.get_cache(subject), "surf_%s_%s.bin"%(type, hemi))
+        surf = _read_surfcache(cachefile, source)
+        if surf is None:
+            from . import formats
+            # Without a cache, still hand out the arrays the cache would have, so the
+            # surface and its digest do not depend on whether the cache is writable
+            pts, polys = _surfcache_layout(*formats.read(os.path.splitext(source)[0])[:2])
+            try:
+                _write_surfcache(cachefile, source, pts, polys)
+            except (IOError, OSError):
+                return pts, polys
+            cache.record(cachefile, inputs=source)
+            surf = _read_surfcache(cachefile, source)
+        else:
+            cache.touch(cachefile)
+        return surf
+
     def save_mask(self, subject, xfmname, type, mask):
         fname = self.get_paths(subject)['masks'].format(xfmname=xfmname, type=type)
         if os.path.exists(fname):
@@ -505,27 +810,106 @@ class Database(object):
         xfm = self.get_xfm(subject, xfmname)
         if xfm.shape != mask.shape:
             raise ValueError("Invalid mask shape: must match shape of reference image")
-        affine = xfm.reference.get_affine()
+        affine = xfm.affine
         nib = nibabel.Nifti1Image(mask.astype(np.uint8).T, affine)
-        nib.to_filename(fname)
+        with cache.atomic_path(fname) as tmpname:
+            nib.to_filename(tmpname)
+        self._mask_indices.pop((subject, xfmname), None)
 
     def get_mask(self, subject, xfmname, type='thick'):
+        """Return the boolean mask `type` of the transform `xfmname`, generating it if it
+        does not exist. Masks are decoded from the mask index, and the returned array is
+        shared between calls, so it is read-only."""
         try:
             self.auxfile.get_mask(subject, xfmname, type)
         except (AttributeError, IOError):
             pass
 
-        fname = self.get_paths(subject)['masks'].format(xfmname=xfmname, type=type)
+        entry = self._mask_index(subject, xfmname).get(type)
+        if entry is None and subject in self._bundles:
+            raise IOError('Mask not found in bundle')
+        if entry is None:
+            fname = self.get_paths(subject)['masks'].format(xfmname=xfmname, type=type)
+            with cache.building(fname) as build:
+                if build:
+                    print('Mask not found, generating...')
+                    from .utils import get_cortical_mask
+                    mask = get_cortical_mask(subject, xfmname, type)
+                    self.save_mask(subject, xfmname, type, mask)
+            self._mask_indices.pop((subject, xfmname), None)
+            entry = self._mask_index(subject, xfmname)[type]
+        return self._unpack_mask(entry)
+
+    def find_mask(self, subject, xfmname, nvox):
+        """Find the mask of the transform `xfmname` that selects `nvox` voxels, such as
+        the mask that linear volume data was taken with.
+
+        Returns
+        -------
+        type : str
+            Name of the mask
+        mask : ndarray of bool
+            The mask, read-only
+        """
+        index = self._mask_index(subject, xfmname)
+        for type in sorted(index):
+            if index[type]['nvox'] == nvox:
+                return type, self._unpack_mask(index[type])
+        raise ValueError('Cannot find a valid mask')
+
+    def _mask_index(self, subject, xfmname):
+        """Index of the masks of the transform `xfmname`, from mask type to its voxel
+        count, a digest of its contents, its shape and its voxels packed into bits.
+
+        The index is kept in memory and in the subject cache. It is checked against the
+        transform directory's mtime, and only mask files whose mtime or size changed are
+        decoded again."""
+        if subject in self._bundles:
+            return self._bundles[subject].mask_index(xfmname)
+
+        pattern = self.get_paths(subject)['masks'].format(xfmname=xfmname, type="*")
         try:
-            import nibabel
-            nib = nibabel.load(fname)
-            return nib.get_data().T != 0
-        except IOError:
-            print('Mask not found, generating...')
-            from .utils import get_cortical_mask
-            mask = get_cortical_mask(subject, xfmname, type)
-            self.save_mask(subject, xfmname, type, mask)
-            return mask
+            dirmtime = os.stat(os.path.dirname(pattern)).st_mtime
+        except OSError:
+            return dict()
+        key = subject, xfmname
+        if key in self._mask_indices and self._mask_indices[key][0] == dirmtime:
+            return self._mask_indices[key][1]
+
+        cachefile = os.path.join(self.get_cache(subject), "masks_%s.npz" % xfmname)
+        cached = _read_mask_index(cachefile)
+        index, changed = dict(), False
+        namere = re.compile(r'mask_([\w]+).nii.gz')
+        for fname in glob.glob(pattern):
+            type = namere.search(os.path.split(fname)[1]).group(1)
+            entry = cached.get(type)
+            stat = os.stat(fname)
+            if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+                entry = _mask_entry(fname)
+                changed = True
+            index[type] = entry
+
+        if changed or set(index) != set(cached):
+            with cache.lock(cachefile):
+                _write_mask_index(cachefile, index)
+            cache.record(cachefile, inputs=dict(xfmname=xfmname, masks=sorted(index)))
+        else:
+            cache.touch(cachefile)
+        self._mask_indices[key] = dirmtime, index
+        return index
+
+    def _unpack_mask(self, entry):
+        """Decode the packed bits of a mask index entry. The last few distinct masks
+        are kept decoded."""
+        mask = self._masks.pop(entry['digest'], None)
+        if mask is None:
+            shape = entry['shape']
+            bits = np.unpackbits(entry['bits'])[:int(np.prod(shape))]
+            mask = _readonly(bits.reshape(shape).astype(bool))
+        self._masks[entry['digest']] = mask
+        while len(self._masks) > _mask_cache_size:
+            self._masks.popitem(last=False)
+        return mask
 
     def get_coords(self, subject, xfmname, hemisphere="both", magnet=None):
         """Calculate the coordinates of each vertex in the epi space by transforming the fiducial to the coordinate space
@@ -566,48 +950,127 @@ class Database(object):
             hashname = "pycx_%s"%hashlib.md5(self.auxfile.h5.filename).hexdigest()[-8:]
             cachedir = os.path.join(tempfile.gettempdir(), hashname, subject)
         except (AttributeError, IOError):
-            cachedir = os.path.join(self.filestore, subject, "cache")
+            cachedir = self._extract(subject, os.path.join(self._subjdir(subject), "cache"))
             
         if not os.path.exists(cachedir):
             os.makedirs(cachedir)
+        cache.manage(cachedir, options.config.get("basic", "cache_size"))
         return cachedir
 
-    def get_paths(self, subject):
-        """Get a dictionary with a list of all candidate filenames for associated data, such as roi overlays, flatmap caches, and ctm caches.
-        """
-        surfpath = os.path.join(self.filestore, subject, "surfaces")
+    def _input_digest(self, subject, surfaces=(), xfmname=None, files=(), **params):
+        """Digest of everything a derived artifact is built from, for content-addressed
+        cache file names: the arrays of the named `surfaces`, the matrix and reference
+        shape of the transform `xfmname`, the contents of `files` and any other
+        parameters. Missing surfaces and files are part of the digest too."""
+        inputs = [self._surf_digest(subject, type) for type in surfaces]
+        if xfmname is not None:
+            xfm = self.get_xfm(subject, xfmname)
+            inputs.append(cache.digest(np.asarray(xfm.xfm), tuple(xfm.shape)))
+        inputs.extend(self._file_digest(filename) for filename in files)
+        return cache.digest(inputs, params)
+
+    def _surf_digest(self, subject, type):
+        """Digest of the arrays of a surface, only computed again when its files
+        change."""
+        return self._hash_surf(subject, type, self._surf_stamp(subject, type))
+
+    @_memo
+    def _hash_surf(self, subject, type, stamp):
+        try:
+            return cache.digest(self.get_surf(subject, type))
+        except IOError:
+            return None
 
-        if self.subjects[subject]._warning is not None:
-            warnings.warn(self.subjects[subject]._warning)
+    def _file_digest(self, filename):
+        """Digest of the contents of `filename`, only read again when its size or mtime
+        changes."""
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        return self._hash_file(filename, stat.st_mtime, stat.st_size)
 
-        surfs = dict()
-        for surf in os.listdir(surfpath):
-            ssurf = os.path.splitext(surf)[0].split('_')
-            name = '_'.join(ssurf[:-1])
-            hemi = ssurf[-1]
+    @_memo
+    def _hash_file(self, filename, mtime, size):
+        with open(filename, "rb") as fp:
+            return cache.digest(fp.read())
 
-            if name not in surfs:
-                surfs[name] = dict()
-            surfs[name][hemi] = os.path.abspath(os.path.join(surfpath,surf))
+    def cache_stats(self, subject=None):
+        """Size and contents of the subject caches. Artifacts are recorded when they are
+        built, with their size, inputs and last access; when a cache grows past the
+        `cache_size` option in the [basic] section, the least recently used artifacts are
+        evicted. Without a `cache_size`, access times are not updated after the build.
 
-        viewsdir = os.path.join(self.filestore, subject, "views")
-        if not os.path.exists(viewsdir):
-            os.makedirs(viewsdir)
-        views = os.listdir(viewsdir)
+        Parameters
+        ----------
+        subject : str, optional
+            Subject to report on. Defaults to every subject.
+
+        Returns
+        -------
+        stats : dict
+            For one subject, a dict with the total `size` (bytes), the `max_size` budget
+            (0 for no limit) and the `artifacts` in the cache. Otherwise a dict of these
+            for every subject.
+        """
+        if subject is None:
+            return dict((subj, self.cache_stats(subj)) for subj in self.subjects)
+        return cache.stats(self.get_cache(subject))
+
+    def get_paths(self, subject):
+        """Get a dictionary with a list of all candidate filenames for associated data, such as roi overlays, flatmap caches, and ctm caches.
+
+        The contents of the surfaces, views and transforms directories are indexed once
+        per process and reused until one of the directories changes. The index is
+        seeded from the subject's manifest, if `write_manifest` made one.
+        """
+        subjdir = self._subjdir(subject)
+        if subject in self._bundles:
+            # Mounted subjects are listed by the bundle index, with surfaces named as
+            # they would be in the filestore
+            index = self._bundles[subject].index
+            surfs = dict((name, dict((hemi, "%s_%s.gii"%(name, hemi)) for hemi in hemis))
+                         for name, hemis in index['surfs'].items())
+            xfms, views = index['xfms'], []
+        else:
+            mtimes = _dir_mtimes(subjdir)
+            index = _path_index.get(subjdir)
+            if index is None:
+                index = _read_manifest(subjdir)
+            if index is None or index[0] != mtimes:
+                if self.subjects[subject]._warning is not None:
+                    warnings.warn(self.subjects[subject]._warning)
+                listing = _list_subject(subjdir)
+                index = _dir_mtimes(subjdir), listing
+            _path_index[subjdir] = index
+            surfs, xfms, views = index[1]
 
         filenames = dict(
-            surfs=surfs,
-            xfms=sorted(os.listdir(os.path.join(self.filestore, subject, "transforms"))),
-            xfmdir=os.path.join(self.filestore, subject, "transforms", "{xfmname}", "matrices.xfm"),
-            anats=os.path.join(self.filestore, subject, "anatomicals", '{type}{opts}.{ext}'), 
-            surfinfo=os.path.join(self.filestore, subject, "surface-info", '{type}{opts}.npz'),
-            masks=os.path.join(self.filestore, subject, 'transforms', '{xfmname}', 'mask_{type}.nii.gz'),
-            rois=os.path.join(self.filestore, subject, "rois.svg").format(subj=subject),
-            views=sorted([os.path.splitext(f)[0] for f in views]),
+            surfs=dict((name, dict((hemi, os.path.join(subjdir, "surfaces", fname))
+                                   for hemi, fname in hemis.items()))
+                       for name, hemis in surfs.items()),
+            xfms=list(xfms),
+            xfmdir=os.path.join(subjdir, "transforms", "{xfmname}", "matrices.xfm"),
+            anats=os.path.join(subjdir, "anatomicals", '{type}{opts}.{ext}'), 
+            surfinfo=os.path.join(subjdir, "surface-info", '{type}{opts}.npz'),
+            masks=os.path.join(subjdir, 'transforms', '{xfmname}', 'mask_{type}.nii.gz'),
+            rois=self._extract(subject, os.path.join(subjdir, "rois.svg").format(subj=subject)),
+            views=list(views),
         )
 
         return filenames
 
+    def write_manifest(self, subject):
+        """Write the index of the subject's files to manifest.json in the subject
+        directory, so that new processes can resolve paths without listing directories.
+        """
+        subjdir = os.path.join(self.filestore, subject)
+        self.get_paths(subject)
+        mtimes, listing = _path_index[subjdir]
+        with cache.atomic_write(os.path.join(subjdir, "manifest.json"), "w") as fp:
+            json.dump(dict(mtimes=mtimes, surfs=listing[0], xfms=listing[1], views=listing[2]),
+                      fp, sort_keys=True, indent=4)
+
     def make_subj(self, subject):
         if os.path.exists(os.path.join(self.filestore, subject)):
             if raw_input("Are you sure you want to overwrite this existing subject? Type YES\n") == "YES":
@@ -716,18 +1179,19 @@ class Database(object):
 
         # Check cache first
         mnixfmfile = os.path.join(self.get_cache(subject), "mni_xfm-%s-%s.txt"%(xfm, templatehash))
-        if os.path.exists(mnixfmfile):
-            mnixfm = np.loadtxt(mnixfmfile)
-        else:
-            # Run the transform
-            if template is None:
-                mnixfm = mni.compute_mni_transform(subject, xfm)
-            else:
-                mnixfm = mni.compute_mni_transform(subject, xfm, template)
-
-            # Cache the result
-            mni._save_fsl_xfm(mnixfmfile, mnixfm)
-
-        return mnixfm
+        with cache.building(mnixfmfile) as build:
+            if build:
+                # Run the transform
+                if template is None:
+                    mnixfm = mni.compute_mni_transform(subject, xfm)
+                else:
+                    mnixfm = mni.compute_mni_transform(subject, xfm, template)
+
+                # Cache the result
+                with cache.atomic_path(mnixfmfile) as tmpname:
+                    mni._save_fsl_xfm(tmpname, mnixfm)
+                return mnixfm
+
+        return np.loadtxt(mnixfmfile)
 
 db = Database()
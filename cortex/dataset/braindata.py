@@ -237,7 +237,7 @@ class VolumeData(BrainData):
         copied from the reference nifti file.
         """
         xfm = db.get_xfm(self.subject, self.xfmname)
-        affine = xfm.reference.get_affine()
+        affine = xfm.affine
         import nibabel
         new_nii = nibabel.Nifti1Image(self.volume.T, affine)
         nibabel.save(new_nii, filename)
@@ -366,20 +366,7 @@ class VertexData(BrainData):
             return self.data[self.llen:]
 
 def _find_mask(nvox, subject, xfmname):
-    import os
-    import re
-    import glob
-    import nibabel
-    files = db.get_paths(subject)['masks'].format(xfmname=xfmname, type="*")
-    for fname in glob.glob(files):
-        nib = nibabel.load(fname)
-        mask = nib.get_data().T != 0
-        if nvox == np.sum(mask):
-            fname = os.path.split(fname)[1]
-            name = re.compile(r'mask_([\w]+).nii.gz').search(fname)
-            return name.group(1), mask
-
-    raise ValueError('Cannot find a valid mask')
+    return db.find_mask(subject, xfmname, nvox)
 
 
 class _masker(object):
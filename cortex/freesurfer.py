@@ -319,67 +319,76 @@ def write_decimated(path, pts, polys):
         fp.write(struct.pack('>i', len(dpts)))
         fp.write(data.tostring())
 
-import copy
 class SpringLayout(object):
-    def __init__(self, pts, polys, dpts=None, pins=None, stepsize=1, neighborhood=0):
-        self.pts = pts
+    def __init__(self, pts, polys, dpts=None, pins=None, stepsize=1, neighborhood=0,
+                 dtype=np.float64):
+        """Relax a surface towards the edge lengths of a reference surface, by treating
+        every edge as a spring.
+
+        Parameters
+        ----------
+        pts : 2D ndarray, shape (total_verts, 3)
+            Starting vertex positions
+        polys : 2D ndarray, shape (total_polys, 3)
+            Triangles of the surface
+        dpts : 2D ndarray, optional
+            Reference vertex positions that give the spring rest lengths. Defaults
+            to `pts`.
+        pins : array-like, optional
+            Vertices that stay in place
+        stepsize : float, optional
+            Fraction of the spring force applied per step
+        neighborhood : int, optional
+            Also connect springs to more distant vertices. Each increment doubles the
+            number of edges a spring can span.
+        dtype : numpy dtype, optional
+            Precision of the positions; float32 halves memory and speeds up steps.
+        """
+        from scipy import sparse
+        self.pts = np.array(pts, dtype=dtype)
         self.polys = polys
         self.stepsize = stepsize
-        pinmask = np.zeros((len(pts),), dtype=bool)
+        npt = len(pts)
+        pinmask = np.zeros((npt,), dtype=bool)
         if isinstance(pins, (list, set, np.ndarray)):
-            pinmask[pins] = True
+            pinmask[list(pins) if isinstance(pins, set) else pins] = True
         self.pins = pinmask
-        self.neighbors = [set() for _ in range(len(pts))]
-
-        for i, j, k in polys:
-            self.neighbors[i].add(j)
-            self.neighbors[i].add(k)
-            self.neighbors[j].add(i)
-            self.neighbors[j].add(k)
-            self.neighbors[k].add(i)
-            self.neighbors[k].add(j)
 
+        polys = np.asarray(polys)
+        adj = sparse.coo_matrix((np.ones((3*len(polys),), dtype=bool),
+            (polys.ravel(), polys[:,[1, 2, 0]].ravel())), (npt, npt)).tocsr()
+        adj = adj + adj.T
         for _ in range(neighborhood):
-            _neighbors = copy.deepcopy(self.neighbors)
-            for v, neighbors in enumerate(self.neighbors):
-                for n in neighbors:
-                    _neighbors[v] |= self.neighbors[n]
-            self.neighbors = _neighbors
-
-        for i in range(len(self.neighbors)):
-            self.neighbors[i] = list(self.neighbors[i] - set([i]))
+            adj = adj + adj.dot(adj)
+        # Drop the self loops from the COO entries; setting the diagonal of a CSR
+        # matrix would change its sparsity structure
+        adj.eliminate_zeros()
+        adj = adj.tocoo()
+        keep = adj.row != adj.col
+        self._idx, self._neigh = adj.row[keep], adj.col[keep]
 
         if dpts is None:
             dpts = pts
-
-        #self.kdt = cKDTree(self.pts)
-        self._next = self.pts.copy()
-
-        width = max(len(n) for n in self.neighbors)
-        self._mask = np.zeros((len(pts), width), dtype=bool)
-        self._move = np.zeros((len(pts), width, 3))
-        #self._mean = np.zeros((len(pts), width))
-        self._num = np.zeros((len(pts),))
-        self._dists = []
-        self._idx = []
-        for i, n in enumerate(self.neighbors):
-            self._mask[i, :len(n)] = True
-            self._dists.append(np.sqrt(((dpts[n] - dpts[i])**2).sum(-1)))
-            self._idx.append(np.ones((len(n),))*i)
-            self._num[i] = len(n)
-        self._dists = np.hstack(self._dists)
-        self._idx = np.hstack(self._idx).astype(np.uint)
-        self._neigh = np.hstack(self.neighbors).astype(np.uint)
+        self._dists = np.sqrt(((dpts[self._neigh] - dpts[self._idx])**2).sum(-1)).astype(dtype)
+        self._num = np.bincount(self._idx, minlength=npt)
+
+        # Every spring as the difference of its two ends, and the average over the
+        # springs of each vertex, as sparse operators
+        nedge = len(self._idx)
+        self._diff = sparse.coo_matrix((np.hstack([np.ones(nedge), -np.ones(nedge)]).astype(dtype),
+            (np.tile(np.arange(nedge), 2), np.hstack([self._neigh, self._idx]))),
+            (nedge, npt)).tocsr()
+        with np.errstate(divide='ignore'):
+            weight = (1. / self._num[self._idx]).astype(dtype)
+        self._avg = sparse.coo_matrix((weight, (self._idx, np.arange(nedge))),
+            (npt, nedge)).tocsr()
         self.figure = None
 
     def _spring(self):
-        svec = self.pts[self._neigh] - self.pts[self._idx]
+        svec = self._diff.dot(self.pts)
         slen = np.sqrt((svec**2).sum(-1))
-        force = (slen - self._dists) # / self._dists
-        svec /= slen[:,np.newaxis]
-        fvec = force[:, np.newaxis] * svec
-        self._move[self._mask] = self.stepsize * fvec
-        return self._move.sum(1) / self._num[:, np.newaxis]
+        force = self.stepsize * (slen - self._dists) / slen
+        return self._avg.dot(force[:,np.newaxis] * svec)
 
     def _estatic(self, idx):
         dist, neighbors = self.kdt.query(self.pts[idx], k=20)
@@ -390,15 +399,18 @@ class SpringLayout(object):
 
     def step(self):
         move = self._spring()[~self.pins]
-        self._next[~self.pins] += move #+ self._estatic(i)
-        self.pts = self._next.copy()
+        self.pts[~self.pins] += move #+ self._estatic(i)
         return dict(x=self.pts[:,0],y=self.pts[:, 1], z=self.pts[:,2]), move
-        #self.kdt = cKDTree(self.pts)
 
-    def run(self, n=1000):
-        for _ in range(n):
-            self.step()
-            print(_)
+    def run(self, n=1000, tol=None):
+        """Take up to `n` steps, stopping early once no vertex moves more than `tol`.
+        Returns the number of steps taken.
+        """
+        for i in range(n):
+            _, move = self.step()
+            if tol is not None and (move.size == 0 or (move**2).sum(1).max() < tol**2):
+                return i + 1
+        return n
 
     def view_step(self):
         from mayavi import mlab
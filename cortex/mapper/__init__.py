@@ -6,6 +6,7 @@ import numpy as np
 from scipy import sparse
 warnings.simplefilter('ignore', sparse.SparseEfficiencyWarning)
 
+from .. import cache
 from .. import dataset
 
 def get_mapper(subject, xfmname, type='nearest', recache=False, **kwargs):
@@ -28,32 +29,42 @@ def get_mapper(subject, xfmname, type='nearest', recache=False, **kwargs):
     if len(kwds) > 0:
         ptype += '_'+kwds
 
-    fname = "{xfmname}_{projection}.npz".format(xfmname=xfmname, projection=ptype)
-
-    xfmfile = db.get_paths(subject)['xfmdir'].format(xfmname=xfmname)
+    # The cache is named by the surfaces, transform and options the mapper is made
+    # from, so any change to them makes a new one
+    digest = db._input_digest(subject, Map.surfaces, xfmname, mapper=type, options=kwargs)
+    fname = "{xfmname}_{projection}_{digest}.npz".format(xfmname=xfmname, projection=ptype,
+                                                         digest=digest[:16])
     cachefile = os.path.join(db.get_cache(subject), fname)
 
+    inputs = dict(subject=subject, xfmname=xfmname, type=type, digest=digest)
+    with cache.building(cachefile, recache, inputs=inputs) as build:
+        if build:
+            return Map._cache(cachefile, subject, xfmname, **kwargs)
     try:
-        if not recache and (xfmname == "identity" or os.stat(cachefile).st_mtime > os.stat(xfmfile).st_mtime):
-           return mapcls[type].from_cache(cachefile)
-        raise Exception
-    except Exception as e:
-        return mapcls[type]._cache(cachefile, subject, xfmname, **kwargs)
+        return Map.from_cache(cachefile)
+    except Exception:
+        # Unreadable cache, left by an interrupted write before writes were atomic
+        with cache.lock(cachefile):
+            return Map._cache(cachefile, subject, xfmname, **kwargs)
 
 def _savecache(filename, left, right, shape):
-    np.savez(filename,
-            left_data=left.data,
-            left_indices=left.indices,
-            left_indptr=left.indptr,
-            left_shape=left.shape,
-            right_data=right.data,
-            right_indices=right.indices,
-            right_indptr=right.indptr,
-            right_shape=right.shape,
-            shape=shape)
+    with cache.atomic_write(filename) as fp:
+        np.savez(fp,
+                left_data=left.data,
+                left_indices=left.indices,
+                left_indptr=left.indptr,
+                left_shape=left.shape,
+                right_data=right.data,
+                right_indices=right.indices,
+                right_indptr=right.indptr,
+                right_shape=right.shape,
+                shape=shape)
 
 class Mapper(object):
     '''Maps data from epi volume onto surface using various projections'''
+    # Surfaces that the mapper is built from
+    surfaces = ("fiducial", "flat")
+
     def __init__(self, left, right, shape):
         self.idxmap = None
         self.masks = [left, right]
@@ -5,6 +5,8 @@ from . import Mapper, _savecache
 from . import samplers
 
 class LineMapper(Mapper):
+    surfaces = ("pia", "wm")
+
     @classmethod
     def _cache(cls, filename, subject, xfmname, **kwargs):
         from .. import db
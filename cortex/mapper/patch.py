@@ -7,46 +7,38 @@ from .. import polyutils
 
 class PatchMapper(Mapper):
     @classmethod
-    def _getmask(cls, pts, polys, shape, npts=64, mp=True, **kwargs):
+    def _getmask(cls, pts, polys, shape, npts=64, mp=True, chunksize=8192, **kwargs):
         rand = np.random.rand(2, npts)
-
-        def func(ipts):
-            idx, pts = ipts
-            if pts is not None:
-                A = np.outer(1-np.sqrt(rand[0]), pts[:,0].ravel())
-                B = np.outer(np.sqrt(rand[0]) * (1-rand[1]), pts[:,1].ravel())
-                C = np.outer(rand[1] * np.sqrt(rand[0]), pts[:,2].ravel())
-                randpts = (A+B+C).reshape(-1, pts.shape[0], pts.shape[2])
-                areas = polyutils.face_area(pts)
-                areas /= areas.sum()
-
-                allj, alldata = [], []
-                for tri, area in zip(randpts.swapaxes(0,1), areas):
-                    i, j, data = cls.sampler(tri, shape, renorm=False, mp=False, **kwargs)
-                    alldata.append(data / data.sum() * area)
-                    allj.append(j)
-
-                #print idx
-                return samplers.collapse(np.hstack(allj), np.hstack(alldata))
-            return None, None
+        # Barycentric weights of the random sample points, shared by all triangles
+        bary = np.array([1-np.sqrt(rand[0]),
+                         np.sqrt(rand[0]) * (1-rand[1]),
+                         rand[1] * np.sqrt(rand[0])])
 
         surf = polyutils.Surface(pts, polys)
-        patches = surf.patches(n=cls.patchsize)
+        offsets, tris = surf.batch_patches(n=cls.patchsize)
+        owner = np.repeat(np.arange(len(pts)), np.diff(offsets))
+        # Weight each triangle by its share of the patch area
+        areas = polyutils.face_area(tris)
+        areas /= np.bincount(owner, areas, minlength=len(pts))[owner]
+
+        def func(start):
+            chunk = slice(start, start+chunksize)
+            randpts = np.einsum('pk,tpc->tkc', bary, tris[chunk]).reshape(-1, 3)
+            i, j, data = cls.sampler(randpts, shape, renorm=False, mp=False, **kwargs)
+            tri = i // npts
+            total = np.bincount(tri, data, minlength=len(areas[chunk]))
+            return owner[chunk][tri], j, data / total[tri] * areas[chunk][tri]
+
+        starts = range(0, len(tris), chunksize)
         if mp:
             from .. import mp
-            samples = mp.map(func, enumerate(patches))
+            samples = mp.map(func, starts)
         else:
-            samples = map(func, enumerate(patches))
-
-        ij, alldata = [], []
-        for i, (j, data) in enumerate(samples):
-            if data is not None:
-                ij.append(np.vstack(np.broadcast_arrays(i, j)).T)
-                alldata.append(data)
+            samples = map(func, starts)
 
-        data, ij = np.hstack(alldata), np.vstack(ij).T
+        i, j, data = [np.hstack(s) for s in zip(*samples)]
         csrshape = len(pts), np.prod(shape)
-        return sparse.csr_matrix((data, ij), shape=csrshape)
+        return sparse.csr_matrix((data, (i, j)), shape=csrshape)
 
 class ConstPatch(PatchMapper):
     patchsize = 1
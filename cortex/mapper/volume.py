@@ -5,6 +5,8 @@ from . import Mapper
 from . import samplers
 
 class VolumeMapper(Mapper):
+    surfaces = ("pia", "wm")
+
     @classmethod
     def _cache(cls, filename, subject, xfmname, **kwargs):
         from .. import db
@@ -962,7 +962,7 @@ def get_aligner(subject, xfmname, epifile=None, xfm=None, xfmtype="magnet", deci
     dbxfm = None
     try:
         dbxfm = db.get_xfm(subject, xfmname, xfmtype='magnet')
-        epifile = dbxfm.reference.get_filename()
+        epifile = dbxfm.reference_file
         dbxfm = dbxfm.xfm
     except IOError:
         pass
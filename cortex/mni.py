@@ -111,10 +111,10 @@ def transform_to_mni(volumedata, func_to_mni,
         from . import xfm
         func_xfm = db.get_xfm(volumedata.subject, volumedata.xfmname)
         #xfm = cortex.db.get_mnixfm("AHfs", "AHfs_auto1")
-        affine = func_xfm.reference.get_affine()
+        affine = func_xfm.affine
         volumedata_nii = nibabel.Nifti1Image(volumedata.volume.T.squeeze(), affine)
         nof_xfm = xfm.Transform.from_fsl(func_to_mni, 
-                                         func_xfm.reference.get_filename(), 
+                                         func_xfm.reference_file, 
                                          template)
         resampled = resample(volumedata_nii, 
                              nof_xfm.xfm, 
@@ -197,7 +197,7 @@ def transform_mni_to_subject(subject, xfm, volarray, func_to_mni,
     _save_fsl_xfm(mni_to_func_xfm, np.linalg.inv(func_to_mni))
 
     # Use flirt to resample data to functional space
-    ref_filename = db.get_xfm(subject, xfm).reference.get_filename()
+    ref_filename = db.get_xfm(subject, xfm).reference_file
     
     subprocess.call(["{fslprefix}flirt".format(fslprefix=fslprefix),
                      "-in", mnispace_func_nii,
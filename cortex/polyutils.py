@@ -4,6 +4,7 @@ from scipy.spatial import distance, Delaunay
 from scipy import sparse
 import scipy.sparse.linalg
 import functools
+import hashlib
 import numexpr as ne
 
 def _memo(fn):
@@ -19,6 +20,23 @@ def _memo(fn):
 
     return memofn
 
+def _factorize(A):
+    """Factorize the sparse symmetric positive definite matrix `A`, returning a function
+    that solves A x = b for 1D or 2D `b`. Uses CHOLMOD from scikit-sparse if it is
+    installed, and otherwise falls back to the sparse LU decomposition in scipy.
+    """
+    try:
+        from sksparse.cholmod import cholesky
+    except ImportError:
+        try:
+            from scikits.sparse.cholmod import cholesky
+        except ImportError:
+            cholesky = None
+
+    if cholesky is not None:
+        return cholesky(sparse.csc_matrix(A)).solve_A
+    return sparse.linalg.splu(sparse.csc_matrix(A), permc_spec="MMD_AT_PLUS_A").solve
+
 class Surface(object):
     """Represents a single cortical hemisphere surface. Can be the white matter surface,
     pial surface, fiducial (mid-cortical) surface, inflated surface, flattened surface,
@@ -26,22 +44,55 @@ class Surface(object):
 
     Implements some useful functions for dealing with functions across surfaces.
     """
-    def __init__(self, pts, polys):
+    def __init__(self, pts, polys, compact=False):
         """Initialize Surface.
 
+        Arrays that already have the right dtype are used in place rather than copied,
+        so a Surface can be built over memmapped or shared memory buffers (see `save`
+        and `load`) and parallel workers share one copy of the mesh.
+
         Parameters
         ----------
         pts : 2D ndarray, shape (total_verts, 3)
             Location of each vertex in space (mm). Order is x, y, z.
         polys : 2D ndarray, shape (total_polys, 3)
             Indices of the vertices in each triangle in the surface.
+        compact : bool, optional
+            If True, store points as float32 and polys as int32, which roughly halves
+            the memory used by the surface and by its cached properties.
         """
-        self.pts = pts.astype(np.double)
-        self.polys = polys
+        self.compact = compact
+        if compact:
+            self.pts = np.asarray(pts, dtype=np.float32)
+            self.polys = np.asarray(polys, dtype=np.int32)
+        else:
+            self.pts = np.asarray(pts, dtype=np.double)
+            self.polys = np.asarray(polys)
 
         self._cache = dict()
         self._rlfac_solvers = dict()
         self._nLC_solvers = dict()
+        self._bh_solvers = dict()
+        self._smooth_solvers = dict()
+        self._eigenbasis = None
+
+    def save(self, prefix):
+        """Save the points and polys of this surface to `prefix`.pts.npy and
+        `prefix`.polys.npy, in their current dtypes, so that they can be memory
+        mapped by `load`.
+        """
+        np.save(prefix + ".pts.npy", self.pts)
+        np.save(prefix + ".polys.npy", self.polys)
+
+    @classmethod
+    def load(cls, prefix, mmap_mode='r', compact=False):
+        """Load a surface saved by `save`. By default the arrays are memory mapped
+        read-only, so every process that loads the same files shares their pages.
+        Saving a compact surface keeps `compact=True` loads from copying.
+        """
+        pts = np.load(prefix + ".pts.npy", mmap_mode=mmap_mode)
+        polys = np.load(prefix + ".polys.npy", mmap_mode=mmap_mode)
+        return cls(pts, polys, compact=compact)
 
     @property
     @_memo
@@ -98,7 +149,8 @@ class Surface(object):
         # Average adjacent face normals
         nnvnorms = np.nan_to_num(self.connected.dot(self.face_normals) / self.connected.sum(1)).A
         # Normalize to norm 1
-        return nnvnorms / np.sqrt((nnvnorms**2).sum(1))[:,np.newaxis]
+        nnvnorms /= np.sqrt((nnvnorms**2).sum(1))[:,np.newaxis]
+        return nnvnorms.astype(self.pts.dtype, copy=False)
 
     @property
     @_memo
@@ -222,10 +274,13 @@ class Surface(object):
             return scalars
         
         B,D,W,V = self.laplace_operator
-        npt = len(D)
-        lfac = sparse.dia_matrix((D,[0]), (npt,npt)) - factor * (W-V)
-        goodrows = np.nonzero(~np.array(lfac.sum(0) == 0).ravel())[0]
-        lfac_solver = sparse.linalg.dsolve.factorized(lfac[goodrows][:,goodrows])
+        if factor not in self._smooth_solvers:
+            npt = len(D)
+            lfac = sparse.dia_matrix((D,[0]), (npt,npt)) - factor * (W-V)
+            goodrows = np.nonzero(~np.array(lfac.sum(0) == 0).ravel())[0]
+            self._smooth_solvers[factor] = (goodrows,
+                sparse.linalg.dsolve.factorized(lfac[goodrows][:,goodrows]))
+        goodrows, lfac_solver = self._smooth_solvers[factor]
         to_smooth = scalars.copy()
         for _ in range(iterations):
             from_smooth = lfac_solver((D * to_smooth)[goodrows])
@@ -234,6 +289,119 @@ class Surface(object):
         smscalars[goodrows] = from_smooth
         return smscalars
         
+    def laplace_eigenbasis(self, k=100, cachefile=None):
+        """Lowest `k` eigenpairs of the Laplace-Beltrami operator, solving the
+        generalized problem (V-W) phi = lambda D phi. Eigenvectors are orthonormal
+        under the lumped mass matrix D, so phi.T D phi = I.
+
+        The basis is kept on this object, and optionally saved to and loaded from
+        `cachefile`, so it only has to be computed once per surface.
+
+        Parameters
+        ----------
+        k : int, optional
+            Number of eigenpairs, starting from the constant mode.
+        cachefile : str, optional
+            Path to an npz file holding a previously computed basis. If it is missing,
+            holds fewer than `k` modes or was computed for a different mesh, the basis
+            is computed and written there.
+
+        Returns
+        -------
+        evals : 1D ndarray, shape (k,)
+            Eigenvalues in increasing order (1/mm^2)
+        evecs : 2D ndarray, shape (total_verts, k)
+            Eigenvectors, zero at vertices without faces
+        """
+        npt = len(self.pts)
+        if self._eigenbasis is None or self._eigenbasis[0].shape[0] < k:
+            basis = None
+            if cachefile is not None:
+                from . import cache
+                # The cache is only valid for exactly this mesh
+                digest = cache.digest(self.pts, self.polys)
+                try:
+                    npz = np.load(cachefile)
+                    if ('digest' in npz and str(npz['digest']) == digest
+                            and len(npz['evals']) >= k):
+                        basis = npz['evals'], npz['evecs']
+                    npz.close()
+                except IOError:
+                    pass
+
+            if basis is None:
+                B, D, W, V = self.laplace_operator
+                goodrows = np.nonzero(D > 0)[0]
+                A = (V - W).tocsr()[goodrows][:,goodrows]
+                M = sparse.dia_matrix((D[goodrows], [0]), (len(goodrows), len(goodrows)))
+                # Shift-invert just below zero, since the operator is singular
+                evals, gevecs = sparse.linalg.eigsh(A.tocsc(), k=k, M=M.tocsc(),
+                                                    sigma=-1e-6, which='LM')
+                order = np.argsort(evals)
+                evecs = np.zeros((npt, k))
+                evecs[goodrows] = gevecs[:,order]
+                basis = np.clip(evals[order], 0, None), evecs
+                if cachefile is not None:
+                    with cache.atomic_write(cachefile) as fp:
+                        np.savez(fp, evals=basis[0], evecs=basis[1], digest=digest)
+
+            self._eigenbasis = basis
+
+        evals, evecs = self._eigenbasis
+        return evals[:k], evecs[:,:k]
+
+    def spectral_filter(self, scalars, response, k=100, cachefile=None):
+        """Filter vertex-wise functions in the Laplace-Beltrami eigenbasis. Each
+        function is projected onto the first `k` modes, every mode is scaled by
+        `response`, and the result is projected back. Many functions (e.g. the
+        frames of a movie) are filtered at once by passing a 2D `scalars`.
+
+        Parameters
+        ----------
+        scalars : ndarray, shape (total_verts,) or (total_verts, n)
+            Functions to filter
+        response : function or 1D ndarray, shape (k,)
+            Gain of each mode, either given directly or as a function of the eigenvalues
+        k : int, optional
+            Number of modes to use. Detail finer than the last mode is discarded.
+        cachefile : str, optional
+            Passed on to `laplace_eigenbasis`
+
+        Returns
+        -------
+        filtered : ndarray, same shape as `scalars`
+        """
+        evals, evecs = self.laplace_eigenbasis(k, cachefile=cachefile)
+        if callable(response):
+            response = response(evals)
+        coefs = self.spectral_coefficients(scalars, k, cachefile=cachefile)
+        coefs = coefs * np.reshape(response, (-1,) + (1,) * (coefs.ndim - 1))
+        return evecs.dot(coefs)
+
+    def spectral_coefficients(self, scalars, k=100, cachefile=None):
+        """Coefficients of vertex-wise functions in the first `k` Laplace-Beltrami modes,
+        shape (k,) or (k, n). This is a compressed representation of smooth maps;
+        `evecs.dot(coefs)` restores them.
+        """
+        B, D, W, V = self.laplace_operator
+        evals, evecs = self.laplace_eigenbasis(k, cachefile=cachefile)
+        return evecs.T.dot(D.reshape((-1,) + (1,) * (np.ndim(scalars) - 1)) * scalars)
+
+    def heat_smooth(self, scalars, t, k=100, cachefile=None):
+        """Smooth vertex-wise functions with the heat kernel, which damps each mode by
+        exp(-t * lambda). The kernel is roughly gaussian with a standard deviation of
+        sqrt(2 * t) mm. See `spectral_filter` for the parameters.
+        """
+        return self.spectral_filter(scalars, lambda evals: np.exp(-t * evals), k=k,
+                                    cachefile=cachefile)
+
+    def bandpass(self, scalars, low=0, high=np.inf, k=100, cachefile=None):
+        """Keep only the modes with eigenvalues in [`low`, `high`), in 1/mm^2. See
+        `spectral_filter` for the other parameters.
+        """
+        return self.spectral_filter(scalars, lambda evals: (evals >= low) & (evals < high),
+                                    k=k, cachefile=cachefile)
+
     @property
     @_memo
     def avg_edge_length(self):
@@ -244,45 +412,81 @@ class Surface(object):
         edgelens = np.sqrt(((self.pts[tadj.row] - self.pts[tadj.col])**2).sum(1))
         return edgelens.mean()
 
+    @property
+    @_memo
+    def gradient_operator(self):
+        """Sparse face gradient operator, shape (3 * total_polys, total_verts). Applied
+        to vertex values it gives the x, y and z gradient of every face, stacked by
+        coordinate: all x components first, then all y, then all z.
+        """
+        npt, npoly = len(self.pts), len(self.polys)
+        fe12, fe23, fe31 = self._facenorm_cross_edge
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = np.nan_to_num(1 / (2 * self.face_areas))[:,np.newaxis]
+        # Each face edge weights the vertex opposite to it
+        data = np.hstack([(fe * scale).T.ravel() for fe in (fe12, fe23, fe31)])
+        rows = np.tile(np.arange(3 * npoly), 3)
+        cols = np.hstack([np.tile(self.polys[:,i], 3) for i in (2, 0, 1)])
+        return sparse.coo_matrix((data, (rows, cols)), (3 * npoly, npt)).tocsr()
+
+    @property
+    @_memo
+    def averaging_operator(self):
+        """Sparse operator of shape (total_verts, total_polys) that averages face values
+        over the faces around each vertex.
+        """
+        nfaces = np.asarray(self.connected.sum(1)).ravel()
+        with np.errstate(divide='ignore'):
+            inv = np.nan_to_num(1. / nfaces)
+        npt = len(self.pts)
+        return (sparse.dia_matrix((inv, [0]), (npt, npt)) * self.connected).tocsr()
+
+    @property
+    @_memo
+    def divergence_operator(self):
+        """Sparse integrated divergence operator, shape (total_verts, 3 * total_polys).
+        Applied to a face vector field stacked like the output of `gradient_operator`,
+        it gives the integrated divergence of the field at every vertex.
+        """
+        npt, npoly = len(self.pts), len(self.polys)
+        data = np.hstack([(0.5 * c).T.ravel() for c in self._cot_edge])
+        rows = np.hstack([np.tile(self.polys[:,i], 3) for i in range(3)])
+        cols = np.tile(np.arange(3 * npoly), 3)
+        return sparse.coo_matrix((data, (rows, cols)), (npt, 3 * npoly)).tocsr()
+
     def surface_gradient(self, scalars, at_verts=True):
         """Gradient of a function with values `scalars` at each vertex on the surface.
         If `at_verts`, returns values at each vertex. Otherwise, returns values at each
-        face.
+        face. Many functions can be differentiated at once by passing a 2D `scalars`.
 
         Parameters
         ----------
-        scalars : 1D ndarray, shape (total_verts,)
-            A scalar-valued function across the cortex.
+        scalars : 1D ndarray, shape (total_verts,) or 2D ndarray, shape (total_verts, k)
+            A scalar-valued function across the cortex, or k such functions.
         at_verts : bool, optional
             If True (default), values will be returned for each vertex. Otherwise,
             values will be retruned for each face.
 
         Returns
         -------
-        gradu : 2D ndarray, shape (total_verts,3) or (total_polys,3)
+        gradu : ndarray, shape (total_verts, 3) or (total_polys, 3), plus (k,) for 2D input
             Contains the x-, y-, and z-axis gradients of the given `scalars` at either
             each vertex (if `at_verts` is True) or each face.
         """
-        pu = scalars[self.polys]
-        fe12, fe23, fe31 = [f.T for f in self._facenorm_cross_edge]
-        pu1, pu2, pu3 = pu.T
-        fa = self.face_areas
-
-        # numexpr is much faster than doing this using numpy!
-        #gradu = ((fe12.T * pu[:,2] +
-        #          fe23.T * pu[:,0] +
-        #          fe31.T * pu[:,1]) / (2 * self.face_areas)).T
-        gradu = np.nan_to_num(ne.evaluate("(fe12 * pu3 + fe23 * pu1 + fe31 * pu2) / (2 * fa)").T)
-        
+        npoly = len(self.polys)
+        gradu = self.gradient_operator.dot(scalars).reshape((3, npoly) + scalars.shape[1:])
+        gradu = np.moveaxis(gradu, 0, 1)
+
         if at_verts:
-            return (self.connected.dot(gradu).T / self.connected.sum(1).A.squeeze()).T
+            avg = self.averaging_operator.dot(gradu.reshape(npoly, -1))
+            return avg.reshape((len(self.pts),) + gradu.shape[1:])
         return gradu
 
     def _create_biharmonic_solver(self, boundary_verts, clip_D=0.1):
         """Set up biharmonic equation with Dirichlet boundary conditions on the cortical
-        mesh and precompute Cholesky factorization for solving it. The vertices listed in
+        mesh and precompute a factorization for solving it. The vertices listed in
         `boundary_verts` are considered part of the boundary, and will not be included in
-        the factorization.
+        the factorization. Solvers are cached by the set of boundary vertices.
 
         To facilitate Cholesky decomposition (which requires a symmetric matrix), the
         squared Laplace-Beltrami operator is separated into left-hand-side (L2) and
@@ -309,30 +513,32 @@ class Surface(object):
             Right side of biharmonic problem, D
         Dinv : sparse matrix, dia
             Inverse mass matrix, D^{-1}
-        lhsfac : cholesky Factor object
-            Factorized left side, solves biharmonic problem
+        lhsfac : function
+            Factorized left side, solves biharmonic problem for one or many
+            right-hand sides. See `_factorize`.
         notboundary : ndarray, int
             Indices of non-boundary vertices
         """
-        try:
-            from sksparse.sparse.cholmod import cholesky
-        except ImportError:
-            from scikits.sparse.cholmod import cholesky
+        boundary_verts = np.unique(boundary_verts)
+        key = hashlib.sha1(boundary_verts.astype(np.int64).tobytes()).hexdigest(), clip_D
+        if key in self._bh_solvers:
+            return self._bh_solvers[key]
+
         B, D, W, V = self.laplace_operator
         npt = len(D)
 
         g = np.nonzero(D > 0)[0] # Find vertices with non-zero mass
-        #g = np.nonzero((L.sum(0) != 0).A.ravel())[0] # Find vertices with non-zero mass
         notboundary = np.setdiff1d(np.arange(npt)[g], boundary_verts) # find non-boundary verts
         D = np.clip(D, clip_D, D.max())
 
         Dinv = sparse.dia_matrix((D**-1,[0]), (npt,npt)).tocsr() # construct Dinv
         L = Dinv.dot((V-W)) # construct Laplace-Beltrami operator
         
-        lhs = (V-W).dot(L) # construct left side, almost squared L-B operator
-        lhsfac = cholesky(lhs[notboundary][:,notboundary]) # factorize
-        
-        return lhs, D, Dinv, lhsfac, notboundary
+        lhs = (V-W).dot(L).tocsr() # construct left side, almost squared L-B operator
+        lhsfac = _factorize(lhs[notboundary][:,notboundary]) # factorize
+
+        self._bh_solvers[key] = lhs, D, Dinv, lhsfac, notboundary
+        return self._bh_solvers[key]
 
     def _create_interp(self, verts, bhsolver=None):
         """Creates interpolator that will interpolate values at the given `verts` using
@@ -359,22 +565,15 @@ class Surface(object):
             lhs, D, Dinv, lhsfac, notb = bhsolver
         
         npt = len(D)
+        verts = np.asarray(verts)
+        # Knot values only enter the right side through these columns
+        knotcols = lhs[notb][:,verts]
         def _interp(vals):
             """Interpolate function with values `vals` at the knot points."""
             v2 = np.atleast_2d(vals)
-            nd,nv = v2.shape
-            ij = np.zeros((2,nv*nd))
-            ij[0] = np.array(verts)[np.repeat(np.arange(nv), nd)]
-            ij[1] = np.tile(np.arange(nd), nv)
-            
-            r = sparse.csr_matrix((vals.T.ravel(), ij), shape=(npt,nd))
-            vr = lhs.dot(r)
-            
-            #phi = lhsfac.solve_A(-vr.todense()[notb]) # 29.9ms
-            phi = lhsfac.solve_A(-vr[notb].todense()) # 28.2ms
-            # phi = lhsfac.solve_A(-vr[notb]).todense() # 29.3ms
+            phi = lhsfac(-knotcols.dot(v2.T))
             
-            tphi = np.zeros((npt,nd))
+            tphi = np.zeros((npt,len(v2)))
             tphi[notb] = phi
             tphi[verts] = v2.T
             
@@ -387,10 +586,9 @@ class Surface(object):
         `vals` can be a D x N array to interpolate multiple functions with the same
         knot points.
 
-        Using this function directly is unnecessarily expensive if you want to interpolate
-        many different values between the same knot points. Instead, you should directly
-        create an interpolator function using _create_interp, and then call that function.
-        In fact, that's exactly what this function does.
+        The factorization for each set of knot points is cached, so interpolating
+        many different values between the same knot points only pays for it once.
+        Passing all of the values at once as a D x N array is faster still.
 
         See _create_biharmonic_solver for math details.
 
@@ -513,14 +711,7 @@ class Surface(object):
         X = np.nan_to_num(ne.evaluate("-graduT / sqrt(gusum)").T)
 
         # Compute integrated divergence of X at each vertex
-        #x1 = x2 = x3 = np.zeros((X.shape[0],))
-        c32, c13, c21 = self._cot_edge
-        x1 = 0.5 * (c32 * X).sum(1)
-        x2 = 0.5 * (c13 * X).sum(1)
-        x3 = 0.5 * (c21 * X).sum(1)
-        
-        conn1, conn2, conn3 = self._polyconn
-        divx = conn1.dot(x1) + conn2.dot(x2) + conn3.dot(x3)
+        divx = self.divergence_operator.dot(X.T.ravel())
 
         # Compute phi (distance)
         goodphi = self._nLC_solvers[m](divx[self._goodrows])
@@ -532,6 +723,161 @@ class Surface(object):
 
         return phi
 
+    def geodesic_neighborhoods(self, radius, cachefile=None, chunksize=None):
+        """Geodesic neighborhood of radius `radius` (mm) around every vertex, for
+        searchlight analyses.
+
+        Distances are found by front propagation from a chunk of source vertices at a
+        time. Each round relaxes the vertices whose distance changed in the previous
+        round, both along mesh edges and across faces with the planar triangle update
+        used by fast marching, and stops at `radius`. The result is much closer to the
+        true geodesic distance than shortest paths along edges alone.
+
+        Parameters
+        ----------
+        radius : float
+            Neighborhood radius (mm)
+        cachefile : str, optional
+            Path to an npz file holding previously computed neighborhoods of the same
+            radius on the same mesh. If it is missing or was computed for another radius
+            or mesh, the neighborhoods are computed and written there.
+        chunksize : int, optional
+            Number of source vertices propagated together. Memory use grows with
+            chunksize * total_verts; by default this is kept to about 128MB.
+
+        Returns
+        -------
+        neighborhoods : Neighborhoods
+            Vertices within `radius` of each vertex, with their distances
+        """
+        npt = len(self.pts)
+        if cachefile is not None:
+            from . import cache
+            # The cache is only valid for exactly this mesh
+            digest = cache.digest(self.pts, self.polys)
+            try:
+                npz = np.load(cachefile)
+                valid = ('digest' in npz and str(npz['digest']) == digest
+                         and float(npz['radius']) == radius)
+                npz.close()
+                if valid:
+                    return Neighborhoods.from_cache(cachefile)
+            except IOError:
+                pass
+
+        if chunksize is None:
+            chunksize = int(np.clip(2**24 // npt, 1, npt))
+        # Distances from every source in a chunk, reset after each chunk
+        flat = np.full((chunksize * npt,), np.inf)
+
+        indptr = np.zeros((npt + 1,), dtype=np.int64)
+        indices, dists = [], []
+        for start in range(0, npt, chunksize):
+            sources = np.arange(start, min(start + chunksize, npt))
+            # Keys index the flattened (source, vertex) distances
+            keys = self._propagate(np.arange(len(sources)) * npt + sources, radius, flat)
+            indptr[sources + 1] = np.bincount(keys // npt, minlength=len(sources))
+            indices.append(keys % npt)
+            dists.append(flat[keys])
+            flat[keys] = np.inf
+
+        hoods = Neighborhoods(np.cumsum(indptr), np.hstack(indices), np.hstack(dists))
+        if cachefile is not None:
+            hoods.save(cachefile, radius=radius, digest=digest)
+        return hoods
+
+    def geodesic_within(self, verts, radius, buffer=None):
+        """Vertices within geodesic distance `radius` (mm) of any vertex in `verts`,
+        found with the same front propagation as `geodesic_neighborhoods`.
+
+        Parameters
+        ----------
+        verts : array_like
+            Source vertices
+        radius : float
+            Largest distance to propagate to
+        buffer : 1D ndarray, optional
+            Float buffer with one infinite entry per vertex, for repeated calls. Only
+            the entries that were reached are touched, and they are set back to
+            infinity before returning, so the buffer can be passed to the next call.
+            Without it, a new buffer is allocated, which takes time proportional to
+            the size of the surface; with it, the work done only grows with the area
+            that is reached.
+
+        Returns
+        -------
+        idx : 1D ndarray
+            Sorted indices of the vertices that were reached
+        dist : 1D ndarray
+            Distance of each of them to the closest vertex in `verts`
+        """
+        if buffer is None:
+            buffer = np.full((len(self.pts),), np.inf)
+        idx = self._propagate(np.unique(verts), radius, buffer)
+        dist = buffer[idx]
+        buffer[idx] = np.inf
+        return idx, dist
+
+    @property
+    @_memo
+    def _edge_lengths(self):
+        adj = self.adj.tocsr()
+        adjrows = np.repeat(np.arange(len(self.pts)), np.diff(adj.indptr))
+        return adj, np.sqrt(((self.pts[adjrows] - self.pts[adj.indices])**2).sum(1))
+
+    def _propagate(self, seeds, radius, flat):
+        """Propagate distance fronts out to `radius` from the `seeds`, which are keys
+        into `flat`, a buffer of distances from each of several sources (key
+        source * total_verts + vertex) that is infinite where nothing was reached yet.
+        Fills in `flat` and returns the sorted keys that were reached.
+        """
+        npt = len(self.pts)
+        adj, edgelen = self._edge_lengths
+        offsets, faces, vfpolys = self._vertex_faces
+
+        pending = seeds
+        flat[pending] = 0
+        reached = [pending]
+
+        # Relax the pending vertices in narrow bands of distance, nearest first, so
+        # that few of them are relaxed more than once
+        band = 0
+        while len(pending) > 0:
+            pdist = flat[pending]
+            band = max(band, pdist.min()) + self.avg_edge_length / 4.
+            front, pending = pending[pdist <= band], pending[pdist > band]
+            src, vert = front // npt, front % npt
+            fdist = flat[front]
+
+            # Relax along edges
+            idx, pos = _ragged_ranges(adj.indptr[vert], adj.indptr[vert+1])
+            ckeys = [src[idx] * npt + adj.indices[pos]]
+            cdist = [fdist[idx] + edgelen[pos]]
+
+            # Relax across faces, from the front vertex and each reached neighbor
+            idx, pos = _ragged_ranges(offsets[vert], offsets[vert+1])
+            for b, c in [(1, 2), (2, 1)]:
+                bdist = flat[src[idx] * npt + vfpolys[pos, b]]
+                known = np.isfinite(bdist)
+                a = vert[idx[known]]
+                pb, pc = vfpolys[pos[known], b], vfpolys[pos[known], c]
+                ckeys.append(src[idx[known]] * npt + pc)
+                cdist.append(_triangle_update(self.pts[a], self.pts[pb], self.pts[pc],
+                                              fdist[idx[known]], bdist[known]))
+
+            ckeys, cdist = np.hstack(ckeys), np.hstack(cdist)
+            valid = cdist <= radius
+            ckeys, cdist = ckeys[valid], cdist[valid]
+
+            # Every vertex that got closer has to be relaxed again
+            improved = cdist < flat[ckeys] - 1e-9
+            ckeys, cdist = ckeys[improved], cdist[improved]
+            np.minimum.at(flat, ckeys, cdist)
+            pending = np.union1d(pending, ckeys)
+            reached.append(ckeys)
+
+        return np.unique(np.hstack(reached))
+
     @property
     @_memo
     def _cot_edge(self):
@@ -545,17 +891,6 @@ class Surface(object):
         c21 = c2 - c1
         return c32, c13, c21
 
-    @property
-    @_memo
-    def _polyconn(self):
-        npt = len(self.pts)
-        npoly = len(self.polys)
-        o = np.ones((npoly,))
-        c1 = sparse.coo_matrix((o, (self.polys[:,0], range(npoly))), (npt, npoly)).tocsr()
-        c2 = sparse.coo_matrix((o, (self.polys[:,1], range(npoly))), (npt, npoly)).tocsr()
-        c3 = sparse.coo_matrix((o, (self.polys[:,2], range(npoly))), (npt, npoly)).tocsr()
-        return c1, c2, c3
-
     @property
     @_memo
     def graph(self):
@@ -578,40 +913,65 @@ class Surface(object):
     def get_graph(self):
         return self.graph
 
+    @property
+    @_memo
+    def aabb_tree(self):
+        """Bounding box tree over the faces of this Surface, for closest point,
+        ray intersection and inside/outside queries. See `cortex.aabb.AABBTree`.
+        """
+        from .aabb import AABBTree
+        return AABBTree(self.pts, self.polys)
+
+    def submesh(self, vertex_mask):
+        """Cut out the part of the surface covered by `vertex_mask`. Faces are kept if
+        all three of their vertices are selected.
+
+        Parameters
+        ----------
+        vertex_mask : 1D ndarray
+            Boolean mask of length total_verts, or indices of the selected vertices
+
+        Returns
+        -------
+        pts : 2D ndarray, shape (sub_verts, 3)
+            Selected vertices, in their original order
+        polys : 2D ndarray, shape (sub_polys, 3)
+            Kept faces, indexing into `pts`
+        forward : 1D ndarray, shape (total_verts,)
+            New index of each original vertex, -1 if it was not selected
+        inverse : 1D ndarray, shape (sub_verts,)
+            Original index of each new vertex
+        """
+        mask = np.zeros((len(self.pts),), dtype=bool)
+        mask[vertex_mask] = True
+        inverse = np.nonzero(mask)[0]
+        forward = -np.ones((len(self.pts),), dtype=np.int64)
+        forward[inverse] = np.arange(len(inverse))
+        polys = forward[self.polys[mask[self.polys].all(1)]]
+        return self.pts[inverse], polys, forward, inverse
+
     def extract_chunk(self, nfaces=100, seed=None, auxpts=None):
         '''Extract a chunk of the surface using breadth first search, for testing purposes'''
         node = seed
         if seed is None:
             node = np.random.randint(len(self.pts))
 
-        ptmap = dict()
-        queue = [node]
-        faces = set()
-        visited = set([node])
-        while len(faces) < nfaces and len(queue) > 0:
-            node = queue.pop(0)
-            for face in self.connected[node].indices:
-                if face not in faces:
-                    faces.add(face)
-                    for pt in self.polys[face]:
-                        if pt not in visited:
-                            visited.add(pt)
-                            queue.append(pt)
-
-        pts, aux, polys = [], [], []
-        for face in faces:
-            for pt in self.polys[face]:
-                if pt not in ptmap:
-                    ptmap[pt] = len(pts)
-                    pts.append(self.pts[pt])
-                    if auxpts is not None:
-                        aux.append(auxpts[pt])
-            polys.append([ptmap[p] for p in self.polys[face]])
-
+        # Grow whole rings of neighbors until they touch enough faces
+        visited = np.zeros((len(self.pts),), dtype=bool)
+        visited[node] = True
+        faces = self.connected[node].indices
+        while len(faces) < nfaces:
+            ring = np.logical_and(np.asarray(self.adj.dot(visited)).ravel() > 0, ~visited)
+            if not ring.any():
+                break
+            visited |= ring
+            faces = np.nonzero(np.asarray(self.connected.T.dot(visited)).ravel())[0]
+
+        pts, polys, _, idx = self.submesh(np.unique(self.polys[faces]))
         if auxpts is not None:
-            return np.array(pts), np.array(aux), np.array(polys)
+            return pts, auxpts[idx], polys
 
-        return np.array(pts), np.array(polys)
+        return pts, polys
 
     def polyhedra(self, wm):
         '''Iterates through the polyhedra that make up the closest volume to a certain vertex'''
@@ -687,11 +1047,198 @@ class Surface(object):
             else:
                 yield None
 
+    @property
+    @_memo
+    def _vertex_faces(self):
+        """Every (vertex, face) incidence, grouped by vertex. Returns the CSR row offsets,
+        the face of each incidence, and that face's vertices rolled to start at the vertex.
+        """
+        conn = self.connected
+        offsets = conn.indptr.astype(np.int64)
+        faces = conn.indices.astype(np.int64)
+        verts = np.repeat(np.arange(len(self.pts)), np.diff(offsets))
+        polys = self.polys[faces]
+        first = np.argmax(polys == verts[:,np.newaxis], axis=1)
+        roll = (first[:,np.newaxis] + np.arange(3)) % 3
+        return offsets, faces, polys[np.arange(len(faces))[:,np.newaxis], roll]
+
+    def batch_patches(self, n=1, auxpts=None):
+        """Triangles of the patch around every vertex at once, as a ragged array.
+        This is the array equivalent of `patches`, with the triangles of vertex `i`
+        in `tris[offsets[i]:offsets[i+1]]`.
+
+        Parameters
+        ----------
+        n : 1 or 0.5, optional
+            With 1, the patch is every face touching the vertex. With 0.5, each face
+            is cut at its centroid and edge midpoints into two triangles that touch
+            the vertex, so that the patches of all vertices tile the surface.
+        auxpts : 2D ndarray, shape (total_verts, 3), optional
+            Another surface with the same faces, e.g. the pial surface. If given,
+            the matching triangles on it are returned as well.
+
+        Returns
+        -------
+        offsets : 1D ndarray, shape (total_verts+1,)
+            Start of each vertex's triangles
+        tris : 3D ndarray, shape (offsets[-1], 3, 3)
+            Corner coordinates of every triangle
+        auxtris : 3D ndarray, shape (offsets[-1], 3, 3)
+            Only if `auxpts` is given, the same triangles on `auxpts`
+        """
+        vfoffsets, faces, aligned = self._vertex_faces
+        if n == 1:
+            offsets = vfoffsets
+            def _tris(pts):
+                return pts[self.polys[faces]]
+        elif n == 0.5:
+            offsets = 2 * vfoffsets
+            ninc = len(faces)
+            # left halves go first in each vertex's block, then right halves
+            start = np.repeat(vfoffsets[:-1], np.diff(vfoffsets))
+            left = np.arange(ninc) + start
+            right = left + np.repeat(np.diff(vfoffsets), np.diff(vfoffsets))
+            def _tris(pts):
+                ppts = pts[aligned]
+                mid = ppts.mean(1)
+                tris = np.empty((2 * ninc, 3, 3))
+                tris[left] = np.array([ppts[:,0], mid, ppts[:,[0, 2]].mean(1)]).swapaxes(0, 1)
+                tris[right] = np.array([ppts[:,0], mid, ppts[:,[0, 1]].mean(1)]).swapaxes(0, 1)
+                return tris
+        else:
+            raise ValueError
+
+        if auxpts is not None:
+            return offsets, _tris(self.pts), _tris(auxpts)
+        return offsets, _tris(self.pts)
+
+    def batch_polyhedra(self, wm):
+        """Polyhedra between this surface and `wm` for every vertex at once. This is the
+        array equivalent of `polyhedra`: the region around each vertex is bounded by its
+        half-edge patch on both surfaces, joined by quads along the patch outline.
+
+        Parameters
+        ----------
+        wm : 2D ndarray, shape (total_verts, 3)
+            Inner (white matter) surface with the same faces as this one
+
+        Returns
+        -------
+        ptoffsets : 1D ndarray, shape (total_verts+1,)
+            Start of each vertex's points in `pts`
+        pts : 2D ndarray, shape (ptoffsets[-1], 3)
+            Corners of all polyhedra
+        trioffsets : 1D ndarray, shape (total_verts+1,)
+            Start of each vertex's triangles in `tris`
+        tris : 2D ndarray, shape (trioffsets[-1], 3)
+            Faces of all polyhedra, as indices into `pts`
+        """
+        npt = len(self.pts)
+        vfoffsets, faces, aligned = self._vertex_faces
+        nfaces = np.diff(vfoffsets)
+        verts = aligned[:,0]
+
+        # Local number of each neighbor of each vertex, from the sorted adjacency rows
+        adj = self.adj.tocsr()
+        adj.sort_indices()
+        nnbrs = np.diff(adj.indptr)
+        nbrkeys = np.repeat(np.arange(npt, dtype=np.int64), nnbrs) * npt + adj.indices
+        def _nbr(u):
+            return np.searchsorted(nbrkeys, verts * npt + u) - adj.indptr[verts]
+
+        # Each vertex has its own two points, then two per neighboring edge
+        # midpoint and two per face centroid (white matter first, then this surface)
+        ptoffsets = np.append(0, np.cumsum(2 + 2 * nnbrs + 2 * nfaces))
+        vstart = ptoffsets[:-1]
+        nbrverts = np.repeat(np.arange(npt), nnbrs)
+        nbrpts = vstart[nbrverts] + 2 + 2 * (np.arange(len(nbrverts)) - adj.indptr[nbrverts])
+        local = np.arange(len(faces)) - vfoffsets[verts]
+        facepts = vstart[verts] + 2 + 2 * nnbrs[verts] + 2 * local
+        pts = np.empty((ptoffsets[-1], 3))
+        for k, surf in enumerate([wm, self.pts]):
+            pts[vstart + k] = surf
+            pts[nbrpts + k] = (surf[nbrverts] + surf[adj.indices]) / 2
+            pts[facepts + k] = surf[aligned].mean(1)
+
+        o = vstart[verts]
+        wmpt, piapt = o, o + 1
+        c, e = o + 2 + 2 * _nbr(aligned[:,2]), o + 2 + 2 * _nbr(aligned[:,1])
+        d, f = c + 1, e + 1
+        a, b = facepts, facepts + 1
+
+        # Side quads between faces of the same vertex cancel out, so only keep
+        # those along edges that appear an odd number of times around the vertex
+        sidekeys = np.append(verts * npt + aligned[:,2], verts * npt + aligned[:,1])
+        _, inverse, counts = np.unique(sidekeys, return_inverse=True, return_counts=True)
+        lone = counts[inverse] % 2 == 1
+        ninc = len(faces)
+        quads = [np.array([wmpt, c, a, e]).T, np.array([piapt, f, b, d]).T,
+                 np.array([f, e, a, b]).T, np.array([d, b, a, c]).T,
+                 np.array([piapt, d, c, wmpt]).T[lone[:ninc]],
+                 np.array([piapt, wmpt, e, f]).T[lone[ninc:]]]
+        owner = np.hstack([verts, verts, verts, verts, verts[lone[:ninc]], verts[lone[ninc:]]])
+        order = np.argsort(owner, kind='mergesort')
+        quads = np.vstack(quads)[order]
+        tris = np.hstack([quads[:,:3], quads[:,[0, 2, 3]]]).reshape(-1, 3)
+        trioffsets = 2 * np.append(0, np.cumsum(np.bincount(owner, minlength=npt)))
+        return ptoffsets, pts, trioffsets, tris
+
     def edge_collapse(self, p1, p2, target):
         raise NotImplementedError
         face1 = self.connected[p1]
         face2 = self.connected[p2]
 
+class Neighborhoods(object):
+    """Neighborhood of every vertex of a surface, in CSR layout: the neighbors of vertex
+    `i` are `indices[indptr[i]:indptr[i+1]]`, at geodesic distances given by the same
+    slice of `dists`. Built by `Surface.geodesic_neighborhoods`.
+    """
+    def __init__(self, indptr, indices, dists):
+        self.indptr = indptr
+        self.indices = indices
+        self.dists = dists
+
+    @classmethod
+    def from_cache(cls, filename):
+        npz = np.load(filename)
+        hoods = cls(npz['indptr'], npz['indices'], npz['dists'])
+        npz.close()
+        return hoods
+
+    def save(self, filename, **attrs):
+        """Write the neighborhoods to the npz file `filename`, atomically, along with
+        any other `attrs`."""
+        from .cache import atomic_write
+        with atomic_write(filename) as fp:
+            np.savez(fp, indptr=self.indptr, indices=self.indices, dists=self.dists, **attrs)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, idx):
+        """Neighbors of vertex `idx` and their distances."""
+        sl = slice(self.indptr[idx], self.indptr[idx+1])
+        return self.indices[sl], self.dists[sl]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def sizes(self):
+        """Number of vertices in each neighborhood."""
+        return np.diff(self.indptr)
+
+    def batches(self, size=1000):
+        """Iterate over the neighborhoods `size` centers at a time, for vectorized
+        searchlights. Yields the centers, the center of each neighbor (as an index into
+        the centers), and the neighbors and their distances.
+        """
+        for start in range(0, len(self), size):
+            centers = np.arange(start, min(start + size, len(self)))
+            idx, pos = _ragged_ranges(self.indptr[centers], self.indptr[centers + 1])
+            yield centers, idx, self.indices[pos], self.dists[pos]
+
 class _ptset(object):
     def __init__(self):
         self.idx = OrderedDict()
@@ -772,11 +1319,9 @@ class Distortion(object):
         flatarea = area(self.flat, self.polys)
         tridists = np.log2(flatarea/refarea)
         
-        vertratios = np.zeros((len(self.ref),))
-        vertratios[self.polys[:,0]] += tridists
-        vertratios[self.polys[:,1]] += tridists
-        vertratios[self.polys[:,2]] += tridists
-        vertratios /= np.bincount(self.polys.ravel())
+        polys = np.asarray(self.polys).ravel()
+        vertratios = np.bincount(polys, weights=np.repeat(tridists, 3), minlength=len(self.ref))
+        vertratios /= np.bincount(polys, minlength=len(self.ref))
         vertratios = np.nan_to_num(vertratios)
         vertratios[vertratios==0] = 1
         return vertratios
@@ -799,27 +1344,19 @@ class Distortion(object):
         vertdists : 1D ndarray, shape (total_verts,)
             Metric distortion at each vertex.
         """
-        import networkx as nx
-        def iter_surfedges(tris):
-            for a,b,c in tris:
-                yield a,b
-                yield b,c
-                yield a,c
-
-        def make_surface_graph(tris):
-            graph = nx.Graph()
-            graph.add_edges_from(iter_surfedges(tris))
-            return graph
-
-        G = make_surface_graph(self.polys)
-        selverts = np.unique(self.polys.ravel())
-        ref_dists = [np.sqrt(((self.ref[G.neighbors(ii)] - self.ref[ii])**2).sum(1))
-                     for ii in selverts]
-        flat_dists = [np.sqrt(((self.flat[G.neighbors(ii)] - self.flat[ii])**2).sum(1))
-                      for ii in selverts]
-        msdists = np.array([(f-r).mean() for r,f in zip(ref_dists, flat_dists)])
-        alldists = np.zeros((len(self.ref),))
-        alldists[selverts] = msdists
+        polys = np.asarray(self.polys)
+        npt = len(self.ref)
+        edges = np.vstack([polys[:,[0,1]], polys[:,[1,2]], polys[:,[2,0]]])
+        adj = sparse.coo_matrix((np.ones(len(edges)), (edges[:,0], edges[:,1])), (npt, npt))
+        adj = (adj + adj.T).tocoo()
+        ref_dists = np.sqrt(((self.ref[adj.col] - self.ref[adj.row])**2).sum(1))
+        flat_dists = np.sqrt(((self.flat[adj.col] - self.flat[adj.row])**2).sum(1))
+        # Mean difference over the neighbors of each vertex
+        total = np.bincount(adj.row, weights=flat_dists - ref_dists, minlength=npt)
+        nneigh = np.bincount(adj.row, minlength=npt)
+        alldists = np.zeros((npt,))
+        selverts = nneigh > 0
+        alldists[selverts] = total[selverts] / nneigh[selverts]
         return alldists
 
 def tetra_vol(pts):
@@ -855,15 +1392,134 @@ def face_volume(pts1, pts2, polys):
             print(i)
     return vols
 
-def decimate(pts, polys):
-    from tvtk.api import tvtk
-    pd = tvtk.PolyData(points=pts, polys=polys)
-    dec = tvtk.DecimatePro(input=pd)
-    dec.set(preserve_topology=True, splitting=False, boundary_vertex_deletion=False, target_reduction=1.0)
-    dec.update()
-    dpts = dec.output.points.to_array()
-    dpolys = dec.output.polys.to_array().reshape(-1, 4)[:,1:]
-    return dpts, dpolys
+def decimate(pts, polys, reduction=0.9, return_map=False):
+    """Decimate a triangle mesh by quadric error metric (Garland & Heckbert 1997) edge
+    collapses.
+
+    Every collapse merges a vertex into one of its neighbors, so the remaining vertices
+    keep their original positions. Boundary vertices are never removed, so boundaries
+    (e.g. the cuts of a flatmap) are preserved exactly. Collapses that would break the
+    manifold or flip a face are skipped.
+
+    The collapses run in rounds. Each round collapses every vertex whose cheapest
+    collapse costs less than that of any other vertex within two edges, so all the
+    collapses of a round are independent and are applied at once.
+
+    Parameters
+    ----------
+    pts : 2D ndarray, shape (total_verts, 3)
+        Vertex coordinates
+    polys : 2D ndarray, shape (total_polys, 3)
+        Indices of the vertices in each triangle
+    reduction : float, optional
+        Fraction of the vertices to remove. Fewer are removed if no valid collapses
+        are left. The default keeps a tenth of the vertices. The VTK DecimatePro call
+        that this replaced removed as many vertices as it could (target_reduction=1.0),
+        which with edge collapses would shrink every interior down to a handful of
+        vertices, so meshes decimated with the default are denser than they used to be.
+    return_map : bool, optional
+        If True, also return the original index of every remaining vertex
+
+    Returns
+    -------
+    dpts : 2D ndarray
+        Remaining vertices, equal to pts[kept]
+    dpolys : 2D ndarray
+        Triangles of the decimated mesh
+    kept : 1D ndarray
+        Only if `return_map`, index of each remaining vertex in `pts`
+    """
+    pts = np.asarray(pts, dtype=float)
+    polys = np.asarray(polys).astype(np.int64)
+    npt = len(pts)
+    hom = np.hstack([pts, np.ones((npt, 1))])
+    nalive = len(np.unique(polys))
+    target = int(round(nalive * (1 - reduction)))
+
+    ## Error quadric of every vertex, summed over the planes of its faces
+    norms = np.cross(pts[polys[:,1]] - pts[polys[:,0]], pts[polys[:,2]] - pts[polys[:,0]])
+    area = np.sqrt((norms**2).sum(1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        unit = np.nan_to_num(norms / area[:,np.newaxis])
+    planes = np.hstack([unit, -(unit * pts[polys[:,0]]).sum(1)[:,np.newaxis]])
+    K = (area[:,np.newaxis,np.newaxis] / 2 * planes[:,:,np.newaxis] * planes[:,np.newaxis,:])
+    Q = np.array([np.bincount(polys.ravel(), weights=np.repeat(k, 3), minlength=npt)
+                  for k in K.reshape(-1, 16).T]).T.reshape(npt, 4, 4)
+
+    boundary = np.zeros((npt,), dtype=bool)
+    boundary[boundary_edges(polys).ravel()] = True
+
+    while nalive > target:
+        ## Every directed edge u -> v of an interior vertex u is a candidate collapse
+        adj = sparse.coo_matrix((np.ones((3*len(polys),)),
+            (polys.ravel(), polys[:,[1, 2, 0]].ravel())), (npt, npt)).tocsr()
+        adj = ((adj + adj.T) > 0).astype(np.int32)
+        adj.sort_indices()
+        rows = np.repeat(np.arange(npt), np.diff(adj.indptr))
+        cand = ~boundary[rows]
+        u, v = rows[cand], adj.indices[cand]
+
+        # Link condition: the edge must have exactly two common neighbors
+        common = adj.dot(adj).multiply(adj).tocsr()
+        common.sort_indices()
+        ckeys = np.repeat(np.arange(npt), np.diff(common.indptr)) * npt + common.indices
+        pos = np.minimum(np.searchsorted(ckeys, u * npt + v), len(ckeys) - 1)
+        ok = (ckeys[pos] == u * npt + v) & (common.data[pos] == 2)
+
+        # No face around u may flip when u moves onto v
+        conn = sparse.coo_matrix((np.ones((3*len(polys),)),
+            (polys.ravel(), np.repeat(np.arange(len(polys)), 3))), (npt, len(polys))).tocsr()
+        idx, fpos = _ragged_ranges(conn.indptr[u], conn.indptr[u+1])
+        face = polys[conn.indices[fpos]]
+        kept = (face != v[idx,np.newaxis]).all(1)
+        idx, face = idx[kept], face[kept]
+        moved = np.where(face == u[idx,np.newaxis], v[idx,np.newaxis], face)
+        before = np.cross(pts[face[:,1]] - pts[face[:,0]], pts[face[:,2]] - pts[face[:,0]])
+        after = np.cross(pts[moved[:,1]] - pts[moved[:,0]], pts[moved[:,2]] - pts[moved[:,0]])
+        flip = (before * after).sum(1) <= 0
+        ok &= np.bincount(idx[flip], minlength=len(u)) == 0
+
+        u, v = u[ok], v[ok]
+        if len(u) == 0:
+            break
+        cost = np.einsum('ni,nij,nj->n', hom[v], Q[u] + Q[v], hom[v])
+
+        # Cheapest collapse of every vertex
+        order = np.lexsort((cost, u))
+        first = np.ones((len(order),), dtype=bool)
+        first[1:] = u[order][1:] != u[order][:-1]
+        best = order[first]
+        u, v, cost = u[best], v[best], cost[best]
+
+        # Keep the vertices that are cheaper than anything within two edges
+        own = np.empty((len(u),), dtype=np.int64)
+        own[np.argsort(cost, kind='mergesort')] = np.arange(len(u))
+        rank = np.full((npt,), len(u), dtype=np.int64)
+        rank[u] = own
+        ring = (adj + sparse.eye(npt, dtype=np.int32, format='csr')).tocsr()
+        for _ in range(2):
+            rank = np.minimum.reduceat(rank[ring.indices], ring.indptr[:-1])
+        sel = rank[u] == own
+        u, v, cost = u[sel], v[sel], cost[sel]
+        if len(u) > nalive - target:
+            cheap = np.argsort(cost, kind='mergesort')[:nalive - target]
+            u, v = u[cheap], v[cheap]
+
+        ## Collapse them all
+        remap = np.arange(npt)
+        remap[u] = v
+        polys = remap[polys]
+        polys = polys[(polys[:,0] != polys[:,1]) & (polys[:,1] != polys[:,2]) &
+                      (polys[:,2] != polys[:,0])]
+        Q[v] += Q[u]
+        nalive -= len(u)
+
+    kept = np.unique(polys)
+    newidx = np.zeros((npt,), dtype=np.int64)
+    newidx[kept] = np.arange(len(kept))
+    if return_map:
+        return pts[kept], newidx[polys], kept
+    return pts[kept], newidx[polys]
 
 def inside_convex_poly(pts):
     """Returns a function that checks if inputs are inside the convex hull of polyhedron defined by pts
@@ -884,100 +1540,206 @@ def make_cube(center=(.5, .5, .5), size=1):
     return pts * size + center, polys
 
 def boundary_edges(polys):
-    '''Returns the edges that are on the boundary of a mesh, as defined by belonging to only 1 face'''
-    edges = dict()
-    for i, poly in enumerate(np.sort(polys)):
-        for a, b in [(0,1), (1,2), (0, 2)]:
-            key = poly[a], poly[b]
-            if key not in edges:
-                edges[key] = []
-            edges[key].append(i)
-
-    epts = []
-    for edge, faces in edges.items():
-        if len(faces) == 1:
-            epts.append(edge)
-
-    return np.array(epts)
+    '''Returns the edges that are on the boundary of a mesh, as defined by belonging to only 1 face
+
+    Edges keep the winding of the face they belong to, so on a consistently oriented
+    mesh each boundary loop can be followed head to tail.
+
+    Parameters
+    ----------
+    polys : 2D ndarray, shape (total_polys, 3)
+        Indices of the vertices in each triangle
+
+    Returns
+    -------
+    edges : 2D ndarray, shape (boundary_edges, 2)
+        Directed boundary edges, sorted by their first vertex
+    '''
+    polys = np.asarray(polys).astype(np.int64).reshape(-1, 3)
+    if len(polys) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    directed = np.vstack([polys[:,[0, 1]], polys[:,[1, 2]], polys[:,[2, 0]]])
+    keys = np.sort(directed, axis=1)
+    keys = keys[:,0] * (polys.max() + 1) + keys[:,1]
+    _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    edges = directed[counts[inverse] == 1]
+    return edges[np.lexsort(edges.T[::-1])]
+
+def trace_loops(edges):
+    '''Given a disjoint set of edges, return all the complete linked loops at once
+
+    If every vertex has as many incoming as outgoing edges (such as the output of
+    `boundary_edges`), edges are followed in their given direction. Otherwise they are
+    treated as undirected, and every vertex must belong to an even number of edges.
+
+    Where loops touch at a vertex (a bowtie), the way through it is chosen by vertex
+    index: directed, the k-th edge coming in from the smallest vertex leaves to the
+    k-th smallest vertex; undirected, the neighbors of the vertex are paired in
+    sorted order.
+
+    Parameters
+    ----------
+    edges : 2D ndarray, shape (n_edges, 2)
+        Vertex indices of each edge
+
+    Returns
+    -------
+    loops : list of 1D ndarray
+        Vertex indices around each loop, without repeating the first vertex. Loops
+        start at, and are sorted by, their smallest vertex index.
+    '''
+    from scipy.sparse import csgraph
+    edges = np.asarray(edges).astype(np.int64).reshape(-1, 2)
+    if len(edges) == 0:
+        return []
+
+    nvert = edges.max() + 1
+    outdeg = np.bincount(edges[:,0], minlength=nvert)
+    indeg = np.bincount(edges[:,1], minlength=nvert)
+    directed = (outdeg == indeg).all()
+    if directed:
+        half = edges[np.lexsort(edges.T[::-1])]
+        # Pair the k-th edge entering each vertex with the k-th edge leaving it
+        nxt = np.empty((len(half),), dtype=np.int64)
+        nxt[np.argsort(half[:,1], kind='mergesort')] = np.arange(len(half))
+    else:
+        if ((outdeg + indeg) % 2 != 0).any():
+            raise ValueError('Undirected edges must form closed loops')
+        half = np.vstack([edges, edges[:,::-1]])
+        half = half[np.lexsort(half.T[::-1])]
+        keys = half[:,0] * nvert + half[:,1]
+        rev = np.searchsorted(keys, half[:,1] * nvert + half[:,0])
+        # The half-edges leaving a vertex are adjacent and sorted by neighbor. Pair
+        # them up in that order: arriving back along one, leave along its partner.
+        first = np.searchsorted(half[:,0], half[:,1])
+        nxt = first + ((rev - first) ^ 1)
+
+    nhalf = len(half)
+    idx = np.arange(nhalf)
+    graph = sparse.coo_matrix((np.ones((nhalf,)), (idx, nxt)), (nhalf, nhalf))
+    nloops, labels = csgraph.connected_components(graph, directed=False)
+    # The smallest half-edge of each loop leaves its smallest vertex
+    root = np.full((nloops,), nhalf, dtype=np.int64)
+    np.minimum.at(root, labels, idx)
+
+    # Cut every loop just before its root, then rank by pointer jumping
+    last = nxt == root[labels]
+    jump = np.where(last, idx, nxt)
+    dist = (~last).astype(np.int64)
+    for _ in range(int(np.ceil(np.log2(nhalf))) + 1):
+        dist += dist[jump]
+        jump = jump[jump]
+
+    order = np.lexsort((-dist, labels))
+    loops = np.split(half[order, 0], np.cumsum(np.bincount(labels, minlength=nloops))[:-1])
+    if directed:
+        return loops
+
+    # Undirected loops were traced both ways; keep the way that leaves the
+    # smallest vertex towards its smaller neighbor
+    keep = root <= root[labels[rev[root]]]
+    return [loop for loop, k in zip(loops, keep) if k]
 
 def trace_poly(edges):
-    '''Given a disjoint set of edges, yield complete linked polygons'''
-    idx = dict((i, set([])) for i in np.unique(edges))
-    for i, (x, y) in enumerate(edges):
-        idx[x].add(i)
-        idx[y].add(i)
-
-    eset = set(range(len(edges)))
-    while len(eset) > 0:
-        eidx = eset.pop()
-        poly = list(edges[eidx])
-        stack = set([eidx])
-        while poly[-1] != poly[0] or len(poly) == 1:
-            next = list(idx[poly[-1]] - stack)[0]
-            eset.remove(next)
-            stack.add(next)
-            if edges[next][0] == poly[-1]:
-                poly.append(edges[next][1])
-            elif edges[next][1] == poly[-1]:
-                poly.append(edges[next][0])
-            else:
-                raise Exception
+    '''Given a disjoint set of edges, yield complete linked polygons
 
+    Each polygon is a list of vertex indices that repeats its first vertex at the end.
+    See `trace_loops` to get all loops at once as arrays.
+    '''
+    for loop in trace_loops(edges):
+        poly = loop.tolist()
+        poly.append(poly[0])
         yield poly
 
-def rasterize(poly, shape=(256, 256)):
-    #ImageDraw sucks at its job, so we'll use imagemagick to do rasterization
-    import subprocess as sp
-    import cStringIO
-    import shlex
-    from PIL import Image
-    
-    polygon = " ".join(["%0.3f,%0.3f"%tuple(p[::-1]) for p in np.array(poly)-(.5, .5)])
-    cmd = 'convert -size %dx%d xc:black -fill white -stroke none -draw "polygon %s" PNG32:-'%(shape[0], shape[1], polygon)
-    proc = sp.Popen(shlex.split(cmd), stdout=sp.PIPE)
-    png = cStringIO.StringIO(proc.communicate()[0])
-    im = Image.open(png)
-
-    # For PNG8:
-    # mode, palette = im.palette.getdata()
-    # lut = np.fromstring(palette, dtype=np.uint8).reshape(-1, 3)
-    # if (lut == 255).any():
-    #     white = np.nonzero((lut == 255).all(1))[0][0]
-    #     return np.array(im) == white
-    # return np.zeros(shape, dtype=bool)
-    return (np.array(im)[:,:,0] > 128).T
-
-def voxelize(pts, polys, shape=(256, 256, 256), center=(128, 128, 128), mp=True):
-    from tvtk.api import tvtk
-    
-    pd = tvtk.PolyData(points=pts + center + (0, 0, 0), polys=polys)
-    plane = tvtk.Planes(normals=[(0,0,1)], points=[(0,0,0)])
-    clip = tvtk.ClipPolyData(clip_function=plane, input=pd)
-    feats = tvtk.FeatureEdges(
-        manifold_edges=False, 
-        non_manifold_edges=False, 
-        feature_edges=False,
-        boundary_edges=True,
-        input=clip.output)
-
-    def func(i):
-        plane.points = [(0,0,i)]
-        feats.update()
-        vox = np.zeros(shape[:2][::-1], np.uint8)
-        if feats.output.number_of_lines > 0:
-            epts = feats.output.points.to_array()
-            edges = feats.output.lines.to_array().reshape(-1, 3)[:,1:]
-            for poly in trace_poly(edges):
-                vox += rasterize(epts[poly][:,:2]+[.5, .5], shape=shape[:2][::-1])
-        return vox % 2
-
-    if mp:
-        from . import mp
-        layers = mp.map(func, range(shape[2]))
-    else:
-        layers = map(func, range(shape[2]))
+def boundary_loops(polys):
+    '''Ordered vertex loops along every boundary of a mesh. See `trace_loops`.'''
+    return trace_loops(boundary_edges(polys))
+
+def voxelize(pts, polys, shape=(256, 256, 256), center=(128, 128, 128)):
+    '''Fill the voxels whose centers lie inside a closed mesh
 
-    return np.array(layers).T
+    The mesh is cut by every z plane at once, and each slice is filled by the parity
+    of outline crossings along its scanlines, so no intermediate polygons are traced.
+
+    Parameters
+    ----------
+    pts : 2D ndarray, shape (total_verts, 3)
+        Vertex coordinates in voxel units, in (x, y, z) order
+    polys : 2D ndarray, shape (total_polys, 3)
+        Triangles of a closed mesh
+    shape : tuple of int, optional
+        (x, y, z) shape of the output volume
+    center : tuple of float, optional
+        Offset added to `pts` before voxelizing
+
+    Returns
+    -------
+    vox : 3D ndarray, shape `shape`
+        1 inside the mesh, 0 outside
+    '''
+    pts = np.asarray(pts, dtype=float) + center
+    polys = np.asarray(polys)
+    nx, ny, nz = shape
+
+    ## Cut every triangle with every z plane it spans. A vertex counts as above a
+    ## plane when z >= plane, so each crossed triangle has exactly two cut edges.
+    z = pts[polys, 2]
+    kmin = np.clip(np.floor(z.min(1)) + 1, 0, nz).astype(int)
+    kmax = np.clip(np.floor(z.max(1)) + 1, 0, nz).astype(int)
+    tri, k = _ragged_ranges(kmin, kmax)
+    edges = np.array([[0, 1], [1, 2], [2, 0]])
+    above = z[tri] >= k[:,np.newaxis]
+    cut = above[:,edges[:,0]] != above[:,edges[:,1]]
+    row, edge = np.nonzero(cut)
+    # Order each edge by vertex index so both faces sharing it cut at the same point
+    ends = np.sort(polys[tri[row]][np.arange(len(row))[:,np.newaxis], edges[edge]], axis=1)
+    p0, p1 = pts[ends[:,0]], pts[ends[:,1]]
+    t = (k[row] - p0[:,2]) / (p1[:,2] - p0[:,2])
+    cutpts = (p0 + t[:,np.newaxis] * (p1 - p0))[:,:2].reshape(-1, 2, 2)
+    k = k[row[::2]]
+
+    ## Cross every segment with the scanlines it spans, using the same rule in y
+    y = cutpts[:,:,1]
+    jmin = np.clip(np.floor(y.min(1)) + 1, 0, ny).astype(int)
+    jmax = np.clip(np.floor(y.max(1)) + 1, 0, ny).astype(int)
+    seg, j = _ragged_ranges(jmin, jmax)
+    (x0, y0), (x1, y1) = cutpts[seg].transpose(1, 2, 0)
+    x = x0 + (j - y0) * (x1 - x0) / (y1 - y0)
+
+    ## Every crossing flips inside/outside for the voxels after it in its row
+    flips = np.zeros((nz, ny, nx+1), dtype=np.uint8)
+    np.add.at(flips, (k[seg], j, np.clip(np.floor(x) + 1, 0, nx).astype(int)), 1)
+    vox = np.bitwise_xor.accumulate(flips[..., :nx] & 1, axis=-1)
+    return vox.T
+
+def _ragged_ranges(start, stop):
+    '''Concatenate range(start[i], stop[i]) for all i, returning the source i of each value'''
+    count = np.maximum(stop - start, 0)
+    idx = np.repeat(np.arange(len(count)), count)
+    offsets = np.cumsum(count) - count
+    return idx, start[idx] + np.arange(count.sum()) - offsets[idx]
+
+def _triangle_update(a, b, c, da, db):
+    """Distance to the corners `c` of triangles (a, b, c) of a front with distances `da`
+    and `db` at `a` and `b`, unfolding the triangle into the plane as in fast marching.
+    Where the front cannot reach `c` through the edge ab, falls back to the shortest
+    path along the edges.
+    """
+    ab = b - a
+    lab = np.sqrt((ab**2).sum(1))
+    ac = c - a
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Virtual source on the far side of ab, and c, in the plane of the triangle
+        sx = (da**2 - db**2 + lab**2) / (2 * lab)
+        sy = -np.sqrt(da**2 - sx**2)
+        cx = (ac * ab).sum(1) / lab
+        cy = np.sqrt(np.maximum((ac**2).sum(1) - cx**2, 0))
+        update = np.sqrt((cx - sx)**2 + (cy - sy)**2)
+        # The straight path from the source must cross ab
+        cross = sx + (cx - sx) * -sy / (cy - sy)
+        valid = np.isfinite(update) & (cross >= 0) & (cross <= lab)
+    edges = np.minimum(da + np.sqrt((ac**2).sum(1)), db + np.sqrt(((c - b)**2).sum(1)))
+    return np.where(valid, np.minimum(update, edges), edges)
 
 def measure_volume(pts, polys):
     from tvtk.api import tvtk
@@ -999,26 +1761,25 @@ def marching_cubes(volume, smooth=True, decimate=True, **kwargs):
         smoothargs = dict(number_of_iterations=40, feature_angle = 90, pass_band=.05)
         smoothargs.update(kwargs)
         contours = tvtk.WindowedSincPolyDataFilter(input=contours.output, **smoothargs)
-    if decimate:
-        contours = tvtk.QuadricDecimation(input=contours.output, target_reduction=.75)
-    
+
     contours.update()
     pts = contours.output.points.to_array()
     polys = contours.output.polys.to_array().reshape(-1, 4)[:,1:]
+    if decimate:
+        # The argument shadows this module's decimate function
+        from . import polyutils
+        pts, polys = polyutils.decimate(pts, polys, reduction=.75)
     return pts, polys
 
 
 def deduplicate(pts, polys):
-    npts = []
-    dpts = dict()
-    i = 0
-    for p in pts:
-        if tuple(p) not in dpts:
-            dpts[tuple(p)] = i
-            i += 1
-            npts.append(p)
-    
-    newpolys = np.zeros_like(polys)
-    for i, pts in enumerate(pts[polys]):
-        newpolys[i] = dpts[tuple(pts[0])], dpts[tuple(pts[1])], dpts[tuple(pts[2])]
-    return np.array(npts), np.array(newpolys)
\ No newline at end of file
+    '''Merge vertices with identical coordinates, keeping the first copy of each
+
+    Returns the unique points, in order of first appearance, and the faces
+    reindexed to them.
+    '''
+    _, first, inverse = np.unique(pts, axis=0, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return pts[first[order]], rank[inverse.ravel()][polys]
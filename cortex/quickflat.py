@@ -5,6 +5,7 @@ import binascii
 import numpy as np
 
 from . import utils
+from . import cache
 from . import dataset
 from .database import db
 from .options import config
@@ -509,35 +510,47 @@ def make_movie(name, data, subject, xfmname, recache=False, height=1024,
 
 def get_flatmask(subject, height=1024, recache=False):
     cachedir = db.get_cache(subject)
-    cachefile = os.path.join(cachedir, "flatmask_{h}.npz".format(h=height))
-
-    if not os.path.exists(cachefile) or recache:
-        mask, extents = _make_flatmask(subject, height=height)
-        np.savez(cachefile, mask=mask, extents=extents)
-    else:
-        npz = np.load(cachefile)
-        mask, extents = npz['mask'], npz['extents']
-        npz.close()
-
+    digest = db._input_digest(subject, ["flat"], height=height)
+    cachefile = os.path.join(cachedir, "flatmask_{h}_{d}.npz".format(h=height, d=digest[:16]))
+
+    with cache.building(cachefile, recache, inputs=dict(subject=subject, digest=digest)) as build:
+        if build:
+            mask, extents = _make_flatmask(subject, height=height)
+            with cache.atomic_write(cachefile) as fp:
+                np.savez(fp, mask=mask, extents=extents)
+            return mask, extents
+
+    npz = np.load(cachefile)
+    mask, extents = npz['mask'], npz['extents']
+    npz.close()
     return mask, extents
 
 def get_flatcache(subject, xfmname, pixelwise=True, thick=32, sampler='nearest',
                   recache=False, height=1024, depth=0.5):
     cachedir = db.get_cache(subject)
-    cachefile = os.path.join(cachedir, "flatverts_{height}.npz").format(height=height)
+    # Cache files are named by the surfaces, transform and options they are made from
     if pixelwise and xfmname is not None:
-        cachefile = os.path.join(cachedir, "flatpixel_{xfmname}_{height}_{sampler}_{extra}.npz")
+        digest = db._input_digest(subject, ["flat", "pia", "wm", "fiducial"], xfmname,
+                                  height=height, sampler=sampler, thick=thick, depth=depth)
+        cachefile = os.path.join(cachedir, "flatpixel_{xfmname}_{height}_{sampler}_{extra}_{digest}.npz")
         extra = "l%d"%thick if thick > 1 else "d%g"%depth
-        cachefile = cachefile.format(height=height, xfmname=xfmname, sampler=sampler, extra=extra)
-
-    if not os.path.exists(cachefile) or recache:
-        print("Generating a flatmap cache")
-        if pixelwise and xfmname is not None:
-            pixmap = _make_pixel_cache(subject, xfmname, height=height, sampler=sampler, thick=thick, depth=depth)
-        else:
-            pixmap = _make_vertex_cache(subject, height=height)
-        np.savez(cachefile, data=pixmap.data, indices=pixmap.indices, indptr=pixmap.indptr, shape=pixmap.shape)
+        cachefile = cachefile.format(height=height, xfmname=xfmname, sampler=sampler, extra=extra,
+                                     digest=digest[:16])
     else:
+        digest = db._input_digest(subject, ["flat"], height=height)
+        cachefile = os.path.join(cachedir, "flatverts_{height}_{digest}.npz").format(
+            height=height, digest=digest[:16])
+
+    with cache.building(cachefile, recache, inputs=dict(subject=subject, digest=digest)) as build:
+        if build:
+            print("Generating a flatmap cache")
+            if pixelwise and xfmname is not None:
+                pixmap = _make_pixel_cache(subject, xfmname, height=height, sampler=sampler, thick=thick, depth=depth)
+            else:
+                pixmap = _make_vertex_cache(subject, height=height)
+            with cache.atomic_write(cachefile) as fp:
+                np.savez(fp, data=pixmap.data, indices=pixmap.indices, indptr=pixmap.indptr, shape=pixmap.shape)
+    if not build:
         from scipy import sparse
         npz = np.load(cachefile)
         pixmap = sparse.csr_matrix((npz['data'], npz['indices'], npz['indptr']), shape=npz['shape'])
@@ -565,8 +578,9 @@ def _make_flatmask(subject, height=1024):
     from . import polyutils
     from PIL import Image, ImageDraw
     pts, polys = db.get_surf(subject, "flat", merge=True, nudge=True)
-    bounds = polyutils.trace_poly(polyutils.boundary_edges(polys))
-    left, right = bounds.next(), bounds.next()
+    # The two longest boundary loops outline the hemispheres, left one first
+    bounds = sorted(polyutils.boundary_loops(polys), key=len)[-2:]
+    left, right = sorted(bounds, key=lambda loop: loop[0])
     aspect = (height / (pts.max(0) - pts.min(0))[1])
     lpts = (pts[left] - pts.min(0)) * aspect
     rpts = (pts[right] - pts.min(0)) * aspect
@@ -7,16 +7,30 @@ import subprocess as sp
 import numpy as np
 
 from . import utils
+from . import cache
 from . import polyutils
 from .database import db
 from .xfm import Transform
 
+def _curvature(surf, smooth=20):
+    return surf.smooth(surf.mean_curvature(), smooth)
+
+def _distortion(surf, flatpts, flatpolys, type='areal', smooth=20):
+    dist = getattr(polyutils.Distortion(flatpts, surf.pts, flatpolys), type)
+    return surf.smooth(dist, smooth)
+
+def _sulcaldepth(pts):
+    from scipy.spatial import ConvexHull
+    from .aabb import AABBTree
+    hull = ConvexHull(pts)
+    dist, _, _ = AABBTree(pts, hull.simplices).closest_point(pts)
+    return dist
+
 def curvature(outfile, subject, smooth=20, **kwargs):
     curvs = []
     for pts, polys in db.get_surf(subject, "fiducial"):
         surf = polyutils.Surface(pts, polys)
-        curv = surf.smooth(surf.mean_curvature(), smooth)
-        curvs.append(curv)
+        curvs.append(_curvature(surf, smooth))
     np.savez(outfile, left=curvs[0], right=curvs[1])
 
 def distortion(outfile, subject, type='areal', smooth=20):
@@ -37,10 +51,7 @@ def distortion(outfile, subject, type='areal', smooth=20):
         fidvert, fidtri = db.get_surf(subject, "fiducial", hem)
         flatvert, flattri = db.get_surf(subject, "flat", hem)
         surf = polyutils.Surface(fidvert, fidtri)
-
-        dist = getattr(polyutils.Distortion(flatvert, fidvert, flattri), type)
-        smdist = surf.smooth(dist, smooth)
-        distortions.append(smdist)
+        distortions.append(_distortion(surf, flatvert, flattri, type, smooth))
 
     np.savez(outfile, left=distortions[0], right=distortions[1])
 
@@ -51,7 +62,101 @@ def thickness(outfile, subject):
     right = np.sqrt(((pr[0] - wr[0])**2).sum(1))
     np.savez(outfile, left=left, right=right)
 
-def tissots_indicatrix(outfile, sub, radius=10, spacing=50, maxfails=100): 
+def sulcaldepth(outfile, subject):
+    """Computes sulcal depth as the distance from each fiducial vertex to the convex
+    hull of its hemisphere. Vertices on the crowns of gyri are near 0.
+    """
+    depths = [_sulcaldepth(pts) for pts, polys in db.get_surf(subject, "fiducial")]
+    np.savez(outfile, left=depths[0], right=depths[1])
+
+# Surface info files made by `generate`, as (type, generator options) pairs
+_generated = dict(
+    curvature=[("curvature", ())],
+    thickness=[("thickness", ())],
+    distortion=[("distortion", ()), ("distortion", (("type", "metric"),))],
+    sulcaldepth=[("sulcaldepth", ())],
+)
+
+def _hemisphere_info(args):
+    """Compute the surface info `types` of one hemisphere, sharing a single fiducial
+    Surface (and its Laplacian and smoothing factorization) between them.
+    """
+    subject, hem, types = args
+    fidpts, fidpolys = db.get_surf(subject, "fiducial", hem)
+    surf = polyutils.Surface(fidpts, fidpolys)
+    info = dict()
+    for key in types:
+        type, opts = key
+        if type == "curvature":
+            info[key] = _curvature(surf)
+        elif type == "distortion":
+            flatpts, flatpolys = db.get_surf(subject, "flat", hem)
+            info[key] = _distortion(surf, flatpts, flatpolys, **dict(opts))
+        elif type == "thickness":
+            piapts, _ = db.get_surf(subject, "pia", hem)
+            wmpts, _ = db.get_surf(subject, "wm", hem)
+            info[key] = np.sqrt(((piapts - wmpts)**2).sum(1))
+        elif type == "sulcaldepth":
+            info[key] = _sulcaldepth(fidpts)
+    return info
+
+def generate(subject, types=("curvature", "thickness", "distortion", "sulcaldepth"),
+             n_jobs=2, recache=False):
+    """Generate several types of surface info for a subject at once, with the two
+    hemispheres computed in parallel processes. Every npz is written to the same place
+    that `db.get_surfinfo` reads it from, so this is a faster way to set up a new subject.
+
+    Parameters
+    ----------
+    subject : str
+        Subject name
+    types : list of str, optional
+        Surface info to generate, any of "curvature", "thickness", "distortion" (both
+        areal and metric) and "sulcaldepth"
+    n_jobs : int, optional
+        Number of processes; at most one per hemisphere is used
+    recache : bool, optional
+        Regenerate info that is already in the filestore
+
+    Returns
+    -------
+    files : list of str
+        Files that were written
+    """
+    keys = [key for type in types for key in _generated[type]]
+    if not recache:
+        keys = [key for key in keys
+                if not os.path.exists(db._surfinfo_file(subject, key[0], dict(key[1])))]
+    if len(keys) == 0:
+        return []
+
+    jobs = [(subject, hem, keys) for hem in ["lh", "rh"]]
+    if n_jobs > 1:
+        import multiprocessing as mp
+        pool = mp.Pool(min(n_jobs, len(jobs)))
+        try:
+            left, right = pool.map(_hemisphere_info, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        left, right = map(_hemisphere_info, jobs)
+
+    files = []
+    for key in keys:
+        fname = db._surfinfo_file(subject, key[0], dict(key[1]))
+        with cache.atomic_write(fname) as fp:
+            np.savez(fp, left=left[key], right=right[key])
+        files.append(fname)
+    return files
+
+def tissots_indicatrix(outfile, sub, radius=10, spacing=50, maxfails=100, rng=None):
+    """Draw Tissot's indicatrix on both hemispheres: disks of geodesic `radius` (mm)
+    around centers that are about `spacing` apart, saved to `outfile` as the arrays
+    `left`, `right` and `centers`. `rng` is the random state that picks the centers,
+    by default the global one."""
+    if rng is None:
+        rng = np.random
     tissots = []
     allcenters = []
     for hem in ["lh", "rh"]:
@@ -61,30 +166,31 @@ def tissots_indicatrix(outfile, sub, radius=10, spacing=50, maxfails=100):
         nvert = fidpts.shape[0]
         tissot_array = np.zeros((nvert,))
 
-        centers = [np.random.randint(nvert)]
-        cdists = [surf.geodesic_distance(centers)]
-        while True:
-            ## Find possible vertices
-            mcdist = np.vstack(cdists).min(0)
-            possverts = np.nonzero(mcdist > spacing)[0]
-            #possverts = np.nonzero(surf.geodesic_distance(centers) > spacing)[0]
-            if not len(possverts):
-                break
-            ## Pick random vertex
-            centervert = possverts[np.random.randint(len(possverts))]
+        ## Visit the vertices in random order, adding a center at every vertex that is
+        ## not yet within `spacing` of one. Each center is then a random pick among the
+        ## uncovered vertices, and only the disk around it has to be searched, reusing
+        ## one distance buffer for all of them.
+        covered = np.zeros((nvert,), dtype=bool)
+        buffer = np.full((nvert,), np.inf)
+        centers = []
+        for centervert in rng.permutation(nvert):
+            if covered[centervert]:
+                continue
             centers.append(centervert)
             print("Adding vertex %d.." % centervert)
-            dists = surf.geodesic_distance([centervert])
-            cdists.append(dists)
+            idx, dists = surf.geodesic_within([centervert], max(radius, spacing), buffer=buffer)
+            covered[idx[dists <= spacing]] = True
 
             ## Find appropriate set of vertices
-            selverts = dists < radius
-            tissot_array[selverts] = 1
+            tissot_array[idx[dists < radius]] = 1
 
         tissots.append(tissot_array)
         allcenters.append(np.array(centers))
 
-    np.savez(outfile, left=tissots[0], right=tissots[1], centers=allcenters)
+    # The hemispheres have different numbers of centers
+    centers = np.empty((2,), dtype=object)
+    centers[:] = allcenters
+    np.savez(outfile, left=tissots[0], right=tissots[1], centers=centers)
 
 def flat_border(outfile, subject):
     flatpts, flatpolys = db.get_surf(subject, "flat", merge=True, nudge=True)
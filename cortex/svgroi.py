@@ -975,16 +975,15 @@ def scrub(svgfile):
     return svg
 
 def make_svg(pts, polys):
-    from .polyutils import trace_poly, boundary_edges
+    from .polyutils import boundary_loops
     pts = pts.copy()
     pts -= pts.min(0)
     pts *= 1024 / pts.max(0)[1]
     pts[:,1] = 1024 - pts[:,1]
     path = ""
-    polyiter = trace_poly(boundary_edges(polys))
-    for poly in [polyiter.next(), polyiter.next()]:
-        path +="M%f %f L"%tuple(pts[poly.pop(0), :2])
-        path += ', '.join(['%f %f'%tuple(pts[p, :2]) for p in poly])
+    for poly in boundary_loops(polys)[:2]:
+        path +="M%f %f L"%tuple(pts[poly[0], :2])
+        path += ', '.join(['%f %f'%tuple(pts[p, :2]) for p in poly[1:]])
         path += 'Z '
 
     w, h = pts.max(0)[:2]
@@ -0,0 +1,92 @@
+import os
+import json
+import numpy as np
+from cortex import bundle, database
+
+def _subject(tmpdir):
+    """A filestore with subject S2: one surface, a raw anatomical, one transform with
+    a mask, an overlay and a cache file. The surfaces are only in the binary surface
+    cache, which is what the database reads them from."""
+    import nibabel
+    subjdir = tmpdir.mkdir("S2")
+    for dirname in ["surfaces", "views", "cache", "anatomicals"]:
+        subjdir.mkdir(dirname)
+    rand = np.random.RandomState(0)
+    surfs = dict(lh=(rand.rand(10, 3), np.arange(30).reshape(10, 3) % 10),
+                 rh=(rand.rand(12, 3), np.arange(30).reshape(10, 3) % 12))
+    for hemi, (pts, polys) in surfs.items():
+        source = subjdir.join("surfaces", "wm_%s.gii" % hemi)
+        source.write("")
+        database._write_surfcache(str(subjdir.join("cache", "surf_wm_%s.bin" % hemi)),
+                                  str(source), pts, polys)
+    nibabel.Nifti1Image(np.zeros((8, 9, 10), dtype=np.uint8), np.diag([1., 1., 1.5, 1.])
+                        ).to_filename(str(subjdir.join("anatomicals", "raw.nii.gz")))
+    xfmdir = subjdir.mkdir("transforms").mkdir("coord")
+    affine = np.diag([2., 2., 2., 1.])
+    nibabel.Nifti1Image(np.zeros((6, 5, 4), dtype=np.uint8), affine).to_filename(
+        str(xfmdir.join("reference.nii.gz")))
+    xfmdir.join("matrices.xfm").write(json.dumps(dict(coord=np.eye(4).tolist(),
+        magnet=affine.tolist(), shape=[4, 5, 6], affine=affine.tolist())))
+    mask = rand.rand(4, 5, 6) > .5
+    nibabel.Nifti1Image(mask.astype(np.uint8).T, affine).to_filename(
+        str(xfmdir.join("mask_thick.nii.gz")))
+    subjdir.join("rois.svg").write("<svg/>")
+    subjdir.join("cache", "flatmask_1024.npz").write("cached")
+    subjdir.join("cache", "flatmask_1024.npz.lock").write("")
+    return surfs, mask
+
+def test_bundle(tmpdir, monkeypatch):
+    surfs, mask = _subject(tmpdir.mkdir("filestore"))
+    db = database.Database(str(tmpdir.join("filestore")))
+    monkeypatch.setattr(database, "db", db)
+    filename = bundle.pack("S2", str(tmpdir.join("S2.pycx")))
+
+    mounted = database.Database(str(tmpdir.mkdir("empty")))
+    assert mounted.mount(filename) == "S2"
+    try:
+        # Nothing is extracted until it is used
+        scratch = mounted._bundles["S2"].scratch
+        assert not os.path.exists(scratch)
+        assert "S2" in mounted.subjects
+        paths = mounted.get_paths("S2")
+        assert list(paths['surfs']) == ["wm"] and paths['xfms'] == ["coord"]
+        for hemi in ["lh", "rh"]:
+            pts, polys = mounted.get_surf("S2", "wm", hemi)
+            assert pts.dtype == np.float32 and np.allclose(pts, surfs[hemi][0])
+            assert polys.dtype == np.int32 and np.array_equal(polys, surfs[hemi][1])
+
+        xfm = mounted.get_xfm("S2", "coord", "magnet")
+        assert xfm.shape == (4, 5, 6) and np.array_equal(xfm.xfm, np.diag([2., 2., 2., 1.]))
+        assert np.array_equal(xfm.affine, np.diag([2., 2., 2., 1.]))
+        try:
+            xfm.reference_file
+            assert False
+        except IOError:
+            pass
+        assert np.array_equal(mounted.get_mask("S2", "coord", "thick"), mask)
+        assert mounted.find_mask("S2", "coord", mask.sum())[0] == "thick"
+
+        # The subject handles read through the database that mounted the bundle
+        assert np.array_equal(mounted.S2.surfaces.wm.get("lh")[1], surfs['lh'][1])
+        xfmset = mounted.S2.transforms["coord"]
+        assert np.array_equal(xfmset.magnet.xfm, np.diag([2., 2., 2., 1.]))
+        assert np.array_equal(xfmset.masks["thick"], mask)
+
+        # The identity transform comes from the bundled raw anatomical, which is
+        # extracted when it is first read
+        anatfile = os.path.join(scratch, "anatomicals", "raw.nii.gz")
+        assert not os.path.exists(anatfile)
+        assert mounted.get_anat("S2", "raw").shape == (8, 9, 10)
+        assert os.path.exists(anatfile)
+        identity = mounted.get_xfm("S2", "identity")
+        assert identity.shape == (10, 9, 8)
+        assert np.allclose(identity([[1., 1., 3.]]), [[1., 1., 2.]])
+
+        # Files are extracted into the scratch subject directory, without locks
+        with open(paths['rois']) as fp:
+            assert fp.read() == "<svg/>"
+        cached = os.listdir(mounted.get_cache("S2"))
+        assert "flatmask_1024.npz" in cached and "flatmask_1024.npz.lock" not in cached
+    finally:
+        mounted.unmount("S2")
+    assert "S2" not in mounted.subjects and len(mounted._masks) == 0
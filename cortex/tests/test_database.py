@@ -0,0 +1,313 @@
+import os
+import time
+import numpy as np
+from cortex import cache, database
+
+def test_surfcache(tmpdir):
+    source = str(tmpdir.join("fiducial_lh.gii"))
+    with open(source, "w") as fp:
+        fp.write("surface")
+    cachefile = str(tmpdir.join("surf_fiducial_lh.bin"))
+    assert database._read_surfcache(cachefile, source) is None
+
+    pts = np.random.RandomState(0).rand(100, 3)
+    polys = np.random.RandomState(1).randint(100, size=(50, 3))
+    database._write_surfcache(cachefile, source, pts, polys)
+    cpts, cpolys = database._read_surfcache(cachefile, source)
+    assert cpts.dtype == np.float32 and cpolys.dtype == np.int32
+    assert np.allclose(cpts, pts) and np.array_equal(cpolys, polys)
+    assert not cpts.flags.writeable
+
+    # Touching the source invalidates the cache
+    stat = os.stat(source)
+    os.utime(source, (stat.st_atime, stat.st_mtime + 10))
+    assert database._read_surfcache(cachefile, source) is None
+
+def test_surfcache_fallback(tmpdir, monkeypatch):
+    import types
+    import cortex
+    surfdir = tmpdir.mkdir("S2").mkdir("surfaces")
+    tmpdir.join("S2").mkdir("transforms")
+    surfdir.join("wm_lh.gii").write("surface")
+    pts = np.random.RandomState(0).rand(100, 3)
+    polys = np.random.RandomState(1).randint(100, size=(50, 3)).astype(np.uint32)
+    monkeypatch.setattr(cortex, "formats", types.SimpleNamespace(read=lambda name: (pts, polys)),
+                        raising=False)
+
+    def unwritable(*args):
+        raise IOError("read-only filestore")
+    db = database.Database(str(tmpdir))
+    with monkeypatch.context() as m:
+        m.setattr(database, "_write_surfcache", unwritable)
+        fpts, fpolys = db.get_surf("S2", "wm", "lh")
+    assert not os.path.exists(os.path.join(db.get_cache("S2"), "surf_wm_lh.bin"))
+
+    # The cached surface is identical to the one parsed without a cache
+    db = database.Database(str(tmpdir))
+    cpts, cpolys = db.get_surf("S2", "wm", "lh")
+    assert os.path.exists(os.path.join(db.get_cache("S2"), "surf_wm_lh.bin"))
+    for fallback, cached in [(fpts, cpts), (fpolys, cpolys)]:
+        assert fallback.dtype == cached.dtype and np.array_equal(fallback, cached)
+        assert fallback.flags.c_contiguous and not fallback.flags.writeable
+    assert cache.digest(fpts, fpolys) == cache.digest(cpts, cpolys)
+
+def test_path_index(tmpdir, monkeypatch):
+    subjdir = tmpdir.mkdir("S2")
+    for dirname in ["surfaces", "transforms", "views"]:
+        subjdir.mkdir(dirname)
+    surfdir = tmpdir.join("S2", "surfaces")
+    surfdir.join("wm_lh.gii").write("")
+    db = database.Database(str(tmpdir))
+    paths = db.get_paths("S2")
+    assert list(paths['surfs']) == ["wm"]
+    assert paths['surfs']['wm']['lh'] == str(surfdir.join("wm_lh.gii"))
+
+    # Adding a file changes the directory mtime, which rebuilds the index
+    surfdir.join("pia_lh.gii").write("")
+    stat = os.stat(str(surfdir))
+    os.utime(str(surfdir), (stat.st_atime, stat.st_mtime + 10))
+    assert sorted(db.get_paths("S2")['surfs']) == ["pia", "wm"]
+
+    db.write_manifest("S2")
+    database._path_index.clear()
+    assert database.Database(str(tmpdir)).get_paths("S2") == db.get_paths("S2")
+
+    # A failed write keeps the old manifest and leaves no temporary file behind
+    manifest = tmpdir.join("S2", "manifest.json").read()
+    def fail(*args, **kwargs):
+        raise ValueError("not serializable")
+    monkeypatch.setattr(database.json, "dump", fail)
+    try:
+        db.write_manifest("S2")
+    except ValueError:
+        pass
+    assert tmpdir.join("S2", "manifest.json").read() == manifest
+    assert sorted(os.listdir(str(tmpdir.join("S2")))) == ["manifest.json", "surfaces",
+                                                         "transforms", "views"]
+
+def _build(cachefile):
+    with cache.building(cachefile) as build:
+        if build:
+            time.sleep(.2)
+            with cache.atomic_write(cachefile) as fp:
+                np.savez(fp, pid=os.getpid())
+    return int(np.load(cachefile)['pid']), build
+
+def test_cache_building(tmpdir):
+    import multiprocessing as mp
+    cachefile = str(tmpdir.join("flatmask_1024.npz"))
+    pool = mp.Pool(4)
+    try:
+        results = pool.map(_build, [cachefile] * 4)
+    finally:
+        pool.close()
+        pool.join()
+    # One process built the file, and every process read what it built
+    assert sum(build for _, build in results) == 1
+    assert len(set(pid for pid, _ in results)) == 1
+
+    # Failed writes leave neither partial files nor temporary files behind
+    try:
+        with cache.atomic_write(str(tmpdir.join("mask_thick.nii.gz"))) as fp:
+            fp.write(b"partial")
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert os.listdir(str(tmpdir)) == ["flatmask_1024.npz"]
+
+def _increment(counter):
+    for _ in range(50):
+        with cache.lock(counter):
+            with open(counter) as fp:
+                count = int(fp.read())
+            with open(counter, "w") as fp:
+                fp.write(str(count + 1))
+
+def test_cache_lock(tmpdir):
+    import multiprocessing as mp
+    counter = str(tmpdir.join("counter"))
+    with open(counter, "w") as fp:
+        fp.write("0")
+    procs = [mp.Process(target=_increment, args=(counter,)) for _ in range(4)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    # Lock files are removed on release, and a waiter never shares the lock with a
+    # process that made a new lock file
+    with open(counter) as fp:
+        assert int(fp.read()) == 200
+    assert os.listdir(str(tmpdir)) == ["counter"]
+
+def test_cache_eviction(tmpdir, monkeypatch):
+    monkeypatch.setattr(cache, "_touch_interval", 0)
+    cache.manage(str(tmpdir), "1K")
+    def build(name):
+        filename = str(tmpdir.join(name))
+        with cache.building(filename, inputs=dict(name=name)) as build:
+            if build:
+                with cache.atomic_write(filename) as fp:
+                    fp.write(b"\0" * 400)
+        return filename
+
+    first, second = build("a.npz"), build("b.npz")
+    time.sleep(.01)
+    build("a.npz")
+    stats = cache.stats(str(tmpdir))
+    assert stats['size'] == 800 and stats['max_size'] == 1024
+    assert stats['artifacts']['a.npz']['inputs'] == dict(name="a.npz")
+
+    # The least recently used artifact makes room for the new one
+    build("c.npz")
+    assert os.path.exists(first) and not os.path.exists(second)
+    assert sorted(cache.stats(str(tmpdir))['artifacts']) == ["a.npz", "c.npz"]
+    assert sorted(os.listdir(str(tmpdir))) == ["a.npz", "c.npz", cache._manifest_name]
+
+def test_cache_touch(tmpdir, monkeypatch):
+    cache.manage(str(tmpdir), "1K")
+    filename = str(tmpdir.join("a.npz"))
+    with cache.atomic_write(filename) as fp:
+        fp.write(b"\0" * 400)
+    cache.record(filename)
+    accessed = cache.stats(str(tmpdir))['artifacts']['a.npz']['accessed']
+
+    # Hits within the interval do not read the manifest
+    reads = []
+    read_manifest = cache._read_manifest
+    monkeypatch.setattr(cache, "_read_manifest", lambda dirname: reads.append(dirname) or
+                        read_manifest(dirname))
+    for _ in range(10):
+        cache.touch(filename)
+    assert reads == []
+
+    monkeypatch.setattr(cache, "_touch_interval", 0)
+    time.sleep(.01)
+    cache.touch(filename)
+    assert len(reads) == 1
+    assert cache.stats(str(tmpdir))['artifacts']['a.npz']['accessed'] > accessed
+
+    # Without a budget nothing is evicted, so hits do not need the manifest at all
+    cache.manage(str(tmpdir), 0)
+    del reads[:]
+    cache.touch(filename)
+    assert reads == []
+
+def test_input_digest(tmpdir, monkeypatch):
+    pts = np.arange(12.).reshape(4, 3)
+    assert cache.digest(pts, dict(a=1, b=2)) == cache.digest(pts.copy(), dict(b=2, a=1))
+    assert cache.digest(pts) != cache.digest(pts.astype(np.float32))
+    assert cache.digest(["ab", "c"]) != cache.digest(["a", "bc"])
+    assert cache.digest(np.float64(2.), np.int64(3), np.bool_(True)) == cache.digest(2., 3, True)
+
+    db = database.Database(str(tmpdir))
+    surfs = dict(flat=((pts, None), (pts, None)))
+    def get_surf(subject, type):
+        if type not in surfs:
+            raise IOError
+        return surfs[type]
+    monkeypatch.setattr(db, "get_surf", get_surf)
+    svgfile = tmpdir.join("rois.svg")
+    svgfile.write("<svg/>")
+    digest = db._input_digest("S1", ["flat", "pia"], files=[str(svgfile)], height=1024)
+    assert digest == db._input_digest("S1", ["flat", "pia"], files=[str(svgfile)], height=1024)
+    assert digest != db._input_digest("S1", ["flat", "pia"], files=[str(svgfile)], height=512)
+
+    # Changed file contents change the digest
+    svgfile.write("<svg></svg>")
+    stat = os.stat(str(svgfile))
+    os.utime(str(svgfile), (stat.st_atime, stat.st_mtime + 10))
+    assert digest != db._input_digest("S1", ["flat", "pia"], files=[str(svgfile)], height=1024)
+
+def test_surf_digest(tmpdir):
+    surfdir = tmpdir.mkdir("S2").mkdir("surfaces")
+    tmpdir.join("S2").mkdir("transforms")
+    db = database.Database(str(tmpdir))
+    def write(pts, mtime):
+        for hemi in ["lh", "rh"]:
+            source = str(surfdir.join("wm_%s.gii" % hemi))
+            with open(source, "w") as fp:
+                fp.write("surface")
+            os.utime(source, (mtime, mtime))
+            database._write_surfcache(os.path.join(db.get_cache("S2"), "surf_wm_%s.bin" % hemi),
+                                      source, pts, np.array([[0, 1, 2]]))
+    pts = np.random.RandomState(0).rand(3, 3)
+    write(pts, 1000)
+    digest = db._surf_digest("S2", "wm")
+    assert np.allclose(db.get_surf("S2", "wm", "lh")[0], pts)
+
+    # Replacing the surface files under a running process changes the surfaces and
+    # their digest
+    write(pts * 2, 2000)
+    assert np.allclose(db.get_surf("S2", "wm", "lh")[0], pts * 2)
+    assert db._surf_digest("S2", "wm") != digest
+
+def test_mask_index(tmpdir, monkeypatch):
+    import nibabel
+    xfmdir = tmpdir.mkdir("S2").mkdir("transforms").mkdir("coord")
+    for dirname in ["surfaces", "views"]:
+        tmpdir.join("S2").mkdir(dirname)
+    rand = np.random.RandomState(0)
+    masks = dict(thick=rand.rand(4, 5, 6) > .5, thin=rand.rand(4, 5, 6) > .8)
+    for name, mask in masks.items():
+        fname = str(xfmdir.join("mask_%s.nii.gz" % name))
+        nibabel.Nifti1Image(mask.astype(np.uint8).T, np.eye(4)).to_filename(fname)
+
+    db = database.Database(str(tmpdir))
+    mask = db.get_mask("S2", "coord", "thick")
+    assert np.array_equal(mask, masks['thick']) and not mask.flags.writeable
+    assert db.get_mask("S2", "coord", "thick") is mask
+    name, found = db.find_mask("S2", "coord", masks['thin'].sum())
+    assert name == "thin" and np.array_equal(found, masks['thin'])
+
+    # Only the most recently used masks are kept decoded
+    monkeypatch.setattr(database, "_mask_cache_size", 1)
+    db.get_mask("S2", "coord", "thin")
+    assert len(db._masks) == 1
+    again = db.get_mask("S2", "coord", "thick")
+    assert again is not mask and np.array_equal(again, mask)
+    monkeypatch.undo()
+
+    # A new database reads the index from the cache, without decoding any NIfTI
+    def load(fname):
+        raise AssertionError("decoded %s" % fname)
+    monkeypatch.setattr(nibabel, "load", load)
+    db = database.Database(str(tmpdir))
+    assert np.array_equal(db.get_mask("S2", "coord", "thin"), masks['thin'])
+    try:
+        db.find_mask("S2", "coord", 1)
+        assert False
+    except ValueError:
+        pass
+
+def test_xfm_cache(tmpdir, monkeypatch):
+    import json
+    import nibabel
+    xfmdir = tmpdir.mkdir("S2").mkdir("transforms").mkdir("coord")
+    affine = np.diag([2., 2., 2., 1.])
+    nibabel.Nifti1Image(np.zeros((6, 5, 4), dtype=np.uint8), affine).to_filename(
+        str(xfmdir.join("reference.nii.gz")))
+    xfmdir.join("matrices.xfm").write(json.dumps(dict(coord=np.eye(4).tolist(),
+        magnet=affine.tolist(), shape=[4, 5, 6], affine=affine.tolist())))
+
+    loads = []
+    nibload = nibabel.load
+    def load(fname):
+        loads.append(fname)
+        return nibload(fname)
+    monkeypatch.setattr(nibabel, "load", load)
+
+    db = database.Database(str(tmpdir))
+    xfm = db.get_xfm("S2", "coord")
+    assert db.get_xfm("S2", "coord") is xfm
+    assert xfm.shape == (4, 5, 6) and np.array_equal(xfm.affine, affine)
+    assert xfm.inv.shape == (4, 5, 6) and not xfm.xfm.flags.writeable
+    assert xfm.reference_file == str(xfmdir.join("reference.nii.gz"))
+    assert loads == []
+    assert xfm.reference.shape == (6, 5, 4) and len(loads) == 1
+
+    # Changing the matrices reads the transform again
+    xfmdir.join("matrices.xfm").write(json.dumps(dict(coord=(2*np.eye(4)).tolist(),
+        magnet=affine.tolist(), shape=[4, 5, 6], affine=affine.tolist())))
+    stat = os.stat(str(xfmdir.join("matrices.xfm")))
+    os.utime(str(xfmdir.join("matrices.xfm")), (stat.st_atime, stat.st_mtime + 10))
+    assert np.array_equal(db.get_xfm("S2", "coord").xfm, 2*np.eye(4))
@@ -1,3 +1,4 @@
+import os
 import numpy as np
 from cortex import polyutils
 
@@ -16,3 +17,250 @@ def test_surfpatch():
     subwm, subpia, subpolys = surf.extract_chunk(auxpts=pia)
     subsurf = polyutils.Surface(subwm, subpolys)
     return [patch for patch in subsurf.patches(n=0.5)]
+
+def _grid(n=20):
+    idx = np.arange(n*n).reshape(n, n)
+    a, b = idx[:-1,:-1].ravel(), idx[1:,:-1].ravel()
+    c, d = idx[1:,1:].ravel(), idx[:-1,1:].ravel()
+    pts = np.vstack([np.mgrid[:n,:n].reshape(2, -1), np.zeros((1, n*n))]).T
+    polys = np.vstack([np.array([a, b, c]).T, np.array([a, c, d]).T])
+    return pts, polys
+
+def test_boundary_loops():
+    pts, polys = _grid()
+    # punch a hole in the middle of the grid
+    corner = polys.min(1)
+    hole = np.logical_and(np.logical_and(corner // 20 > 5, corner // 20 < 10),
+                          np.logical_and(corner % 20 > 5, corner % 20 < 10))
+    polys = polys[~hole]
+    edges = polyutils.boundary_edges(polys)
+    loops = polyutils.boundary_loops(polys)
+    assert [len(loop) for loop in loops] == [76, 16]
+    assert sum(len(loop) for loop in loops) == len(edges)
+    edgeset = set(map(tuple, np.sort(edges, 1)))
+    for loop in loops:
+        steps = np.sort(np.array([loop, np.roll(loop, -1)]).T, 1)
+        assert set(map(tuple, steps)) == edgeset & set(map(tuple, steps))
+
+    undirected = polyutils.trace_loops(np.sort(edges, 1))
+    assert [loop[0] for loop in undirected] == [loop[0] for loop in loops]
+    poly = next(polyutils.trace_poly(edges))
+    assert poly[0] == poly[-1]
+
+def test_boundary_loops_degenerate():
+    empty = np.zeros((0, 3), dtype=np.int64)
+    assert polyutils.boundary_edges(empty).shape == (0, 2)
+    assert polyutils.boundary_loops(empty) == []
+
+    # Two triangles that only share vertex 0 form a bowtie on the boundary
+    polys = np.array([[0, 1, 2], [0, 3, 4]])
+    edges = polyutils.boundary_edges(polys)
+    for loops in [polyutils.trace_loops(edges), polyutils.trace_loops(np.sort(edges, 1)),
+                  polyutils.trace_loops(np.sort(edges, 1)[::-1])]:
+        assert [loop.tolist() for loop in loops] == [[0, 1, 2], [0, 3, 4]]
+    try:
+        polyutils.trace_loops(np.array([[0, 1], [1, 2]]))
+        assert False
+    except ValueError:
+        pass
+
+def test_batch_patches():
+    pts, polys = _grid(8)
+    pts[:,2] = np.random.rand(len(pts))
+    surf = polyutils.Surface(pts, polys)
+    for n in [1, 0.5]:
+        offsets, tris = surf.batch_patches(n=n)
+        for i, patch in enumerate(surf.patches(n=n)):
+            assert np.allclose(tris[offsets[i]:offsets[i+1]], patch)
+
+def test_batch_polyhedra():
+    pts, polys = _grid(8)
+    wm = pts - [0, 0, 1]
+    surf = polyutils.Surface(pts, polys)
+    ptoffsets, allpts, trioffsets, alltris = surf.batch_polyhedra(wm)
+    corners = lambda tris: sorted(tuple(sorted(map(tuple, tri.round(6)))) for tri in tris)
+    for i, (ppts, ptris) in enumerate(surf.polyhedra(wm)):
+        tris = alltris[trioffsets[i]:trioffsets[i+1]]
+        assert ((tris >= ptoffsets[i]) & (tris < ptoffsets[i+1])).all()
+        assert corners(allpts[tris]) == corners(ppts[ptris])
+
+def test_voxelize():
+    pts, polys = polyutils.make_cube((10, 10, 10), 6)
+    vox = polyutils.voxelize(pts, polys, shape=(20, 21, 22), center=(0, 0, 0))
+    assert vox.shape == (20, 21, 22)
+    assert vox.sum() == 6**3
+    assert vox[8:14, 8:14, 8:14].all()
+
+def test_submesh():
+    pts, polys = _grid(10)
+    surf = polyutils.Surface(pts, polys)
+    mask = pts[:,0] < 4.5
+    subpts, subpolys, forward, inverse = surf.submesh(mask)
+    assert len(subpts) == mask.sum() and np.allclose(subpts, pts[mask])
+    assert len(subpolys) == 2 * 4 * 9
+    assert np.array_equal(forward[inverse], np.arange(len(inverse)))
+    assert np.array_equal(inverse[subpolys], polys[mask[polys].all(1)])
+
+    dpts, dpolys = polyutils.deduplicate(np.vstack([pts, pts]), polys + len(pts))
+    assert np.allclose(dpts, pts) and np.array_equal(dpolys, polys)
+
+def test_gradient_operator():
+    pts, polys = _grid(10)
+    surf = polyutils.Surface(pts, polys)
+    fields = np.array([pts[:,0], 2 * pts[:,1], pts[:,0] - pts[:,1]]).T
+    grad = surf.surface_gradient(fields, at_verts=False)
+    assert grad.shape == (len(polys), 3, 3)
+    assert np.allclose(grad[:,:,1], [0, 2, 0])
+    assert np.allclose(grad[:,:,2], surf.surface_gradient(fields[:,2], at_verts=False))
+    assert np.allclose(surf.surface_gradient(fields)[:,:,0], [1, 0, 0])
+    # The integrated divergence of a gradient is the cotangent laplacian
+    B, D, W, V = surf.laplace_operator
+    div = surf.divergence_operator.dot(surf.gradient_operator.dot(fields[:,2]))
+    assert np.allclose(div, (W - V).dot(fields[:,2]))
+
+def test_laplace_eigenbasis():
+    pts, polys = _grid(12)
+    surf = polyutils.Surface(pts, polys)
+    evals, evecs = surf.laplace_eigenbasis(k=10)
+    B, D, W, V = surf.laplace_operator
+    assert np.allclose(evecs.T.dot(D[:,np.newaxis] * evecs), np.eye(10))
+    assert np.allclose(evals[0], 0) and (np.diff(evals) >= 0).all()
+
+    maps = evecs[:,[2, 7]].dot([[1, 2], [3, 4]])
+    assert np.allclose(surf.spectral_coefficients(maps, 10)[[2, 7]], [[1, 2], [3, 4]])
+    assert np.allclose(surf.bandpass(maps, high=evals[5], k=10), np.outer(evecs[:,2], [1, 2]))
+    smoothed = surf.heat_smooth(evecs[:,7], t=2., k=10)
+    assert np.allclose(smoothed, np.exp(-2 * evals[7]) * evecs[:,7])
+
+def test_laplace_eigenbasis_cache(tmpdir):
+    pts, polys = _grid(12)
+    cachefile = str(tmpdir.join("eigenbasis.npz"))
+    evals, _ = polyutils.Surface(pts, polys).laplace_eigenbasis(k=5, cachefile=cachefile)
+    assert np.allclose(polyutils.Surface(pts, polys).laplace_eigenbasis(5, cachefile)[0], evals)
+
+    # A different mesh with the same number of vertices does not reuse the cache
+    stretched = pts * [2, 1, 1]
+    sevals, _ = polyutils.Surface(stretched, polys).laplace_eigenbasis(k=5, cachefile=cachefile)
+    assert not np.allclose(sevals, evals)
+    assert np.allclose(polyutils.Surface(stretched, polys).laplace_eigenbasis(5)[0], sevals)
+
+def test_aabb_tree():
+    from cortex.aabb import closest_on_triangles
+    pts, polys = polyutils.make_cube((10, 10, 10), 6)
+    tree = polyutils.Surface(pts, polys).aabb_tree
+
+    query = np.random.RandomState(0).uniform(0, 20, size=(200, 3))
+    dist, faces, bary = tree.closest_point(query)
+    tris = pts[polys]
+    brute = closest_on_triangles(np.repeat(query, len(polys), 0), np.tile(tris, (len(query), 1, 1)))
+    brute = (brute[:,:,np.newaxis] * np.tile(tris, (len(query), 1, 1))).sum(1)
+    brute = np.sqrt(((brute - np.repeat(query, len(polys), 0))**2).sum(1)).reshape(len(query), -1)
+    assert np.allclose(dist, brute.min(1))
+    closest = (bary[:,:,np.newaxis] * tris[faces]).sum(1)
+    assert np.allclose(np.sqrt(((closest - query)**2).sum(1)), dist)
+
+    inside = np.abs(query - 10).max(1) < 3
+    assert np.all(tree.contains(query) == inside)
+
+    t, faces, bary = tree.intersect([[10, 10, 10], [10, 10, 20]], [0, 0, 1])
+    assert np.allclose(t, [3, np.inf])
+    assert faces[1] == -1
+
+def test_biharmonic_interp():
+    pts, polys = _grid(30)
+    surf = polyutils.Surface(pts, polys)
+    knots = np.random.RandomState(0).choice(len(pts), 20, replace=False)
+    vals = np.random.RandomState(1).randn(2, 20)
+    phi = surf.interp(knots, vals)
+    assert phi.shape == (len(pts), 2)
+    assert np.allclose(phi[knots], vals.T)
+
+    # Solvers are cached by knot set, regardless of order
+    lhs, D, Dinv, lhsfac, notb = surf._create_biharmonic_solver(knots[::-1])
+    assert len(surf._bh_solvers) == 1
+    assert np.allclose(lhs[notb].dot(phi), 0)
+    assert np.allclose(surf.interp(knots[::-1], vals[1,::-1])[:,0], phi[:,1])
+
+def test_compact_surface(tmpdir):
+    pts, polys = polyutils.make_cube((10, 10, 10), 6)
+    surf = polyutils.Surface(pts, polys, compact=True)
+    assert surf.pts.dtype == np.float32 and surf.polys.dtype == np.int32
+    assert surf.face_normals.dtype == np.float32
+    assert surf.vertex_normals.dtype == np.float32
+
+    prefix = str(tmpdir.join("cube"))
+    surf.save(prefix)
+    mapped = polyutils.Surface.load(prefix, compact=True)
+    assert isinstance(mapped.pts.base, np.memmap)
+    assert np.allclose(mapped.face_areas, polyutils.Surface(pts, polys).face_areas)
+
+def test_geodesic_neighborhoods(tmpdir):
+    pts, polys = _grid(15)
+    surf = polyutils.Surface(pts, polys)
+    cachefile = str(tmpdir.join("hoods.npz"))
+    hoods = surf.geodesic_neighborhoods(3, cachefile=cachefile, chunksize=40)
+    assert len(hoods) == len(pts)
+    # On a flat mesh, geodesic distance is Euclidean distance
+    for vert in [0, 7, 112]:
+        nbrs, dists = hoods[vert]
+        eucl = np.sqrt(((pts - pts[vert])**2).sum(1))
+        assert set(nbrs) == set(np.nonzero(eucl <= 3)[0])
+        assert np.allclose(dists, eucl[nbrs])
+
+    cached = surf.geodesic_neighborhoods(3, cachefile=cachefile)
+    assert np.all(cached.indptr == hoods.indptr)
+    centers, idx, nbrs, dists = next(cached.batches(10))
+    assert np.all(nbrs == hoods.indices[:hoods.indptr[10]])
+
+    # Moving the vertices invalidates the cache
+    stretched = polyutils.Surface(pts * [2, 1, 1], polys).geodesic_neighborhoods(3, cachefile)
+    assert stretched.sizes.sum() < hoods.sizes.sum()
+
+def test_decimate():
+    pts, polys = _grid(30)
+    pts[:,2] = np.sin(pts[:,0] / 5.)
+    dpts, dpolys, kept = polyutils.decimate(pts, polys, reduction=0.8, return_map=True)
+    assert len(dpts) == int(round(len(pts) * 0.2))
+    assert np.all(dpts == pts[kept])
+    # Boundaries are kept exactly
+    border = np.unique(polyutils.boundary_edges(polys))
+    assert np.all(kept[np.unique(polyutils.boundary_edges(dpolys))] == border)
+    # Every directed edge appears once, so the result is a consistently oriented manifold
+    edges = np.vstack([dpolys[:,[0, 1]], dpolys[:,[1, 2]], dpolys[:,[2, 0]]])
+    assert len(np.unique(edges, axis=0)) == len(edges)
+
+def test_spring_layout():
+    from cortex.freesurfer import SpringLayout
+    pts, polys = _grid(10)
+    pts = np.asarray(pts, dtype=float)
+    for dtype in (np.float64, np.float32):
+        layout = SpringLayout(pts * 1.1, polys, dpts=pts, stepsize=.5, neighborhood=1,
+            dtype=dtype)
+        assert layout.pts.dtype == dtype
+        assert layout.run(5000, tol=1e-4) < 5000
+        lengths = np.sqrt((layout._diff.dot(layout.pts)**2).sum(1))
+        assert np.allclose(lengths, layout._dists, atol=1e-2)
+    assert (layout._idx != layout._neigh).all()
+
+    # With every vertex pinned nothing moves, which counts as converged
+    layout = SpringLayout(pts, polys, pins=np.arange(len(pts)))
+    assert layout.run(10, tol=1e-4) == 1
+
+def test_get_searchlights(tmpdir, monkeypatch):
+    from cortex import utils
+    pts, polys = _grid(10)
+    surfs = dict(fiducial=((pts, polys), (pts, polys)))
+    monkeypatch.setattr(utils.db, "get_surf", lambda subject, type: surfs[type])
+    monkeypatch.setattr(utils.db, "get_cache", lambda subject: str(tmpdir))
+    monkeypatch.setattr(utils.db, "_memocache", dict())
+    left, right = utils.get_searchlights("S1", 2)
+    names = sorted(os.listdir(str(tmpdir)))
+    assert len([n for n in names if n.endswith(".npz")]) == 2
+    cached, _ = utils.get_searchlights("S1", 2)
+    assert np.array_equal(cached.indices, left.indices)
+
+    # A changed surface gets new cache files, once its digest is computed again
+    surfs['fiducial'] = ((pts * 2, polys), (pts * 2, polys))
+    utils.db._memocache.clear()
+    utils.get_searchlights("S1", 2)
+    assert len([n for n in os.listdir(str(tmpdir)) if n.endswith(".npz")]) == 4
@@ -0,0 +1,38 @@
+import numpy as np
+from cortex import polyutils, stats
+
+from .test_polyutils import _grid
+
+def test_cluster_labels():
+    pts, polys = _grid(10)
+    surf = polyutils.Surface(pts, polys)
+    stat = np.zeros((len(pts), 2))
+    stat[[0, 1, 10, 99], 0] = 3
+    stat[[50, 51], 1] = 3
+    labels, extent = stats.clusters(stat, surf, 2)
+    assert labels[0, 0] == labels[1, 0] == labels[10, 0] != labels[99, 0]
+    assert labels[50, 1] == labels[51, 1] != labels[0, 0]
+    assert (labels >= 0).sum() == 6
+    areas = stats.vertex_areas(surf)
+    assert np.isclose(areas.sum(), surf.face_areas.sum())
+    assert np.isclose(extent[labels[0, 0]], areas[[0, 1, 10]].sum())
+
+def test_tfce_batch():
+    pts, polys = _grid(20)
+    surf = polyutils.Surface(pts, polys)
+    stat = np.random.RandomState(0).randn(len(pts), 3)
+    batch = stats.tfce(stat, surf, tail=0)
+    single = np.array([stats.tfce(s, surf, tail=0) for s in stat.T]).T
+    assert np.allclose(batch, single)
+    nonzero = batch != 0
+    assert np.all(np.sign(batch[nonzero]) == np.sign(stat[nonzero]))
+
+def test_permutation_test():
+    pts, polys = _grid(20)
+    surf = polyutils.Surface(pts, polys)
+    data = np.random.RandomState(0).randn(10, len(pts))
+    data[:, :60] += 2
+    stat, pvals, null = stats.permutation_test(data, surf, n_perm=100, batch=30, seed=0)
+    assert null.shape == (100,)
+    assert pvals[:60].max() < 0.05
+    assert pvals[100:].min() > 0.05
@@ -0,0 +1,56 @@
+import os
+import numpy as np
+from scipy.spatial import ConvexHull
+from cortex import surfinfo
+
+def _sphere(npt=500):
+    pts = np.random.RandomState(0).randn(npt, 3)
+    pts /= np.sqrt((pts**2).sum(1))[:,np.newaxis]
+    return pts * 50, ConvexHull(pts).simplices
+
+def test_generate(tmpdir, monkeypatch):
+    pts, polys = _sphere()
+    surfs = dict(fiducial=pts, wm=pts * .95, pia=pts, flat=pts * 1.1)
+    monkeypatch.setattr(surfinfo.db, "get_surf",
+        lambda subject, type, hem: (surfs[type], polys))
+    monkeypatch.setattr(surfinfo.db, "_surfinfo_file",
+        lambda subject, type, kwargs: str(tmpdir.join("%s%s.npz" % (type, sorted(kwargs.items())))))
+
+    files = surfinfo.generate("S1", n_jobs=1)
+    assert len(files) == 5 and all(os.path.exists(f) for f in files)
+    assert surfinfo.generate("S1", n_jobs=1) == []
+
+    parallel = surfinfo.generate("S1", n_jobs=2, recache=True)
+    assert parallel == files
+    thick = np.load(files[1])
+    assert np.allclose(thick['left'], 2.5) and np.allclose(thick['right'], 2.5)
+    areal = np.load(files[2])['left']
+    assert np.allclose(areal, 2 * np.log2(1.1), atol=.05)
+    assert np.allclose(np.load(files[4])['left'], 0)
+
+def test_tissots_indicatrix(tmpdir, monkeypatch):
+    pts, polys = _sphere(2000)
+    monkeypatch.setattr(surfinfo.db, "get_surf", lambda subject, type, hem: (pts, polys))
+    outfile = str(tmpdir.join("tissots.npz"))
+    surfinfo.tissots_indicatrix(outfile, "S1", radius=5, spacing=20,
+                                rng=np.random.RandomState(0))
+    saved = np.load(outfile, allow_pickle=True)
+
+    surf = surfinfo.polyutils.Surface(pts, polys)
+    centers = saved['centers'][0]
+    idx, dists = surf.geodesic_within(centers, 20)
+    # Centers are spread out and together cover the whole surface. Propagated
+    # distances are not symmetric, so only check each center against later ones.
+    assert len(idx) == len(pts)
+    for i, center in enumerate(centers):
+        near, _ = surf.geodesic_within([center], 20)
+        assert len(np.intersect1d(near, centers[i+1:])) == 0
+    assert np.array_equal(np.nonzero(saved['left'])[0], idx[dists < 5])
+
+    # The distance buffer is reset between centers, so reusing it changes nothing
+    buffer = np.full((len(pts),), np.inf)
+    for center in centers[:5]:
+        near, ndist = surf.geodesic_within([center], 20, buffer=buffer)
+        expect, edist = surf.geodesic_within([center], 20)
+        assert np.array_equal(near, expect) and np.array_equal(ndist, edist)
+        assert np.isinf(buffer).all()
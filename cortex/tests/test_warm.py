@@ -0,0 +1,60 @@
+import os
+import time
+from cortex import warm
+
+def _build(logdir, name, fail=False):
+    time.sleep(.05)
+    if fail:
+        raise IOError("no overlay")
+    with open(os.path.join(logdir, name), "w") as fp:
+        fp.write(repr(time.time()))
+
+def test_warm(tmpdir, monkeypatch):
+    logdir = str(tmpdir)
+    def tasks(subject, xfms, height, sampler, types, recache):
+        return dict(
+            flatmask=(_build, (logdir, "flatmask"), ()),
+            curvature=(_build, (logdir, "curvature"), ()),
+            flatpixel=(_build, (logdir, "flatpixel"), ("flatmask",)),
+            overlay=(_build, (logdir, "overlay", True), ()),
+            ctmpack=(_build, (logdir, "ctmpack"), ("curvature", "overlay")))
+    monkeypatch.setattr(warm, "_tasks", tasks)
+
+    for n_jobs in [1, 3]:
+        for name in os.listdir(logdir):
+            os.unlink(os.path.join(logdir, name))
+        timings, errors = warm.warm("S1", [], n_jobs=n_jobs)
+        assert sorted(timings) == ["curvature", "flatmask", "flatpixel"]
+        assert sorted(errors) == ["ctmpack", "overlay"]
+        assert "overlay" in errors['ctmpack']
+        assert sorted(os.listdir(logdir)) == ["curvature", "flatmask", "flatpixel"]
+        built = dict((name, float(tmpdir.join(name).read())) for name in timings)
+        assert built['flatpixel'] > built['flatmask']
+
+def _die(logdir, name):
+    time.sleep(.05)
+    os._exit(1)
+
+def test_warm_dead_worker(tmpdir, monkeypatch):
+    logdir = str(tmpdir)
+    def tasks(subject, xfms, height, sampler, types, recache):
+        return dict(
+            flatmask=(_build, (logdir, "flatmask"), ()),
+            curvature=(_build, (logdir, "curvature"), ()),
+            mapper=(_die, (logdir, "mapper"), ("flatmask", "curvature")),
+            flatpixel=(_build, (logdir, "flatpixel"), ("mapper",)))
+    monkeypatch.setattr(warm, "_tasks", tasks)
+
+    # The worker that dies fails its artifact instead of leaving warm waiting for it
+    timings, errors = warm.warm("S1", [], n_jobs=2)
+    assert sorted(timings) == ["curvature", "flatmask"]
+    assert sorted(errors) == ["flatpixel", "mapper"]
+    assert "BrokenProcessPool" in errors['mapper'] and "mapper" in errors['flatpixel']
+
+def test_warm_tasks():
+    tasks = warm._tasks("S1", ["fullhead"], 1024, "nearest", ("inflated",), False)
+    # Artifacts wait for the artifacts they read, so no two workers build the same one
+    assert sorted(tasks["flatpixel:fullhead"][2]) == ["flatmask", "mapper:fullhead"]
+    assert sorted(tasks["ctmpack"][2]) == ["curvature", "flatmask"]
+    for name, (func, args, deps) in tasks.items():
+        assert all(dep in tasks for dep in deps)
@@ -3,6 +3,7 @@ import os
 import binascii
 import numpy as np
 from importlib import import_module
+from . import cache
 from .database import db
 from .volume import mosaic, unmask, anat2epispace
 from .options import config
@@ -37,30 +38,37 @@ def get_ctmpack(subject, types=("inflated",), method="raw", level=0, recache=Fal
     between surfaces, (3) the display layers to include (rois, sulci, etc)
     """   
     lvlstr = ("%dd" if decimate else "%d")%level
+    # The pack is named by the surfaces, overlays and options it is made from. The
+    # curvature comes from the fiducial surface, and extra_disp from its svg file.
+    surfaces = ["fiducial", "flat", "pia", "wm"] + [t for t in types if t not in ("fiducial", "flat", "pia", "wm")]
+    svgfiles = [db.get_paths(subject)['rois']]
+    if extra_disp is not None:
+        svgfiles.append(extra_disp[0])
+    digest = db._input_digest(subject, surfaces, files=svgfiles, types=list(types),
+                              method=method, level=level, decimate=decimate,
+                              disp_layers=sorted(disp_layers),
+                              extra_layers=None if extra_disp is None else list(extra_disp[1]))
     # Generates different cache files for each combination of disp_layers
-    ctmcache = "%s_[{types}]_{method}_{level}_{layers}{extra}.json"%subject
-    # Mark any ctm file containing extra_disp as unique (will be over-written every time)
+    ctmcache = "%s_[{types}]_{method}_{level}_{layers}_{digest}.json"%subject
     ctmcache = ctmcache.format(types=','.join(types),
                                method=method,
                                level=lvlstr,
                                layers=repr(sorted(disp_layers)),
-                               extra='' if extra_disp is None else '_xx')
+                               digest=digest[:16])
     ctmfile = os.path.join(db.get_cache(subject), ctmcache)
 
-    if os.path.exists(ctmfile) and not recache: # and extra_disp is None:
-        # (never load cache with extra_disp, which is based on files outside pycortex)
-        return ctmfile
-
-    print("Generating new ctm file...")
-    from . import brainctm
-    ptmap = brainctm.make_pack(ctmfile,
-                               subject,
-                               types=types,
-                               method=method, 
-                               level=level,
-                               decimate=decimate,
-                               disp_layers=disp_layers,
-                               extra_disp=extra_disp)
+    with cache.building(ctmfile, recache, inputs=dict(subject=subject, digest=digest)) as build:
+        if build:
+            print("Generating new ctm file...")
+            from . import brainctm
+            ptmap = brainctm.make_pack(ctmfile,
+                                       subject,
+                                       types=types,
+                                       method=method, 
+                                       level=level,
+                                       decimate=decimate,
+                                       disp_layers=disp_layers,
+                                       extra_disp=extra_disp)
     return ctmfile
 
 def get_ctmmap(subject, **kwargs):
@@ -102,7 +110,7 @@ def get_cortical_mask(subject, xfmname, type='nearest'):
         return get_mapper(subject, xfmname, type=type).mask
 
 
-def get_vox_dist(subject, xfmname, surface="fiducial", max_dist=np.inf):
+def get_vox_dist(subject, xfmname, surface="fiducial", max_dist=np.inf, exact=False):
     """Get the distance (in mm) from each functional voxel to the closest
     point on the surface.
 
@@ -118,6 +126,10 @@ def get_vox_dist(subject, xfmname, surface="fiducial", max_dist=np.inf):
         Limit computation to only voxels within `max_dist` mm of the surface.
         Makes computation orders of magnitude faster for high-resolution 
         volumes.
+    exact : bool, optional
+        If True, measure the distance to the closest point on the surface
+        triangles rather than to the closest vertex. `argdist` is then the
+        corner of the closest triangle with the largest barycentric weight.
 
     Returns
     -------
@@ -135,12 +147,51 @@ def get_vox_dist(subject, xfmname, surface="fiducial", max_dist=np.inf):
     idx = np.mgrid[:x, :y, :z].reshape(3, -1).T
     mm = xfm.inv(idx)
 
-    tree = cKDTree(fiducial)
-    dist, argdist = tree.query(mm, distance_upper_bound=max_dist)
+    if exact:
+        from .polyutils import Surface
+        dist, faces, bary = Surface(fiducial, polys).aabb_tree.closest_point(mm, max_dist=max_dist)
+        argdist = np.where(faces >= 0, polys[faces, bary.argmax(1)], len(fiducial))
+    else:
+        tree = cKDTree(fiducial)
+        dist, argdist = tree.query(mm, distance_upper_bound=max_dist)
     dist.shape = (x,y,z)
     argdist.shape = (x,y,z)
     return dist.T, argdist.T
 
+def get_searchlights(subject, radius, surface="fiducial"):
+    """Get the geodesic neighborhood of every vertex, for surface searchlights.
+    Neighborhoods are computed once per surface and radius, then loaded from the
+    subject's cache. Cache files are named by the surface they were computed on.
+
+    Parameters
+    ----------
+    subject : str
+        Name of the subject
+    radius : float
+        Searchlight radius (mm)
+    surface : str, optional
+        Surface to measure geodesic distances on
+
+    Returns
+    -------
+    left, right : polyutils.Neighborhoods
+        Neighborhoods for each hemisphere. Vertex indices are within the
+        hemisphere; add the number of left vertices to index merged data.
+    """
+    from .polyutils import Surface, Neighborhoods
+    digest = db._input_digest(subject, [surface], radius=radius)
+    hoods = []
+    for hemi, (pts, polys) in zip(["lh", "rh"], db.get_surf(subject, surface)):
+        cachefile = os.path.join(db.get_cache(subject), "searchlight_%s_%s_%gmm_%s.npz" % (
+            surface, hemi, radius, digest[:16]))
+        inputs = dict(subject=subject, surface=surface, radius=radius, digest=digest)
+        with cache.building(cachefile, inputs=inputs) as build:
+            if build:
+                hoods.append(Surface(pts, polys).geodesic_neighborhoods(radius, cachefile=cachefile))
+        if not build:
+            hoods.append(Neighborhoods.from_cache(cachefile))
+    return tuple(hoods)
+
 def get_hemi_masks(subject, xfmname, type='nearest'):
     '''Returns a binary mask of the left and right hemisphere
     surface voxels for the given subject.
@@ -395,7 +446,8 @@ def get_dropout(subject, xfmname, power=20):
     is very low.
     """
     xfm = db.get_xfm(subject, xfmname)
-    rawdata = xfm.reference.get_data().T
+    import nibabel
+    rawdata = np.asarray(nibabel.load(xfm.reference_file).dataobj).T
 
     ## Collapse epi across time if it's 4D
     if rawdata.ndim > 3:
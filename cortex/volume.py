@@ -280,7 +280,7 @@ def epi2anatspace_fsl(volumedata):
             xfmh.write(" ".join(["%0.5f"%f for f in ll])+"\n")
 
     ## Save out data into nifti file
-    datafile = nibabel.Nifti1Image(data.T, xfm.reference.get_affine(), xfm.reference.get_header())
+    datafile = nibabel.Nifti1Image(data.T, xfm.affine)
     datafilename = tempfile.mktemp(".nii")
     nibabel.save(datafile, datafilename)
 
@@ -328,7 +328,7 @@ def anat2epispace_fsl(data,subject,xfmname):
     nibabel.save(datafile, datafilename)
 
     ## Reslice epi-space image
-    epiNIIf = xfm.reference.get_filename()
+    epiNIIf = xfm.reference_file
     outfilename = tempfile.mktemp(".nii")
     subprocess.call(["fsl5.0-flirt",
                      "-in", datafilename,
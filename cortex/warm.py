@@ -0,0 +1,178 @@
+"""Prebuild the derived caches of a subject, so that interactive use afterwards only
+hits the cache.
+
+The first quickflat or webshow of a new subject or transform otherwise builds the
+curvature, flatmap caches, mappers and ctm pack one after another. Here they are built
+as a dependency graph in a process pool: every artifact starts as soon as the artifacts
+it reads are done, and independent ones are built at the same time. From the shell::
+
+    python -m cortex.warm S1 fullhead -j 4
+"""
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from .database import db
+
+def _curvature(subject, recache):
+    db.get_surfinfo(subject, "curvature", recache=recache)
+
+def _flatmask(subject, height, recache):
+    from . import quickflat
+    quickflat.get_flatmask(subject, height=height, recache=recache)
+
+def _flatverts(subject, height, recache):
+    from . import quickflat
+    quickflat.get_flatcache(subject, None, height=height, recache=recache)
+
+def _flatpixel(subject, xfmname, height, sampler, recache):
+    from . import quickflat
+    quickflat.get_flatcache(subject, xfmname, height=height, sampler=sampler, recache=recache)
+
+def _mapper(subject, xfmname, sampler, recache):
+    from . import utils
+    utils.get_mapper(subject, xfmname, sampler, recache=recache)
+
+def _ctmpack(subject, types, recache):
+    from . import utils
+    # The options that webgl.show uses
+    utils.get_ctmpack(subject, types, method='mg2', level=9, recache=recache)
+
+def _tasks(subject, xfms, height, sampler, types, recache):
+    """The artifacts to build, as a dict from name to (function, args, dependencies)."""
+    tasks = dict(
+        curvature=(_curvature, (subject, recache), ()),
+        flatmask=(_flatmask, (subject, height, recache), ()),
+        flatverts=(_flatverts, (subject, height, recache), ("flatmask",)),
+        ctmpack=(_ctmpack, (subject, tuple(types), recache), ("curvature", "flatmask")),
+    )
+    for xfmname in xfms:
+        tasks["mapper:%s"%xfmname] = (_mapper, (subject, xfmname, sampler, recache), ())
+        # The pixel cache also samples with the transform's mapper, so it waits for the
+        # mapper instead of building it again in another worker
+        tasks["flatpixel:%s"%xfmname] = (_flatpixel, (subject, xfmname, height, sampler, recache),
+                                         ("flatmask", "mapper:%s"%xfmname))
+    return tasks
+
+def _run(func, args):
+    """Run one task, returning its time and the error it raised, if any."""
+    start = time.time()
+    try:
+        func(*args)
+        error = None
+    except Exception as e:
+        error = "%s: %s"%(type(e).__name__, e)
+    return time.time() - start, error
+
+def warm(subject, xfms=None, n_jobs=None, height=1024, sampler='nearest', types=("inflated",),
+         recache=False):
+    """Build the caches that quickflat and webgl use for `subject`: curvature, the
+    flatmap mask and vertex cache, the ctm pack, and a mapper and pixel flatmap cache
+    for each transform. Artifacts that do not depend on each other are built in
+    parallel.
+
+    Parameters
+    ----------
+    subject : str
+        Name of the subject
+    xfms : list of str, optional
+        Transforms to build mappers and flatmap caches for. Defaults to all of them.
+    n_jobs : int, optional
+        Number of worker processes. Defaults to the number of CPUs; with 1, everything
+        is built in this process.
+    height : int, optional
+        Height of the flatmaps, as passed to quickflat
+    sampler : str, optional
+        Sampler of the mappers and flatmap caches
+    types : tuple of str, optional
+        Surface types of the ctm pack, as passed to webgl.show
+    recache : bool, optional
+        Rebuild artifacts that are already cached
+
+    Returns
+    -------
+    timings : dict
+        Seconds spent on each artifact
+    errors : dict
+        The error of each artifact that could not be built. Artifacts that depend
+        on it are not attempted. If a worker process dies, every artifact that was
+        being built at the time fails, and the rest are built in a new pool.
+    """
+    if xfms is None:
+        xfms = db.get_paths(subject)['xfms']
+    if n_jobs is None:
+        n_jobs = mp.cpu_count()
+    pending = _tasks(subject, xfms, height, sampler, types, recache)
+    timings, errors = dict(), dict()
+    running = dict()
+
+    def finish(name, result):
+        elapsed, error = result
+        if error is None:
+            timings[name] = elapsed
+            print("Built %s in %0.2f s"%(name, elapsed))
+        else:
+            errors[name] = error
+            print("Could not build %s: %s"%(name, error))
+
+    pool = None
+    start = time.time()
+    try:
+        while pending or running:
+            for name, (func, args, deps) in sorted(pending.items()):
+                if any(dep in errors for dep in deps):
+                    del pending[name]
+                    errors[name] = "depends on %s, which failed"%', '.join(
+                        dep for dep in deps if dep in errors)
+                elif all(dep in timings for dep in deps):
+                    del pending[name]
+                    if n_jobs <= 1:
+                        finish(name, _run(func, args))
+                        continue
+                    if pool is None:
+                        pool = ProcessPoolExecutor(n_jobs)
+                    running[pool.submit(_run, func, args)] = name, pool
+            if not running:
+                continue
+            # A worker that dies fails its future with BrokenProcessPool instead of
+            # leaving it unfinished, so this cannot wait forever
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                name, owner = running.pop(future)
+                try:
+                    result = future.result()
+                except BrokenProcessPool as e:
+                    result = 0, "%s: %s"%(type(e).__name__, e)
+                    if owner is pool:
+                        # The pool cannot take new work, so start another one
+                        pool.shutdown(wait=False)
+                        pool = None
+                finish(name, result)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    print("Warmed up %s in %0.2f s (%d built, %d failed)"%(
+        subject, time.time() - start, len(timings), len(errors)))
+    return timings, errors
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Prebuild the pycortex caches of a subject")
+    parser.add_argument("subject")
+    parser.add_argument("xfms", nargs="*", help="Transforms to build mappers and "
+                        "flatmap caches for (default: all)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument("--height", type=int, default=1024, help="Flatmap height")
+    parser.add_argument("--sampler", default="nearest", help="Mapper sampler")
+    parser.add_argument("--recache", action="store_true", help="Rebuild cached artifacts")
+    args = parser.parse_args(argv)
+    timings, errors = warm(args.subject, args.xfms or None, n_jobs=args.jobs,
+                           height=args.height, sampler=args.sampler, recache=args.recache)
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
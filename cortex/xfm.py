@@ -6,11 +6,17 @@ class Transform(object):
     A standard affine transform. Typically holds a transform from anatomical 
     magnet space to epi file space.
     '''
-    def __init__(self, xfm, reference):
+    def __init__(self, xfm, reference, shape=None, affine=None):
         self.xfm = xfm
-        self.reference = None
-
-        if isstr(reference):
+        self._reference = None
+        self._reffile = None
+        self._affine = affine
+
+        if isstr(reference) and shape is not None:
+            # The shape is known, so the reference is only loaded once it is needed
+            self._reffile = reference
+            self.shape = tuple(shape)
+        elif isstr(reference):
             import nibabel
             try:
                 self.reference = nibabel.load(reference)
@@ -23,33 +29,72 @@ class Transform(object):
             self.reference = reference
             self.shape = self.reference.shape[:3][::-1]
 
-    def __call__(self, pts):
-        return np.dot(self.xfm, np.hstack([pts, np.ones((len(pts),1))]).T)[:3].T
+    @property
+    def reference(self):
+        if self._reffile is not None:
+            import nibabel
+            try:
+                self._reference = nibabel.load(self._reffile)
+            except IOError:
+                self._reference = self._reffile
+            self._reffile = None
+        return self._reference
+
+    @reference.setter
+    def reference(self, reference):
+        self._reference = reference
+        self._reffile = None
 
     @property
-    def inv(self):
+    def affine(self):
+        """Affine of the reference image, from voxel indices to magnet space"""
+        if self._affine is None:
+            self._affine = self.reference.affine
+        return self._affine
+
+    @property
+    def reference_file(self):
+        """Filename of the reference image, for tools that need the image itself.
+        Raises IOError for transforms that only know the shape and affine of their
+        reference, such as those of subjects mounted from a bundle."""
+        if self._reffile is not None:
+            return self._reffile
+        if isstr(self._reference):
+            return self._reference
+        try:
+            return self._reference.get_filename()
+        except AttributeError:
+            raise IOError('Transform has no reference image file, only its shape and affine')
+
+    def _derive(self, xfm):
+        """A transform into the same space as this one, without loading the reference."""
+        if self._reffile is not None:
+            return Transform(xfm, self._reffile, shape=self.shape, affine=self._affine)
         ref = self.reference
         if ref is None:
             ref = self.shape
-        return Transform(np.linalg.inv(self.xfm), ref)
+        return Transform(xfm, ref)
+
+    def __call__(self, pts):
+        return np.dot(self.xfm, np.hstack([pts, np.ones((len(pts),1))]).T)[:3].T
+
+    @property
+    def inv(self):
+        return self._derive(np.linalg.inv(self.xfm))
 
     def __mul__(self, other):
-        ref = self.reference
-        if ref is None:
-            ref = self.shape
         if isinstance(other, Transform):
             other = other.xfm
-        return Transform(np.dot(self.xfm, other), ref)
+        return self._derive(np.dot(self.xfm, other))
 
     def __rmul__(self, other):
-        ref = self.reference
-        if ref is None:
-            ref = self.shape
         if isinstance(other, Transform):
             other = other.xfm
-        return Transform(np.dot(other, self.xfm), ref)
+        return self._derive(np.dot(other, self.xfm))
 
     def __repr__(self):
+        if self._reffile is not None:
+            return "<Transform into %s space>"%os.path.split(self._reffile)[1]
         try:
             path, fname = os.path.split(self.reference.get_filename())
             return "<Transform into %s space>"%fname